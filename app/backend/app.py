@@ -1,9 +1,26 @@
-from flask import Flask, request, jsonify, send_from_directory, send_file
+from flask import Flask, Response, request, jsonify, send_from_directory, send_file
 import os
 import uuid
+import hashlib
+import mimetypes
 # from utils.yandex import ocr_image, generate_worksheet_latex
-from utils.latex import compile_latex
-from utils.db import init_db, save_worksheet, get_history
+from utils.latex import warm_up_latex
+from utils.tex_pool import get_pool_stats
+from utils.pdf_cache import get_cache_stats
+from utils import storage
+from utils.storage import start_reaper, get_storage_stats
+from utils.templates import list_templates
+from utils.cloud_latex import get_cloud_stats
+from utils.gigachat_clients import get_gigachat_stats
+from utils.admission import get_admission_stats
+from utils import thumbnails
+from utils.images import get_image_stats
+from utils.speculative import init_speculative_db, get_speculative_stats
+from utils.llm_limits import init_llm_limits_db, get_llm_limits_stats
+from utils import llm_metrics
+from utils.db import init_db, get_history
+from utils import jobs, pipeline
+from utils.llm_cache import init_llm_cache_db, get_llm_cache_stats, HASH_CHUNK
 
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
@@ -13,11 +30,91 @@ CORS(app)
 
 # Initialize database
 init_db()
+jobs.init_jobs_db()
+init_llm_cache_db()
+init_speculative_db()
+init_llm_limits_db()
+llm_metrics.init_llm_metrics_db()
+
+# Precompile the template preamble so compiles only typeset the document body
+warm_up_latex()
+
+# Enforce max age / max size of static/generated in the background
+start_reaper()
 
 UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Queue workers inside the web process, for deployments without a separate worker.py
+JOB_INPROCESS_WORKERS = int(os.environ.get('JOB_INPROCESS_WORKERS', 0))
+# Longest long-poll of GET /api/jobs/<id>?wait=N (seconds). A waiting request
+# holds a sync gunicorn worker, so longer polls are served by async_app.py
+JOB_MAX_WAIT = 5
+
+# Generated files never change under their name, so browsers and proxies may keep them for a year
+GENERATED_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# With nginx in front, set this to an internal location aliasing static/generated
+# (see deploy_nginx.py); nginx then ships the bytes itself via sendfile.
+# Only requests proxied with "X-Sendfile-Type: X-Accel-Redirect" are handed off,
+# direct requests (e.g. from the bot) still get the file from Flask.
+GENERATED_ACCEL_PREFIX = os.environ.get('GENERATED_ACCEL_PREFIX', '')
+
+if JOB_INPROCESS_WORKERS:
+    from worker import start_inprocess_workers
+    start_inprocess_workers(JOB_INPROCESS_WORKERS)
+
+def save_uploads(files):
+    """
+    Saves uploaded files under the sha256 of their content, so the same page
+    uploaded twice is stored once and recognised by the LLM cache.
+    """
+    filepaths = []
+    for file in files:
+        if file:
+            ext = os.path.splitext(secure_filename(file.filename))[1].lower()
+            tmp_path = os.path.join(app.config['UPLOAD_FOLDER'], f".{uuid.uuid4().hex}.part")
+            h = hashlib.sha256()
+            with open(tmp_path, 'wb') as f:
+                for chunk in iter(lambda: file.stream.read(HASH_CHUNK), b''):
+                    h.update(chunk)
+                    f.write(chunk)
+            filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{h.hexdigest()}{ext}")
+            # Same name means same bytes, so replacing a concurrent upload is harmless
+            os.replace(tmp_path, filepath)
+            filepaths.append(filepath)
+    return filepaths
+
+def sse_response(events):
+    response = Response(events, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Tells nginx to pass events through instead of buffering the response
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def request_flag(value):
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+def job_accepted(job_id):
+    return jsonify({
+        'job_id': job_id,
+        'status': jobs.QUEUED,
+        'status_url': f"/worksheet-api/jobs/{job_id}",
+        'result_url': f"/worksheet-api/jobs/{job_id}/result"
+    }), 202
+
+def api_response(response_data, status):
+    response = jsonify(response_data)
+    response.status_code = status
+    if status in (429, 503) and 'retry_after' in response_data:
+        response.headers['Retry-After'] = str(response_data['retry_after'])
+    return response
+
+@app.before_request
+def tag_llm_metrics():
+    # LLM calls made while handling this request are attributed to its path
+    llm_metrics.set_endpoint(request.path)
+
 @app.route('/')
 def index():
     return send_from_directory(app.static_folder, 'index.html')
@@ -28,33 +125,35 @@ def process_file():
     if not files or files[0].filename == '':
         return jsonify({'error': 'No files selected'}), 400
 
-    filepaths = []
-    for file in files:
-        if file:
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-            filepaths.append(filepath)
-
+    filepaths = save_uploads(files)
     if not filepaths:
         return jsonify({'error': 'Failed to save files'}), 500
 
     # 2. Process with GigaChat (Multimodal)
-    from utils.gigachat_client import process_image_with_gigachat
     task_count = request.form.get('task_count', 3)
-    topic = request.form.get('topic', 'Рабочий лист')
     model = request.form.get('model', 'GigaChat-Max')
-    teacher_name = request.form.get('teacher_name', '')
-    
-    # This single call handles both OCR and LaTeX generation
-    latex_content = process_image_with_gigachat(filepaths, task_count=task_count, model=model)
+    # no_cache=true asks the model again even if these images were recognised before
+    use_cache = not request_flag(request.form.get('no_cache'))
 
-    # 4. Return LaTeX code (Do not compile yet)
-    return jsonify({
-        'message': 'Worksheet parsed successfully',
-        'latex_code': latex_content,
-        'model': model
-    }), 200
+    # Return LaTeX code (Do not compile yet)
+    response_data, status = pipeline.process_images(filepaths, task_count=task_count, model=model, use_cache=use_cache)
+    return api_response(response_data, status)
+
+@app.route('/api/process/stream', methods=['POST'])
+def process_file_stream():
+    """/api/process with the answer streamed as Server-Sent Events (task, done, error)."""
+    files = request.files.getlist('files')
+    if not files or files[0].filename == '':
+        return jsonify({'error': 'No files selected'}), 400
+
+    filepaths = save_uploads(files)
+    if not filepaths:
+        return jsonify({'error': 'Failed to save files'}), 500
+
+    task_count = request.form.get('task_count', 3)
+    model = request.form.get('model', 'GigaChat-Max')
+    use_cache = not request_flag(request.form.get('no_cache'))
+    return sse_response(pipeline.stream_process_images(filepaths, task_count=task_count, model=model, use_cache=use_cache))
 
 @app.route('/api/compile', methods=['POST'])
 def compile_code():
@@ -62,62 +161,128 @@ def compile_code():
     if not data:
         return jsonify({'error': 'Invalid JSON'}), 400
         
-    latex_content = data.get('latex_code')
-    topic = data.get('topic', 'Рабочий лист')
-    teacher_name = data.get('teacher_name', '')
-    is_variant2 = data.get('is_variant2', False)
-    layout = data.get('layout', '1col')
-    
-    if not latex_content:
-        return jsonify({'error': 'No LaTeX code provided'}), 400
-        
-    base_name = f"variant2_{uuid.uuid4()}" if is_variant2 else f"worksheet_{uuid.uuid4()}"
-    topic_str = f"{topic} (Вариант 2)" if is_variant2 else topic
-    
-    pdf_filename, keys_filename, error = compile_latex(latex_content, topic=topic_str, filename_base=base_name, teacher_name=teacher_name, layout=layout)
-
-    if pdf_filename:
-        pdf_url = f"/worksheet-api/generated/{pdf_filename}"
-        keys_url = f"/worksheet-api/generated/{keys_filename}" if keys_filename else None
-        
-        # Save to history
-        try:
-            save_worksheet(topic_str, teacher_name, latex_content, pdf_url, keys_url)
-        except Exception as e:
-            print(f"Failed to save to history: {e}")
-
-        response_data = {
-            'message': 'PDF generated successfully',
-            'pdf_url': pdf_url
-        }
-        if keys_url:
-            response_data['keys_url'] = keys_url
-            
-        return jsonify(response_data), 200
-    else:
-        return jsonify({'error': f"PDF Generation failed: {error}"}), 500
+    response_data, status = pipeline.compile_worksheet(data)
+    return api_response(response_data, status)
 
 @app.route('/api/generate_similar', methods=['POST'])
 def generate_similar():
-    from utils.gigachat_client import generate_similar_worksheet
-    
     original_text = request.form.get('original_text')
     task_count = request.form.get('task_count', 3)
     model = request.form.get('model', 'GigaChat-Max')
-    topic = request.form.get('topic', 'Рабочий лист')
-    teacher_name = request.form.get('teacher_name', '')
     difficulty = request.form.get('difficulty', 'same')
     
     if not original_text:
         return jsonify({'error': 'Original text is required'}), 400
         
     # Generate similar tasks
-    latex_content = generate_similar_worksheet(original_text, task_count=task_count, model=model, difficulty=difficulty)
-    
-    return jsonify({
-        'message': 'Variant 2 text generated successfully',
-        'latex_code': latex_content
-    }), 200
+    response_data, status = pipeline.generate_similar(original_text, task_count=task_count, model=model, difficulty=difficulty)
+    return api_response(response_data, status)
+
+@app.route('/api/generate_similar/stream', methods=['POST'])
+def generate_similar_stream():
+    """/api/generate_similar with the answer streamed as Server-Sent Events (task, done, error)."""
+    original_text = request.form.get('original_text')
+    task_count = request.form.get('task_count', 3)
+    model = request.form.get('model', 'GigaChat-Max')
+    difficulty = request.form.get('difficulty', 'same')
+
+    if not original_text:
+        return jsonify({'error': 'Original text is required'}), 400
+
+    return sse_response(pipeline.stream_generate_similar(original_text, task_count=task_count, model=model, difficulty=difficulty))
+
+@app.route('/api/class_set', methods=['POST'])
+def class_set():
+    """
+    JSON body: original_text, count (students), and optionally task_count, model,
+    difficulty, topic, teacher_name, layout, template, source.
+    A class takes minutes, longer than the proxy waits, so it is always queued
+    as a class_set job: answers 202 with the job id, the result comes from
+    /api/jobs/<id>/result.
+    """
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({'error': 'Invalid JSON'}), 400
+
+    source = data.pop('source', 'web')
+    if source not in jobs.PRIORITIES:
+        return jsonify({'error': f"Unknown source: {source}", 'sources': list(jobs.PRIORITIES)}), 400
+    invalid = pipeline.check_class_set(data)
+    if invalid:
+        return api_response(*invalid)
+
+    job_id = jobs.submit_job('class_set', data, teacher=data.get('teacher_name', ''), source=source)
+    return job_accepted(job_id)
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    """
+    Queues a process, generate_similar, compile or class_set job and returns its id right away.
+    process takes the multipart form of /api/process, the others a JSON body
+    with the fields of their synchronous endpoint plus 'kind'.
+    source (web, bot, bulk) sets the priority.
+    """
+    files = None
+    if request.files:
+        form = request.form
+        kind = form.get('kind', 'process')
+        if kind != 'process':
+            return jsonify({'error': 'Only process jobs take file uploads'}), 400
+        files = request.files.getlist('files')
+        if not files or files[0].filename == '':
+            return jsonify({'error': 'No files selected'}), 400
+        payload = {
+            'task_count': form.get('task_count', 3),
+            'model': form.get('model', 'GigaChat-Max'),
+            'no_cache': request_flag(form.get('no_cache'))
+        }
+        teacher_name = form.get('teacher_name', '')
+        source = form.get('source', 'web')
+    else:
+        payload = request.get_json(silent=True)
+        if not payload:
+            return jsonify({'error': 'Invalid JSON'}), 400
+        kind = payload.pop('kind', 'compile')
+        teacher_name = payload.get('teacher_name', '')
+        source = payload.pop('source', 'web')
+        if kind == 'compile' and not payload.get('latex_code'):
+            return jsonify({'error': 'No LaTeX code provided'}), 400
+        if kind in ('generate_similar', 'class_set') and not payload.get('original_text'):
+            return jsonify({'error': 'Original text is required'}), 400
+
+    if kind not in jobs.KINDS:
+        return jsonify({'error': f"Unknown job kind: {kind}", 'kinds': list(jobs.KINDS)}), 400
+    if source not in jobs.PRIORITIES:
+        return jsonify({'error': f"Unknown source: {source}", 'sources': list(jobs.PRIORITIES)}), 400
+    if files:
+        payload['filepaths'] = save_uploads(files)
+
+    job_id = jobs.submit_job(kind, payload, teacher=teacher_name, source=source)
+    return job_accepted(job_id)
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    # ?wait=N long-polls until the job is finished or N seconds have passed
+    wait = min(request.args.get('wait', 0, type=float), JOB_MAX_WAIT)
+    job = jobs.wait_for_job(job_id, wait) if wait > 0 else jobs.get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(jobs.job_status(job)), 200
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """Answers exactly like the synchronous endpoint once the job is finished, 202 before that."""
+    wait = min(request.args.get('wait', 0, type=float), JOB_MAX_WAIT)
+    job = jobs.wait_for_job(job_id, wait) if wait > 0 else jobs.get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] not in (jobs.DONE, jobs.FAILED):
+        return jsonify(jobs.job_status(job)), 202
+    return api_response(job['result'], job['http_status'])
+
+@app.route('/api/templates', methods=['GET'])
+def templates():
+    return jsonify({'templates': list_templates()}), 200
 
 @app.route('/api/history', methods=['GET'])
 def history():
@@ -128,6 +293,35 @@ def history():
     except Exception as e:
         return jsonify({'error': f"Failed to fetch history: {e}"}), 500
 
+@app.route('/api/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        'tex_pool': get_pool_stats(),
+        'tex_admission': get_admission_stats(),
+        'pdf_cache': get_cache_stats(),
+        'storage': get_storage_stats(),
+        'cloud_latex': get_cloud_stats(),
+        'llm_cache': get_llm_cache_stats(),
+        'images': get_image_stats(),
+        'speculative_variant2': get_speculative_stats(),
+        'gigachat': get_gigachat_stats(),
+        'llm_limits': get_llm_limits_stats(),
+        'llm_metrics': llm_metrics.get_llm_metrics_stats(),
+        'thumbnails': thumbnails.get_thumbnail_stats(),
+        'jobs': jobs.get_queue_stats()
+    }), 200
+
+@app.route('/api/llm_metrics', methods=['GET'])
+def llm_metrics_summary():
+    """
+    Calls to the models in the last ?hours=24, grouped by ?group_by=endpoint,model
+    (any of endpoint, provider, model, operation, prompt_version; all by default).
+    """
+    hours = request.args.get('hours', 24, type=float)
+    group_by = request.args.get('group_by')
+    group_by = group_by.split(',') if group_by else llm_metrics.GROUP_BY
+    return jsonify(llm_metrics.summarize(hours=hours, group_by=group_by)), 200
+
 @app.route('/api/debug-env')
 def debug_env():
     import os
@@ -146,9 +340,50 @@ def debug_env():
         'mod_cred_last10': str(mod_cred)[-10:]
     })
 
+def send_generated(filename, path):
+    """Sends a file from static/generated with an ETag and immutable caching."""
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    if GENERATED_ACCEL_PREFIX and request.headers.get('X-Sendfile-Type') == 'X-Accel-Redirect':
+        # nginx does not pass our ETag on; it sends its own and answers
+        # If-None-Match and Range requests for the file itself
+        response = app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = GENERATED_ACCEL_PREFIX.rstrip('/') + '/' + filename
+    else:
+        # conditional=True answers If-None-Match with 304 and Range requests with 206
+        response = send_file(path, mimetype=mimetype, conditional=True, etag=storage.file_etag(path))
+    response.headers['Cache-Control'] = GENERATED_CACHE_CONTROL
+    return response
+
 @app.route('/api/generated/<path:filename>')
 def serve_generated(filename):
-    return send_from_directory('static/generated', filename)
+    path = storage.resolve(filename)
+    if path is None:
+        return jsonify({'error': 'File not found'}), 404
+    return send_generated(filename, path)
+
+@app.route('/api/thumbnail/<path:filename>')
+def serve_thumbnail(filename):
+    """PNG of page ?page=N (default 1) of a generated PDF, ?width=W pixels wide."""
+    path = storage.resolve(filename)
+    if path is None or not path.endswith('.pdf'):
+        return jsonify({'error': 'File not found'}), 404
+    page = request.args.get('page', 1, type=int)
+    if not 1 <= page <= thumbnails.MAX_PAGE:
+        return jsonify({'error': f"page must be between 1 and {thumbnails.MAX_PAGE}"}), 400
+    width = thumbnails.normalize_width(request.args.get('width', type=int))
+
+    try:
+        thumb_name, error = thumbnails.get_thumbnail(path, page=page, width=width)
+    except thumbnails.ThumbnailBusy as e:
+        return api_response({'error': 'Thumbnail renderer is busy, try again shortly.', 'retry_after': e.retry_after}, 503)
+    if error:
+        if error == thumbnails.PDFTOPPM_NOT_FOUND:
+            return jsonify({'error': error}), 501
+        if 'page' in error.lower():
+            return jsonify({'error': f"Page {page} not found"}), 404
+        return jsonify({'error': error}), 500
+    return send_generated(thumb_name, storage.resolve(thumb_name))
 
 if __name__ == '__main__':
     app.run(debug=True, port=3005)
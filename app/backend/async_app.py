@@ -0,0 +1,233 @@
+"""
+Asyncio server for the LLM-bound endpoints: python async_app.py (from app/backend)
+
+/api/process, /api/generate_similar and their /stream variants spend almost all
+their time waiting for GigaChat. In gunicorn every such request holds a worker
+for up to two minutes; here one process holds hundreds of them, and the number
+of GigaChat calls in flight is limited by GIGACHAT_MAX_CONCURRENT (the upstream
+quota) instead. Hashing, the sqlite caches and image processing run in
+executors. Requests and responses are the same as in app.py; nginx sends these
+paths here and everything else to gunicorn (see deploy_nginx.py).
+The long polls of /api/jobs/<id> wait here as well.
+"""
+import os
+import uuid
+import asyncio
+import hashlib
+
+from aiohttp import web
+from werkzeug.utils import secure_filename
+
+from utils import pipeline, jobs
+from utils.llm_cache import init_llm_cache_db, HASH_CHUNK
+from utils.gigachat_client import get_async_quota_stats
+from utils.speculative import init_speculative_db, get_speculative_stats
+from utils.llm_limits import init_llm_limits_db, get_llm_limits_stats
+from utils import llm_metrics
+from utils.gigachat_clients import aclose_client_manager, get_gigachat_stats
+
+ASYNC_HOST = os.environ.get('ASYNC_HOST', '127.0.0.1')
+ASYNC_PORT = int(os.environ.get('ASYNC_PORT', 3006))
+# Longest long-poll of GET /api/jobs/<id>?wait=N (seconds)
+JOB_MAX_WAIT = 30
+
+UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'uploads')
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+
+def _write_chunk(f, chunk):
+    f.write(chunk)
+
+
+async def read_form(request):
+    """
+    Reads a multipart or urlencoded form. Files are saved like app.save_uploads
+    does (under the sha256 of their content) while they arrive.
+    Returns (fields, filepaths).
+    """
+    if not request.content_type.startswith('multipart/'):
+        return dict(await request.post()), []
+
+    loop = asyncio.get_running_loop()
+    fields = {}
+    filepaths = []
+    reader = await request.multipart()
+    async for part in reader:
+        if not part.filename:
+            fields[part.name] = await part.text()
+            continue
+        if part.name != 'files':
+            await part.release()
+            continue
+        ext = os.path.splitext(secure_filename(part.filename))[1].lower()
+        tmp_path = os.path.join(UPLOAD_FOLDER, f".{uuid.uuid4().hex}.part")
+        h = hashlib.sha256()
+        size = 0
+        f = await loop.run_in_executor(None, open, tmp_path, 'wb')
+        try:
+            while True:
+                chunk = await part.read_chunk(HASH_CHUNK)
+                if not chunk:
+                    break
+                h.update(chunk)
+                size += len(chunk)
+                await loop.run_in_executor(None, _write_chunk, f, chunk)
+        finally:
+            await loop.run_in_executor(None, f.close)
+        if not size:
+            # Empty file input
+            os.remove(tmp_path)
+            continue
+        filepath = os.path.join(UPLOAD_FOLDER, f"{h.hexdigest()}{ext}")
+        os.replace(tmp_path, filepath)
+        filepaths.append(filepath)
+    return fields, filepaths
+
+
+def request_flag(value):
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+
+def api_response(response_data, status):
+    response = web.json_response(response_data, status=status)
+    if status in (429, 503) and 'retry_after' in response_data:
+        response.headers['Retry-After'] = str(response_data['retry_after'])
+    return response
+
+
+async def sse_response(request, events):
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream; charset=utf-8',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    await response.prepare(request)
+    try:
+        async for event in events:
+            await response.write(event.encode('utf-8'))
+    except ConnectionResetError:
+        # The client went away; closing the events below stops the completion
+        pass
+    finally:
+        await events.aclose()
+    return response
+
+
+async def process_file(request):
+    fields, filepaths = await read_form(request)
+    if not filepaths:
+        return web.json_response({'error': 'No files selected'}, status=400)
+
+    task_count = fields.get('task_count', 3)
+    model = fields.get('model', 'GigaChat-Max')
+    use_cache = not request_flag(fields.get('no_cache'))
+    response_data, status = await pipeline.aprocess_images(filepaths, task_count=task_count, model=model, use_cache=use_cache)
+    return api_response(response_data, status)
+
+
+async def process_file_stream(request):
+    fields, filepaths = await read_form(request)
+    if not filepaths:
+        return web.json_response({'error': 'No files selected'}, status=400)
+
+    task_count = fields.get('task_count', 3)
+    model = fields.get('model', 'GigaChat-Max')
+    use_cache = not request_flag(fields.get('no_cache'))
+    return await sse_response(request, pipeline.astream_process_images(filepaths, task_count=task_count, model=model, use_cache=use_cache))
+
+
+async def generate_similar(request):
+    fields, _ = await read_form(request)
+    original_text = fields.get('original_text')
+    if not original_text:
+        return web.json_response({'error': 'Original text is required'}, status=400)
+
+    response_data, status = await pipeline.agenerate_similar(
+        original_text, task_count=fields.get('task_count', 3), model=fields.get('model', 'GigaChat-Max'),
+        difficulty=fields.get('difficulty', 'same')
+    )
+    return api_response(response_data, status)
+
+
+async def generate_similar_stream(request):
+    fields, _ = await read_form(request)
+    original_text = fields.get('original_text')
+    if not original_text:
+        return web.json_response({'error': 'Original text is required'}, status=400)
+
+    return await sse_response(request, pipeline.astream_generate_similar(
+        original_text, task_count=fields.get('task_count', 3), model=fields.get('model', 'GigaChat-Max'),
+        difficulty=fields.get('difficulty', 'same')
+    ))
+
+
+async def _waited_job(request):
+    try:
+        wait = min(float(request.query.get('wait', 0)), JOB_MAX_WAIT)
+    except ValueError:
+        wait = 0
+    job_id = request.match_info['job_id']
+    if wait > 0:
+        return await jobs.await_job(job_id, wait)
+    return await asyncio.to_thread(jobs.get_job, job_id)
+
+
+async def job_status(request):
+    # ?wait=N long-polls until the job is finished or N seconds have passed
+    job = await _waited_job(request)
+    if job is None:
+        return web.json_response({'error': 'Job not found'}, status=404)
+    return web.json_response(jobs.job_status(job))
+
+
+async def job_result(request):
+    """Answers exactly like the synchronous endpoint once the job is finished, 202 before that."""
+    job = await _waited_job(request)
+    if job is None:
+        return web.json_response({'error': 'Job not found'}, status=404)
+    if job['status'] not in (jobs.DONE, jobs.FAILED):
+        return web.json_response(jobs.job_status(job), status=202)
+    return api_response(job['result'], job['http_status'])
+
+
+async def stats(request):
+    return web.json_response({
+        'gigachat': get_gigachat_stats(),
+        'gigachat_quota': get_async_quota_stats(),
+        'llm_limits': get_llm_limits_stats(),
+        'llm_metrics': llm_metrics.get_llm_metrics_stats(),
+        'speculative_variant2': get_speculative_stats()
+    })
+
+
+@web.middleware
+async def tag_llm_metrics(request, handler):
+    # Every request runs in its own task, so the endpoint stays with its LLM calls
+    llm_metrics.set_endpoint(request.path)
+    return await handler(request)
+
+
+async def close_clients(app):
+    await aclose_client_manager()
+
+
+def create_app():
+    init_llm_cache_db()
+    jobs.init_jobs_db()
+    init_speculative_db()
+    init_llm_limits_db()
+    llm_metrics.init_llm_metrics_db()
+    app = web.Application(middlewares=[tag_llm_metrics])
+    app.router.add_post('/api/process', process_file)
+    app.router.add_post('/api/process/stream', process_file_stream)
+    app.router.add_post('/api/generate_similar', generate_similar)
+    app.router.add_post('/api/generate_similar/stream', generate_similar_stream)
+    app.router.add_get('/api/jobs/{job_id}', job_status)
+    app.router.add_get('/api/jobs/{job_id}/result', job_result)
+    app.router.add_get('/api/async/stats', stats)
+    app.on_cleanup.append(close_clients)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host=ASYNC_HOST, port=ASYNC_PORT)
@@ -0,0 +1,230 @@
+"""
+Compile pipeline benchmarks: python benchmarks/bench_compile.py (from app/backend)
+
+Runs every worksheet of benchmarks/corpus.py through the same steps as
+utils.latex.compile_latex, with the PDF cache disabled and local pdflatex only
+(no network), and reports per-stage timings, PDF sizes and p50/p95 latency.
+
+    --save-baseline              store the results as the baseline
+    --baseline FILE              compare with a baseline (default benchmarks/baseline.json)
+    --threshold 0.15             fail (exit code 1) if a case got more than 15% slower
+                                 or its PDF more than 15% bigger than in the baseline
+    --template-file FILE         benchmark this template instead of templates/default_worksheet.tex
+
+Before/after numbers of a template change, e.g. of commit C:
+
+    git show C^:app/backend/templates/default_worksheet.tex > /tmp/before.tex
+    python benchmarks/bench_compile.py --template-file /tmp/before.tex --save-baseline --baseline /tmp/before.json
+    python benchmarks/bench_compile.py --baseline /tmp/before.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+
+# Offline and uncached: must be set before utils are imported
+os.environ['USE_CLOUD_LATEX'] = 'false'
+os.environ['PDF_CACHE_ENABLED'] = 'false'
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from utils import latex, storage  # noqa: E402
+from utils.templates import Template, get_template  # noqa: E402
+from corpus import build_corpus  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+DEFAULT_OUTPUT = os.path.join(BENCH_DIR, 'results', 'latest.json')
+STAGES = ('keys_split', 'render', 'tex', 'total')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 1:
+        return values[0]
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def run_case(template, case, iteration):
+    """One pass through the pipeline. Returns (timings in ms, pdf bytes, keys bytes)."""
+    topic = f"{case['topic']} (Вариант 2)" if case['is_variant2'] else case['topic']
+    base = f"bench_{case['name']}_{iteration}"
+    timings = {}
+    started = time.perf_counter()
+
+    t = time.perf_counter()
+    tasks_content, keys_content = latex.extract_keys(case['content'])
+    timings['keys_split'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    docs = [(*latex._render_document(template, tasks_content, topic, "Бенчмарк", layout=case['layout']), base)]
+    if keys_content:
+        docs.append((*latex._render_document(template, keys_content, f"{topic} (Ответы)", "Бенчмарк"), f"{base}_keys"))
+    timings['render'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    results = latex._compile_documents(template, docs)
+    timings['tex'] = time.perf_counter() - t
+    timings['total'] = time.perf_counter() - started
+
+    sizes = []
+    for pdf_name, error in results:
+        if error:
+            raise RuntimeError(f"{case['name']}: {error}")
+        path = os.path.join(storage.OUTPUT_DIR, *pdf_name.split('/'))
+        sizes.append(os.path.getsize(path))
+        os.remove(path)
+    return {k: v * 1000 for k, v in timings.items()}, sizes[0], (sizes[1] if len(sizes) > 1 else 0)
+
+
+def load_template(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return Template(os.path.splitext(os.path.basename(path))[0], f.read(), os.path.getmtime(path))
+
+
+def run(template, iterations, warmup, only=None):
+    latex.warm_up_latex()
+    fmt_name = latex.get_preamble_format(template, wait=True)
+    if latex.USE_PREAMBLE_FORMAT and not fmt_name:
+        print("Warning: preamble format could not be built, compiling with the full preamble")
+
+    results = {}
+    for case in build_corpus():
+        if only and case['name'] not in only:
+            continue
+        for i in range(warmup):
+            run_case(template, case, f"w{i}")
+        samples = {stage: [] for stage in STAGES}
+        pdf_bytes = keys_bytes = 0
+        for i in range(iterations):
+            timings, pdf_bytes, keys_bytes = run_case(template, case, i)
+            for stage in STAGES:
+                samples[stage].append(timings[stage])
+
+        results[case['name']] = {
+            stage: {
+                'p50': round(percentile(values, 50), 2),
+                'p95': round(percentile(values, 95), 2),
+                'mean': round(statistics.fmean(values), 2)
+            }
+            for stage, values in samples.items()
+        }
+        results[case['name']]['pdf_bytes'] = pdf_bytes
+        results[case['name']]['keys_bytes'] = keys_bytes
+        print(f"{case['name']:<14} total p50 {results[case['name']]['total']['p50']:8.1f} ms  "
+              f"p95 {results[case['name']]['total']['p95']:8.1f} ms  "
+              f"tex p50 {results[case['name']]['tex']['p50']:8.1f} ms  "
+              f"render p50 {results[case['name']]['render']['p50']:6.2f} ms  "
+              f"pdf {pdf_bytes / 1024:6.1f} KiB")
+    return results
+
+
+def environment(template, iterations):
+    try:
+        tex_version = subprocess.run(['pdflatex', '--version'], stdout=subprocess.PIPE, timeout=10).stdout.decode('utf-8', errors='ignore').split('\n')[0]
+    except (OSError, subprocess.TimeoutExpired):
+        tex_version = None
+    return {
+        'created_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'pdflatex': tex_version,
+        'template': template.name,
+        'template_version': template.version,
+        'preamble_format': latex.USE_PREAMBLE_FORMAT,
+        'iterations': iterations
+    }
+
+
+def compare(results, baseline, threshold):
+    """Returns a list of regressions (case, metric, baseline value, new value)."""
+    regressions = []
+    for name, case in results.items():
+        old = baseline.get('cases', {}).get(name)
+        if not old:
+            continue
+        for metric in ('total', 'tex'):
+            if case[metric]['p50'] > old[metric]['p50'] * (1 + threshold):
+                regressions.append((name, f"{metric} p50 ms", old[metric]['p50'], case[metric]['p50']))
+        if case['pdf_bytes'] > old['pdf_bytes'] * (1 + threshold):
+            regressions.append((name, 'pdf bytes', old['pdf_bytes'], case['pdf_bytes']))
+    return regressions
+
+
+def print_changes(results, baseline):
+    """Per case: total p50 and PDF size compared with the baseline."""
+    for name, case in results.items():
+        old = baseline.get('cases', {}).get(name)
+        if not old:
+            continue
+        total, old_total = case['total']['p50'], old['total']['p50']
+        print(f"{name:<14} total p50 {old_total:8.1f} -> {total:8.1f} ms ({(total / old_total - 1) * 100:+5.1f}%)  "
+              f"pdf {old['pdf_bytes'] / 1024:6.1f} -> {case['pdf_bytes'] / 1024:6.1f} KiB "
+              f"({(case['pdf_bytes'] / old['pdf_bytes'] - 1) * 100:+5.1f}%)")
+
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+        f.write('\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the LaTeX compile pipeline (local pdflatex only).")
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--case', action='append', help="run only this case (repeatable)")
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.15)
+    parser.add_argument('--template-file', help="template to benchmark instead of the default one")
+    args = parser.parse_args()
+
+    if shutil.which('pdflatex') is None:
+        print("pdflatex not found: the benchmarks need a local TeX installation.")
+        return 2
+
+    template = load_template(args.template_file) if args.template_file else get_template()
+    report = {
+        'environment': environment(template, args.iterations),
+        'cases': run(template, args.iterations, args.warmup, args.case)
+    }
+    write_json(args.output, report)
+    print(f"Results written to {args.output}")
+
+    if args.save_baseline:
+        write_json(args.baseline, report)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare with (run with --save-baseline first).")
+        return 0
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline.get('environment', {}).get('machine') != report['environment']['machine']:
+        print("Warning: the baseline was recorded on a different machine type")
+
+    print_changes(report['cases'], baseline)
+    regressions = compare(report['cases'], baseline, args.threshold)
+    for name, metric, old, new in regressions:
+        print(f"REGRESSION {name}: {metric} {old} -> {new} (+{(new / old - 1) * 100:.0f}%)")
+    if regressions:
+        return 1
+    print(f"No regressions above {args.threshold * 100:.0f}% compared to {args.baseline}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""
+Representative worksheets for the compile benchmarks.
+
+The documents follow what GigaChat is asked to produce (see
+utils/gigachat_client.py): \\TaskBox + \\WriteField per task, \\newpage after
+every page, an answers table at the end, with the field heights of
+utils/layout.py.
+"""
+
+from utils.layout import grid_height_mm
+
+# Task texts of typical length and math density
+TASK_TEXTS = [
+    r"Решите уравнение $x^2 - 5x + 6 = 0$.",
+    r"Найдите значение выражения $\frac{3}{4} + \frac{5}{6} - \frac{1}{12}$.",
+    r"Упростите выражение $(a + b)^2 - (a - b)^2$ и найдите его значение при $a = 2$, $b = -3$.",
+    r"Решите систему уравнений: $\begin{cases} 2x + y = 7, \\ x - y = 2. \end{cases}$",
+    r"Найдите производную функции $f(x) = x^3 - 4x^2 + \sqrt{x}$ в точке $x_0 = 4$.",
+    r"В треугольнике $ABC$ угол $C$ равен $90^\circ$, $AC = 6$, $BC = 8$. Найдите $\sin A$.",
+    r"Вычислите $\int_0^2 (3x^2 - 2x + 1)\,dx$.",
+    r"Решите неравенство $\dfrac{x - 3}{x + 2} \geq 0$.",
+]
+ANSWERS = [r"$2;\ 3$", r"$\frac{3}{2}$", r"$-24$", r"$(3;\ 1)$", r"$\frac{97}{4}$", r"$0{,}8$", r"$6$", r"$(-\infty;\ -2) \cup [3;\ +\infty)$"]
+
+
+def worksheet(tasks_per_page, total_tasks, keys=True, answers_per_task=1):
+    height = grid_height_mm(tasks_per_page)
+    lines = []
+    for i in range(1, total_tasks + 1):
+        lines.append(f"\\TaskBox{{{i}}}{{{TASK_TEXTS[(i - 1) % len(TASK_TEXTS)]}}}")
+        lines.append(f"\\WriteField{{{height}mm}}")
+        if i % tasks_per_page == 0 and i != total_tasks:
+            lines.append(r"\newpage")
+
+    if keys:
+        lines.append(r"\newpage")
+        lines.append(r"\section*{Ответы}")
+        lines.append(r"\begin{tabular}{|c|c|}")
+        lines.append(r"\hline")
+        lines.append(r"№ & Ответ \\")
+        lines.append(r"\hline")
+        row = 1
+        for i in range(1, total_tasks + 1):
+            for _ in range(answers_per_task):
+                lines.append(f"{row} & {ANSWERS[(i - 1) % len(ANSWERS)]} \\\\")
+                row += 1
+        lines.append(r"\hline")
+        lines.append(r"\end{tabular}")
+    return "\n".join(lines)
+
+
+def build_corpus():
+    """Returns the benchmark cases: dicts with name, content, layout, topic, is_variant2."""
+    cases = []
+    for per_page in range(1, 7):
+        cases.append({
+            'name': f"{per_page}tasks_1col",
+            'content': worksheet(per_page, per_page * 2),
+            'layout': '1col',
+        })
+    for per_page in (3, 6):
+        cases.append({
+            'name': f"{per_page}tasks_2col",
+            'content': worksheet(per_page, per_page * 2),
+            'layout': '2col',
+        })
+    # Keys table spanning more than one page
+    cases.append({
+        'name': 'long_keys',
+        'content': worksheet(4, 12, answers_per_task=5),
+        'layout': '1col',
+    })
+    cases.append({
+        'name': 'no_keys',
+        'content': worksheet(3, 6, keys=False),
+        'layout': '1col',
+    })
+    cases.append({
+        'name': 'variant2',
+        'content': worksheet(3, 6).replace(r"\section*{Ответы}", r"\section*{Ответы (Вариант 2)}"),
+        'layout': '1col',
+        'is_variant2': True,
+    })
+
+    for case in cases:
+        case.setdefault('topic', 'Бенчмарк')
+        case.setdefault('is_variant2', False)
+    return cases
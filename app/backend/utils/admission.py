@@ -0,0 +1,179 @@
+import os
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from utils import storage
+
+# Admission control for local pdflatex runs.
+# At most TEX_MAX_CONCURRENT documents are typeset at once on this machine, over
+# all gunicorn and queue worker processes. Up to TEX_MAX_WAITING more requests
+# wait for a slot (at most TEX_QUEUE_TIMEOUT seconds); beyond that requests are
+# rejected right away, so overload turns into 429s instead of thrashing.
+TEX_MAX_CONCURRENT = int(os.environ.get('TEX_MAX_CONCURRENT', os.cpu_count() or 2))
+TEX_MAX_WAITING = int(os.environ.get('TEX_MAX_WAITING', 2 * TEX_MAX_CONCURRENT))
+TEX_QUEUE_TIMEOUT = float(os.environ.get('TEX_QUEUE_TIMEOUT', 30))
+# Slots are lock files; a lock is released by the kernel when its process dies
+SLOTS_DIR = os.path.join(storage.SCRATCH_ROOT, 'admission')
+
+POLL_INTERVAL = 0.05
+
+_stats = {
+    'admitted': 0, 'waited': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0,
+    'rejected_queue_full': 0, 'rejected_timeout': 0, 'running': 0, 'waiting': 0
+}
+_lock = threading.Lock()
+# Moving average of how long a slot is held, for Retry-After
+_avg_hold = 2.0
+
+
+class CompileRejected(Exception):
+    """Raised when no TeX slot is available; answer with 429 and Retry-After."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _retry_after(waiting):
+    # Time until the queue in front of a new request has drained
+    return max(1, math.ceil(_avg_hold * (waiting + 1) / TEX_MAX_CONCURRENT))
+
+
+class _FileSlots:
+    """N interprocess slots, each an flock on its own file."""
+
+    def __init__(self, prefix, count):
+        os.makedirs(SLOTS_DIR, exist_ok=True)
+        self.paths = [os.path.join(SLOTS_DIR, f"{prefix}_{i}.lock") for i in range(count)]
+
+    def try_acquire(self):
+        """Returns a held slot (an open file) or None if all slots are taken."""
+        for path in self.paths:
+            f = open(path, 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return f
+            except OSError:
+                f.close()
+        return None
+
+    def release(self, slot):
+        try:
+            fcntl.flock(slot, fcntl.LOCK_UN)
+        finally:
+            slot.close()
+
+
+class _ThreadSlots:
+    """Fallback without fcntl: the limit only applies within this process."""
+
+    def __init__(self, prefix, count):
+        self._semaphore = threading.BoundedSemaphore(count)
+
+    def try_acquire(self):
+        return self if self._semaphore.acquire(blocking=False) else None
+
+    def release(self, slot):
+        self._semaphore.release()
+
+
+def make_slots(prefix, count):
+    """
+    count slots named prefix, shared by all processes of the machine where fcntl
+    is available. try_acquire() returns a slot or None, release(slot) frees it.
+    """
+    return _FileSlots(prefix, count) if fcntl is not None else _ThreadSlots(prefix, count)
+
+
+def acquire_slot(slots, timeout):
+    """Polls for a free slot for up to timeout seconds. Returns the slot or None."""
+    started = time.monotonic()
+    slot = slots.try_acquire()
+    while slot is None and time.monotonic() - started < timeout:
+        time.sleep(POLL_INTERVAL)
+        slot = slots.try_acquire()
+    return slot
+
+
+_running = make_slots('tex', TEX_MAX_CONCURRENT)
+_waiting = make_slots('wait', TEX_MAX_WAITING) if TEX_MAX_WAITING > 0 else None
+
+
+def _count(key, value=1):
+    with _lock:
+        _stats[key] += value
+
+
+@contextmanager
+def tex_slot(timeout=None):
+    """
+    Holds one of the machine-wide TeX slots while the block runs.
+    Raises CompileRejected if the wait queue is full or no slot frees up in time.
+    """
+    global _avg_hold
+    timeout = TEX_QUEUE_TIMEOUT if timeout is None else timeout
+
+    slot = _running.try_acquire()
+    if slot is None:
+        # Take a place in the bounded wait queue first
+        place = _waiting.try_acquire() if _waiting is not None else None
+        if place is None:
+            _count('rejected_queue_full')
+            raise CompileRejected(
+                "Server is busy compiling other worksheets, please try again shortly.",
+                _retry_after(TEX_MAX_WAITING)
+            )
+
+        started = time.monotonic()
+        _count('waiting')
+        try:
+            slot = acquire_slot(_running, timeout)
+        finally:
+            _waiting.release(place)
+            _count('waiting', -1)
+
+        waited = time.monotonic() - started
+        with _lock:
+            _stats['waited'] += 1
+            _stats['wait_seconds'] += waited
+            _stats['max_wait_seconds'] = max(_stats['max_wait_seconds'], waited)
+        if slot is None:
+            _count('rejected_timeout')
+            raise CompileRejected(
+                f"No LaTeX compiler became free within {timeout:.0f}s, please try again shortly.",
+                _retry_after(TEX_MAX_WAITING)
+            )
+
+    _count('admitted')
+    _count('running')
+    held_since = time.monotonic()
+    try:
+        yield
+    finally:
+        _running.release(slot)
+        held = time.monotonic() - held_since
+        with _lock:
+            _stats['running'] -= 1
+            _avg_hold = 0.8 * _avg_hold + 0.2 * held
+
+
+def get_admission_stats():
+    """Counters of this process; the slot limits are machine-wide."""
+    with _lock:
+        stats = dict(_stats)
+    stats['wait_seconds'] = round(stats['wait_seconds'], 3)
+    stats['max_wait_seconds'] = round(stats['max_wait_seconds'], 3)
+    stats.update(
+        max_concurrent=TEX_MAX_CONCURRENT,
+        max_waiting=TEX_MAX_WAITING,
+        queue_timeout=TEX_QUEUE_TIMEOUT,
+        interprocess=fcntl is not None
+    )
+    return stats
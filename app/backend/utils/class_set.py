@@ -0,0 +1,140 @@
+import os
+import re
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.latex import extract_keys
+from utils.latex_validator import validate_latex
+from utils.llm_result import LLMError
+
+# Class sets: a distinct variant of the worksheet for every student.
+# The variants are generated concurrently (at most CLASS_SET_CONCURRENCY model
+# calls at a time) and put into ONE document, student after student, with all
+# answer tables at the end. compile_latex then runs TeX twice for the whole
+# class (worksheets and keys) instead of twice per student.
+CLASS_SET_MAX_VARIANTS = int(os.environ.get('CLASS_SET_MAX_VARIANTS', 40))
+CLASS_SET_CONCURRENCY = int(os.environ.get('CLASS_SET_CONCURRENCY', 10))
+# Further attempts for a variant that failed, was broken or repeated another one
+CLASS_SET_RETRIES = int(os.environ.get('CLASS_SET_RETRIES', 1))
+
+OK = 'ok'
+FAILED = 'failed'
+
+# Every student's page starts with what the template prints above the content
+STUDENT_PAGE = "\\newpage\n{header}\n"
+STUDENT_LABEL = "{{\\large\\bfseries Вариант {number}}}\\par\\vspace{{3mm}}\n"
+KEYS_TITLE_RE = re.compile(r'\\section\*\{Ответы[^}]*\}')
+
+
+def _tasks_fingerprint(tasks):
+    return re.sub(r'\s+', '', tasks)
+
+
+def _generate_variant(number, original_text, task_count, model, difficulty):
+    from utils.gigachat_client import generate_similar_worksheet
+
+    # The original is Variant 1 in the prompt; combine_variants renumbers the answers by student
+    result = generate_similar_worksheet(original_text, task_count=task_count, model=model, difficulty=difficulty, variant=number + 1)
+    if result.error:
+        return None, result.error
+    validation_error = validate_latex(result.latex)
+    if validation_error:
+        return None, LLMError(LLMError.INVALID_OUTPUT, f"Invalid LaTeX ({validation_error})")
+    if '\\TaskBox' not in result.latex:
+        return None, LLMError(LLMError.INVALID_OUTPUT, "The variant has no tasks.")
+    return result.latex, None
+
+
+def generate_variants(original_text, count, task_count=3, model="GigaChat-Max", difficulty="same"):
+    """
+    Generates count variants of original_text.
+    Returns a list of {'variant', 'status', 'attempts', 'latex'} or, for failed
+    variants, {'variant', 'status', 'attempts', 'error'} in variant order.
+    Variants whose tasks repeat the original or an earlier variant are generated again.
+    """
+    variants = [{'variant': number, 'status': FAILED, 'attempts': 0} for number in range(1, count + 1)]
+    seen = {_tasks_fingerprint(extract_keys(original_text)[0])}
+    pending = list(variants)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(CLASS_SET_CONCURRENCY, count)), thread_name_prefix='class-set') as executor:
+        for attempt in range(1 + CLASS_SET_RETRIES):
+            futures = [
+                # The calls are recorded in the LLM metrics under the endpoint of this request
+                (variant, executor.submit(
+                    contextvars.copy_context().run, _generate_variant, variant['variant'], original_text, task_count, model, difficulty
+                ))
+                for variant in pending
+            ]
+            pending = []
+            for variant, future in futures:
+                variant['attempts'] = attempt + 1
+                latex_content, error = future.result()
+                if error is None:
+                    fingerprint = _tasks_fingerprint(extract_keys(latex_content)[0])
+                    if fingerprint in seen:
+                        error = LLMError(LLMError.INVALID_OUTPUT, "The variant repeats another one.")
+                    else:
+                        seen.add(fingerprint)
+                        variant.update(status=OK, latex=latex_content)
+                        variant.pop('error', None)
+                        continue
+                variant['error'] = error
+                if error.retryable:
+                    pending.append(variant)
+            if not pending:
+                break
+    return variants
+
+
+def combine_variants(variants, header, layout="1col"):
+    """
+    One document with the tasks of every generated variant (each starting on a
+    new page with header, see Template.render_header) followed by the answers
+    of all of them.
+    The generated variants are numbered for the students 1..N without gaps;
+    each gets its number as 'student'.
+    Returns LaTeX that compile_latex splits into worksheets and keys.
+    """
+    tasks_parts = []
+    keys_parts = []
+    for variant in variants:
+        if variant['status'] != OK:
+            continue
+        number = variant['student'] = len(tasks_parts) + 1
+        tasks, keys = extract_keys(variant['latex'])
+        if layout == "2col":
+            # Per student: the page break and title must stay outside multicols
+            tasks = f"\\begin{{multicols}}{{2}}\n{tasks}\n\\end{{multicols}}"
+        page = STUDENT_PAGE.format(header=header) if tasks_parts else ""
+        tasks_parts.append(page + STUDENT_LABEL.format(number=number) + tasks)
+        if keys:
+            title = f"\\section*{{Ответы (Вариант {number})}}"
+            keys_parts.append(KEYS_TITLE_RE.sub(lambda m: title, keys, count=1))
+
+    content = "\n\n".join(tasks_parts)
+    if keys_parts:
+        content += "\n\\newpage\n" + "\n\n".join(keys_parts)
+    return content
+
+
+def check_answer_tables(variants, content):
+    """
+    Error message if the answer key that compile_latex cuts from content
+    misses answer tables of the generated variants, otherwise None.
+    """
+    expected = sum(1 for variant in variants if variant['status'] == OK and KEYS_TITLE_RE.search(variant['latex']))
+    found = len(KEYS_TITLE_RE.findall(extract_keys(content)[1]))
+    if found != expected:
+        return f"The answer key has {found} answer tables instead of {expected}"
+    return None
+
+
+def variant_statuses(variants):
+    """The variants without their LaTeX, for the response."""
+    statuses = []
+    for variant in variants:
+        status = {key: value for key, value in variant.items() if key not in ('latex', 'error')}
+        if 'error' in variant:
+            status['error'] = variant['error'].to_dict()
+        statuses.append(status)
+    return statuses
@@ -0,0 +1,261 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Cloud compilers, tried in order: "kind=url,kind=url".
+# kind is the request format: latexcgi (texlive.net) or ytotech (latex.ytotech.com).
+CLOUD_LATEX_ENDPOINTS = os.environ.get(
+    'CLOUD_LATEX_ENDPOINTS',
+    'latexcgi=https://texlive.net/cgi-bin/latexcgi,ytotech=https://latex.ytotech.com/builds/sync'
+)
+# Start the next endpoint if the current one hasn't answered within this many seconds
+CLOUD_HEDGE_DELAY = float(os.environ.get('CLOUD_LATEX_HEDGE_DELAY', 4))
+# Overall budget for one document, over all endpoints
+CLOUD_DEADLINE = float(os.environ.get('CLOUD_LATEX_DEADLINE', 30))
+CONNECT_TIMEOUT = 5
+# Open an endpoint's circuit after this many consecutive failures, for this many seconds
+BREAKER_FAILURES = int(os.environ.get('CLOUD_LATEX_BREAKER_FAILURES', 3))
+BREAKER_COOLDOWN = float(os.environ.get('CLOUD_LATEX_BREAKER_COOLDOWN', 60))
+
+CHUNK_SIZE = 64 * 1024
+
+
+class CircuitBreaker:
+    """Skips an endpoint after repeated failures; lets one trial request through after the cooldown."""
+
+    def __init__(self, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.cooldown or self._trial:
+                return False
+            # Half-open: a single trial request decides whether the circuit closes
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.failures >= self.max_failures:
+                self.opened_at = time.monotonic()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if self._trial else 'open'
+
+
+class CloudEndpoint:
+    def __init__(self, kind, url):
+        if kind not in ('latexcgi', 'ytotech'):
+            raise ValueError(f"Unknown cloud LaTeX endpoint kind: {kind}")
+        self.kind = kind
+        self.url = url
+        self.breaker = CircuitBreaker()
+        self.stats = {'requests': 0, 'successes': 0, 'failures': 0, 'hedged': 0}
+        # Hedged attempts update the counters from several threads
+        self._lock = threading.Lock()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def request_kwargs(self, latex_source):
+        if self.kind == 'latexcgi':
+            return {'data': {
+                'filecontents[]': latex_source,
+                'filename[]': 'document.tex',
+                'engine': 'pdflatex',
+                'return': 'pdf'
+            }}
+        return {'json': {
+            'compiler': 'pdflatex',
+            'resources': [{'main': True, 'path': 'main.tex', 'content': latex_source}]
+        }}
+
+
+def parse_endpoints(spec):
+    endpoints = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        kind, _, url = item.partition('=')
+        endpoints.append(CloudEndpoint(kind.strip(), url.strip()))
+    return endpoints
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class CloudLatexClient:
+    """
+    Compiles documents on remote LaTeX services over a shared keep-alive session.
+    Requests are hedged: if an endpoint is slow the next one is started too and
+    the first valid PDF wins. Failing endpoints are skipped by a circuit breaker.
+    """
+
+    def __init__(self, endpoints=None, hedge_delay=CLOUD_HEDGE_DELAY, deadline=CLOUD_DEADLINE, session=None):
+        self.endpoints = endpoints if endpoints is not None else parse_endpoints(CLOUD_LATEX_ENDPOINTS)
+        self.hedge_delay = hedge_delay
+        self.deadline = deadline
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=len(self.endpoints) or 1, pool_maxsize=16)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self._executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='cloud-latex')
+
+    def _fetch(self, endpoint, latex_source, part_path, cancel, read_timeout):
+        """
+        Streams the PDF of one endpoint into part_path.
+        Returns (error, endpoint_ok): error is None on success; endpoint_ok tells
+        the circuit breaker whether the service itself worked.
+        """
+        endpoint._count('requests')
+        try:
+            with self.session.post(
+                endpoint.url,
+                stream=True,
+                timeout=(CONNECT_TIMEOUT, read_timeout),
+                **endpoint.request_kwargs(latex_source)
+            ) as response:
+                if response.status_code not in (200, 201):
+                    return f"{endpoint.url}: HTTP {response.status_code}", False
+
+                with open(part_path, 'wb') as f:
+                    first = True
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        if cancel.is_set():
+                            raise _Cancelled()
+                        if first:
+                            # Both services answer with a log instead of a PDF on LaTeX errors
+                            if not chunk.startswith(b'%PDF'):
+                                return f"{endpoint.url}: response is not a PDF (LaTeX error?)", True
+                            first = False
+                        f.write(chunk)
+                if first:
+                    return f"{endpoint.url}: empty response", False
+            return None, True
+        except requests.Timeout:
+            return f"{endpoint.url}: timeout", False
+        except requests.RequestException as e:
+            return f"{endpoint.url}: {e}", False
+
+    def _attempt(self, endpoint, latex_source, part_path, cancel, read_timeout):
+        try:
+            error, endpoint_ok = self._fetch(endpoint, latex_source, part_path, cancel, read_timeout)
+        except _Cancelled:
+            error, endpoint_ok = 'cancelled', None
+        if error is None:
+            endpoint._count('successes')
+        elif error != 'cancelled':
+            endpoint._count('failures')
+        if endpoint_ok:
+            endpoint.breaker.record_success()
+        elif endpoint_ok is False:
+            endpoint.breaker.record_failure()
+        if error and os.path.exists(part_path):
+            os.remove(part_path)
+        return error
+
+    def compile_to(self, latex_source, pdf_path):
+        """Compiles latex_source into pdf_path. Returns None on success or an error string."""
+        started = time.monotonic()
+        cancel = threading.Event()
+        remaining_endpoints = list(self.endpoints)
+        pending = {}
+        errors = []
+
+        def launch_next():
+            # Breakers are asked only when an endpoint is actually used,
+            # so a half-open trial is never reserved and then skipped
+            while remaining_endpoints:
+                endpoint = remaining_endpoints.pop(0)
+                if not endpoint.breaker.allow():
+                    continue
+                if pending or errors:
+                    endpoint._count('hedged')
+                remaining = max(1.0, self.deadline - (time.monotonic() - started))
+                part_path = f"{pdf_path}.{len(self.endpoints) - len(remaining_endpoints)}.part"
+                future = self._executor.submit(self._attempt, endpoint, latex_source, part_path, cancel, remaining)
+                pending[future] = part_path
+                return True
+            return False
+
+        if not launch_next():
+            return "All cloud LaTeX endpoints are temporarily disabled after repeated failures."
+
+        try:
+            while pending:
+                remaining = self.deadline - (time.monotonic() - started)
+                if remaining <= 0:
+                    errors.append("deadline exceeded")
+                    break
+                timeout = min(self.hedge_delay, remaining) if remaining_endpoints else remaining
+                done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    part_path = pending.pop(future)
+                    error = future.result()
+                    if error is None:
+                        os.replace(part_path, pdf_path)
+                        return None
+                    errors.append(error)
+
+                # Hedge on timeout, fail over immediately when nothing is in flight
+                if not done or not pending:
+                    launch_next()
+        finally:
+            # Losing requests stop at their next chunk and clean up their part files
+            cancel.set()
+
+        return f"Cloud LaTeX compilation failed ({'; '.join(errors)}). Consider installing pdflatex on the server."
+
+    def stats(self):
+        return [
+            dict(e.snapshot(), url=e.url, kind=e.kind, circuit=e.breaker.state)
+            for e in self.endpoints
+        ]
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_cloud_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = CloudLatexClient()
+        return _client
+
+
+def get_cloud_stats():
+    return _client.stats() if _client is not None else None
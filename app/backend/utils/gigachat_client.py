@@ -1,8 +1,40 @@
 import os
+import time
 import base64
-from gigachat import GigaChat
+import asyncio
+import itertools
+import mimetypes
+import httpx
+from concurrent.futures import ThreadPoolExecutor
+from gigachat.exceptions import AuthenticationError, ResponseError
 from gigachat.models import Chat, Messages, MessagesRole
 
+from utils.llm_result import LLMResult, LLMError, LLMStreamError
+from utils.gigachat_clients import get_client_manager
+from utils import llm_cache, llm_limits, llm_metrics
+from utils.llm_limits import RateLimitExceeded
+from utils.layout import TaskLayout, layout_for
+
+# The model returns the tasks as a JSON list of {text, answer} and the server
+# lays them out (utils/layout.py): fewer completion tokens, exact layout.
+GIGACHAT_JSON_TASKS = os.environ.get('GIGACHAT_JSON_TASKS', 'false').lower() == 'true'
+
+# Bump when the prompts change, so cached results of the old prompts are not reused
+PROMPT_VERSION = "1"
+if GIGACHAT_JSON_TASKS:
+    PROMPT_VERSION += "-json"
+
+# Images of a multi-page submission are uploaded concurrently, at most this many at once
+GIGACHAT_UPLOAD_CONCURRENCY = int(os.environ.get('GIGACHAT_UPLOAD_CONCURRENCY', 4))
+# Extra attempts per image after a timeout, a connection error, 429 or 5xx
+GIGACHAT_UPLOAD_RETRIES = int(os.environ.get('GIGACHAT_UPLOAD_RETRIES', 2))
+UPLOAD_RETRY_DELAY = 0.5  # seconds, doubled after every attempt
+
+# asyncio path (async_app.py): LLM calls in flight per model in one process.
+# Set it to the upstream quota; requests beyond it wait up to GIGACHAT_QUEUE_TIMEOUT.
+GIGACHAT_MAX_CONCURRENT = int(os.environ.get('GIGACHAT_MAX_CONCURRENT', 10))
+GIGACHAT_QUEUE_TIMEOUT = float(os.environ.get('GIGACHAT_QUEUE_TIMEOUT', 60))
+
 # Load credentials: environment variables FIRST (for Render), then config.py (for local dev)
 GIGACHAT_CREDENTIALS = os.environ.get('GIGACHAT_CREDENTIALS')
 GIGACHAT_SCOPE = os.environ.get('GIGACHAT_SCOPE', 'GIGACHAT_API_PERS')
@@ -32,41 +64,136 @@ def clean_latex(text):
          text = text[:-3]
     return text.strip()
 
-def process_image_with_gigachat(image_paths, task_count=3, model="GigaChat-Max"):
+def get_gigachat(model):
+    """Shared, already authenticated client for the model (see utils/gigachat_clients.py)."""
+    return get_client_manager(GIGACHAT_CREDENTIALS).get(model, GIGACHAT_SCOPE)
+
+def classify_error(e):
+    """Maps an exception of the GigaChat SDK to an LLMResult with a typed error."""
+    if isinstance(e, RateLimitExceeded):
+        return LLMResult.failure(LLMError.RATE_LIMIT, f"Too many requests to GigaChat, try again in {e.wait:.0f} s.")
+    if isinstance(e, AuthenticationError):
+        return LLMResult.failure(LLMError.AUTH, f"Authentication failed: {e}")
+    if isinstance(e, ResponseError):
+        status = e.args[1] if len(e.args) > 1 else None
+        if status == 429:
+            return LLMResult.failure(LLMError.RATE_LIMIT, "Too many requests to GigaChat, try again later.")
+        return LLMResult.failure(LLMError.PROVIDER, f"GigaChat returned HTTP {status}")
+    if isinstance(e, httpx.TimeoutException):
+        return LLMResult.failure(LLMError.TIMEOUT, "GigaChat did not answer in time.")
+    return LLMResult.failure(LLMError.PROVIDER, str(e))
+
+def _is_transient(e):
+    if isinstance(e, AuthenticationError):
+        return False
+    if isinstance(e, ResponseError):
+        status = e.args[1] if len(e.args) > 1 else None
+        return status == 429 or (status or 500) >= 500
+    return isinstance(e, httpx.TransportError)
+
+def _retry_hint(e):
+    """Minimum delay (Retry-After) before retrying a failed completion, None if it is not worth retrying."""
+    if not _is_transient(e):
+        return None
+    headers = e.args[3] if isinstance(e, ResponseError) and len(e.args) > 3 else None
+    try:
+        return float(headers.get('retry-after', 0)) if headers else 0.0
+    except (AttributeError, TypeError, ValueError):
+        return 0.0
+
+def _complete(model, call):
+    """Runs a completion request within the rate limit of the model, retrying transient errors."""
+    return llm_limits.call_with_retry(model, call, _retry_hint)
+
+def _metrics(model, operation, images=0):
+    """Timing and usage record of one request (see utils/llm_metrics.py)."""
+    return llm_metrics.LLMCall('gigachat', model, operation, PROMPT_VERSION, images=images)
+
+def _finish_metrics(metrics, response, result):
+    if response is not None and response.usage:
+        usage = response.usage
+        metrics.set_usage(usage.prompt_tokens, usage.completion_tokens, usage.total_tokens)
+    metrics.finish_result(result)
+    return result
+
+def _upload_one(giga, path, use_cache):
+    """Returns (file id, sha256, whether the id came from the cache)."""
+    sha256 = llm_cache.file_hash(path)
+    file_id = llm_cache.get_file_id(sha256, GIGACHAT_SCOPE) if use_cache else None
+    if file_id:
+        return file_id, sha256, True
+    for attempt in range(GIGACHAT_UPLOAD_RETRIES + 1):
+        try:
+            with open(path, "rb") as f:
+                file_id = giga.upload_file(f).id_
+            break
+        except Exception as e:
+            if attempt == GIGACHAT_UPLOAD_RETRIES or not _is_transient(e):
+                raise
+            time.sleep(UPLOAD_RETRY_DELAY * 2 ** attempt)
+    llm_cache.put_file_id(sha256, GIGACHAT_SCOPE, file_id)
+    return file_id, sha256, False
+
+def _collect_uploads(image_paths, outcomes):
     """
-    Sends images to GigaChat to extract math tasks and format them in LaTeX.
-    
-    Args:
-        image_paths (str|list): Path or list of paths to the image files.
-        task_count (int): Number of tasks to format (guides the layout).
-        model (str): GigaChat model to use (only GigaChat-Max supports images).
-    
-    Returns:
-        str: LaTeX code representing the worksheet content.
+    outcomes: per image, the result of _upload_one or the exception it raised.
+    Returns (attachment ids in page order, hashes of the images whose ids came from
+    the cache, failed images as [{'page', 'file', 'error'}], first exception).
     """
-    if isinstance(image_paths, str):
-        image_paths = [image_paths]
-    if not GIGACHAT_CREDENTIALS:
-        return "Error: GIGACHAT_CREDENTIALS not found in config.py"
-    
-    # Only GigaChat-Max supports multimodal (image) input
-    if model != "GigaChat-Max":
-        return f"Error: Модель {model} не поддерживает распознавание изображений. Выберите GigaChat-Max для работы с картинками."
-
-    # Layout calculation (reused from previous logic)
-    available_height = 190 # mm
-    text_buffer = 15 # mm
-    try:
-        count = int(task_count)
-    except:
-        count = 3
-    if count < 1: count = 1
-    if count > 6: count = 6
-    raw_grid_height = (available_height / count) - text_buffer
-    if raw_grid_height < 10: raw_grid_height = 10
-    grid_height_mm = int(raw_grid_height)
-
-    prompt_text = f"""Ты - профессиональный верстальщик LaTeX и математик.
+    attachment_ids = []
+    cached_hashes = []
+    failed_files = []
+    first_error = None
+    for page, (path, outcome) in enumerate(zip(image_paths, outcomes), start=1):
+        if isinstance(outcome, Exception):
+            first_error = first_error or outcome
+            failed_files.append({'page': page, 'file': os.path.basename(path), 'error': classify_error(outcome).error.message})
+            continue
+        file_id, sha256, from_cache = outcome
+        attachment_ids.append(file_id)
+        if from_cache:
+            cached_hashes.append(sha256)
+    return attachment_ids, cached_hashes, failed_files, first_error
+
+def _upload_images(giga, image_paths, use_cache):
+    """
+    Uploads the images concurrently (images already uploaded with this scope are
+    not sent again). Returns what _collect_uploads returns.
+    """
+    workers = max(1, min(GIGACHAT_UPLOAD_CONCURRENCY, len(image_paths)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_upload_one, giga, path, use_cache) for path in image_paths]
+
+    outcomes = []
+    for future in futures:
+        try:
+            outcomes.append(future.result())
+        except Exception as e:
+            outcomes.append(e)
+    return _collect_uploads(image_paths, outcomes)
+
+def _output_layout(task_count, answers_title="Ответы"):
+    """Lays out the JSON answer in GIGACHAT_JSON_TASKS mode; None when the model writes the LaTeX itself."""
+    return TaskLayout(task_count, answers_title) if GIGACHAT_JSON_TASKS else None
+
+def _latex_result(raw_content, layout=None):
+    if layout is not None:
+        try:
+            raw_content = layout.render(raw_content or "")
+        except ValueError as e:
+            return LLMResult.failure(LLMError.INVALID_OUTPUT, f"The model returned malformed tasks: {e}")
+    latex = clean_latex(raw_content or "")
+    if not latex:
+        return LLMResult.failure(LLMError.INVALID_OUTPUT, "The model returned an empty answer.")
+    return LLMResult(latex=latex)
+
+def build_image_prompt(task_count=3):
+    """Prompt for recognising the tasks on the uploaded images."""
+    if GIGACHAT_JSON_TASKS:
+        return IMAGE_JSON_PROMPT
+    count, grid_height_mm = layout_for(task_count)
+
+    return f"""Ты - профессиональный верстальщик LaTeX и математик.
 Твоя задача:
 1. Распознать ВСЕ математические задачи с изображения.
 2. Оформить их в LaTeX строго по шаблону.
@@ -113,53 +240,9 @@ def process_image_with_gigachat(image_paths, task_count=3, model="GigaChat-Max")
 Только валидный LaTeX код тела документа (Tasks + PageBreaks + Answers). Без преамбулы `\\documentclass`.
 """
 
-    try:
-        # Use selected GigaChat model
-        with GigaChat(credentials=GIGACHAT_CREDENTIALS, scope=GIGACHAT_SCOPE, model=model, verify_ssl_certs=False, timeout=120) as giga:
-            # 1. Upload the image files
-            # Note: GigaChat needs the file uploaded to process it in chat
-            attachment_ids = []
-            for path in image_paths:
-                with open(path, "rb") as f:
-                    uploaded_file = giga.upload_file(f)
-                    attachment_ids.append(uploaded_file.id_)
-            
-            # 2. Send the chat request with the attachment
-            response = giga.chat(Chat(
-                messages=[
-                    Messages(
-                        role=MessagesRole.USER,
-                        content=prompt_text,
-                        attachments=attachment_ids 
-                    )
-                ]
-            ))
-            
-            raw_content = response.choices[0].message.content
-            return clean_latex(raw_content)
-
-    except Exception as e:
-        return f"GigaChat Error: {str(e)}"
-
-def generate_similar_worksheet(original_text, task_count=3, model="GigaChat-Max", difficulty="same"):
-    """
-    Generates a new set of similar math tasks based on the original ones.
-    """
-    if not GIGACHAT_CREDENTIALS:
-        return "Error: GIGACHAT_CREDENTIALS not found"
-
-    # Reuse layout calc
-    available_height = 190
-    text_buffer = 15
-    try:
-        count = int(task_count)
-    except:
-        count = 3
-    if count < 1: count = 1
-    if count > 6: count = 6
-    raw_grid_height = (available_height / count) - text_buffer
-    if raw_grid_height < 10: raw_grid_height = 10
-    grid_height_mm = int(raw_grid_height)
+def build_similar_prompt(original_text, task_count=3, difficulty="same", variant=2):
+    """Prompt for a new variant (Variant 2 by default) of the given tasks."""
+    count, grid_height_mm = layout_for(task_count)
 
     diff_prompt = ""
     if difficulty == "easier":
@@ -168,9 +251,11 @@ def generate_similar_worksheet(original_text, task_count=3, model="GigaChat-Max"
         diff_prompt = "\n- УРОВЕНЬ: Сделай задачи СЛОЖНЕЕ (увеличь числа, добавь вычисления, усложни структуру уравнений/выражений)."
     else:
         diff_prompt = "\n- УРОВЕНЬ: СОХРАНИ текущую сложность."
+    if GIGACHAT_JSON_TASKS:
+        return build_similar_json_prompt(original_text, diff_prompt, variant)
 
     prompt_text = f"""Ты - профессиональный методист и верстальщик LaTeX.
-Твоя задача: создать ВАРИАНТ 2 контрольной работы с ДРУГИМИ ЧИСЛАМИ.
+Твоя задача: создать ВАРИАНТ {variant} контрольной работы с ДРУГИМИ ЧИСЛАМИ.
 
 ИСХОДНЫЙ ВАРИАНТ (Вариант 1):
 \"\"\"
@@ -202,7 +287,7 @@ def generate_similar_worksheet(original_text, task_count=3, model="GigaChat-Max"
 
 ОТВЕТЫ (в конце документа):
 \\newpage
-\\section*{{Ответы (Вариант 2)}}
+\\section*{{Ответы (Вариант {variant})}}
 \\begin{{tabular}}{{|c|c|}}
 \\hline
 № & Ответ \\\\
@@ -219,12 +304,528 @@ def generate_similar_worksheet(original_text, task_count=3, model="GigaChat-Max"
 ИТОГОВЫЙ ВЫВОД:
 Только LaTeX код (Задачи + WriteField + PageBreaks + Таблица ответов).
 """
+    return prompt_text
+
+# GIGACHAT_JSON_TASKS: the model returns only the tasks and the answers,
+# \TaskBox, \WriteField, page breaks and the answers table come from utils/layout.py
+JSON_TASKS_FORMAT = """ФОРМАТ ОТВЕТА (СТРОГО):
+Только JSON-массив, без пояснений и без Markdown:
+[
+  {"text": "Решите уравнение $x^2 - 5x + 6 = 0$.", "answer": "$2;\\\\ 3$"},
+  {"text": "Найдите значение выражения $\\\\frac{3}{4} + \\\\frac{1}{4}$.", "answer": "$1$"}
+]
+- "text" — условие задачи, формулы в LaTeX ($...$), БЕЗ номера задачи
+- "answer" — ТОЛЬКО итоговый ответ в LaTeX (например: $x=2$, $15$, $\\\\frac{1}{2}$), БЕЗ решений и пояснений
+- Обратную косую черту в JSON удваивай: \\\\frac, \\\\sqrt
+- НЕ пиши \\\\TaskBox, \\\\WriteField, \\\\newpage и таблицу ответов — оформление добавит сервер
+"""
+
+IMAGE_JSON_PROMPT = f"""Ты - профессиональный математик.
+Твоя задача: распознать ВСЕ математические задачи с изображения, по порядку, и решить каждую, чтобы дать КРАТКИЙ ответ.
+
+{JSON_TASKS_FORMAT}"""
+
+def build_similar_json_prompt(original_text, diff_prompt, variant=2):
+    """build_similar_prompt for GIGACHAT_JSON_TASKS."""
+    return f"""Ты - профессиональный методист.
+Твоя задача: создать ВАРИАНТ {variant} контрольной работы с ДРУГИМИ ЧИСЛАМИ.
+
+ИСХОДНЫЙ ВАРИАНТ (Вариант 1):
+\"\"\"
+{original_text}
+\"\"\"
+
+КРИТИЧЕСКИ ВАЖНЫЕ ПРАВИЛА ГЕНЕРАЦИИ:{diff_prompt}
+1. Для КАЖДОЙ задачи создай АНАЛОГИЧНУЮ, но с ДРУГИМИ числами
+2. СОХРАНИ: тип задачи, базовую структуру
+3. ИЗМЕНИ: все числовые значения (коэффициенты, константы, параметры)
+4. Используй "удобные" числа для ручных вычислений (целые, простые дроби)
+5. Количество задач должно ТОЧНО совпадать с исходным вариантом
+6. Ответы исходного варианта не переписывай — дай ответы к НОВЫМ задачам
+
+{JSON_TASKS_FORMAT}"""
+
+def _check_image_request(model):
+    """LLMResult with the error if images can't be processed with this model, otherwise None."""
+    if not GIGACHAT_CREDENTIALS:
+        return LLMResult.failure(LLMError.CONFIG, "GIGACHAT_CREDENTIALS not found in config.py")
+    # Only GigaChat-Max supports multimodal (image) input
+    if model != "GigaChat-Max":
+        return LLMResult.failure(LLMError.UNSUPPORTED, f"Модель {model} не поддерживает распознавание изображений. Выберите GigaChat-Max для работы с картинками.")
+    return None
+
+def _image_chat(prompt_text, attachment_ids):
+    return Chat(
+        messages=[
+            Messages(
+                role=MessagesRole.USER,
+                content=prompt_text,
+                attachments=attachment_ids
+            )
+        ]
+    )
+
+def _stale_file_ids(e, cached_hashes):
+    """
+    Whether a failed request may have been caused by cached file ids pointing to
+    files GigaChat has already deleted; then the images are uploaded again once.
+    """
+    status = e.args[1] if len(e.args) > 1 else None
+    return bool(cached_hashes) and status not in (401, 429) and (status or 500) < 500
+
+def _ask_with_images(giga, image_paths, use_cache, ask, metrics):
+    """
+    Uploads the images and returns (ask(attachment_ids), failed_files).
+    Pages that could not be uploaded are left out and reported in failed_files.
+    """
+    with metrics.uploading():
+        attachment_ids, cached_hashes, failed_files, upload_error = _upload_images(giga, image_paths, use_cache)
+    if not attachment_ids:
+        raise upload_error
+    try:
+        return ask(attachment_ids), failed_files
+    except ResponseError as e:
+        if not _stale_file_ids(e, cached_hashes):
+            raise
+        llm_cache.forget_file_ids(cached_hashes, GIGACHAT_SCOPE)
+        with metrics.uploading():
+            attachment_ids, _, failed_files, upload_error = _upload_images(giga, image_paths, use_cache=False)
+        if not attachment_ids:
+            raise upload_error
+        return ask(attachment_ids), failed_files
+
+def _stream_text(stream, first_chunk, metrics):
+    outcome = llm_metrics.CANCELLED
+    chars = 0
+    try:
+        chunks = itertools.chain([first_chunk] if first_chunk is not None else [], stream)
+        for chunk in chunks:
+            if chunk.choices and chunk.choices[0].delta.content:
+                chars += len(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+        outcome = llm_metrics.OK
+    except Exception as e:
+        error = classify_error(e).error
+        outcome = error.kind
+        raise LLMStreamError(error) from e
+    finally:
+        # Stops the completion when the client went away
+        stream.close()
+        metrics.finish(outcome, chars)
+
+def _laid_out(pieces, layout):
+    """The text pieces of a stream in GIGACHAT_JSON_TASKS mode, laid out task by task."""
+    try:
+        for piece in pieces:
+            latex = layout.feed(piece)
+            if latex:
+                yield latex
+        yield layout.finish()
+    except ValueError as e:
+        raise LLMStreamError(LLMError(LLMError.INVALID_OUTPUT, f"The model returned malformed tasks: {e}")) from e
+    finally:
+        pieces.close()
+
+def _start_stream(giga, payload, metrics):
+    """
+    Sends a streaming completion request and returns an iterator of text pieces.
+    Errors of the request itself are raised here; errors in the middle of the
+    answer are raised by the iterator as LLMStreamError.
+    """
+    stream = giga.stream(payload)
+    first_chunk = next(stream, None)
+    metrics.first_token()
+    return _stream_text(stream, first_chunk, metrics)
+
+def process_image_with_gigachat(image_paths, task_count=3, model="GigaChat-Max", use_cache=True):
+    """
+    Sends images to GigaChat to extract math tasks and format them in LaTeX.
+    
+    Args:
+        image_paths (str|list): Path or list of paths to the image files.
+        task_count (int): Number of tasks to format (guides the layout).
+        model (str): GigaChat model to use (only GigaChat-Max supports images).
+        use_cache (bool): Reuse file ids of images uploaded before.
+    
+    Returns:
+        LLMResult: LaTeX code representing the worksheet content, or a typed error.
+    """
+    if isinstance(image_paths, str):
+        image_paths = [image_paths]
+    error = _check_image_request(model)
+    if error:
+        return error
+    prompt_text = build_image_prompt(task_count)
 
+    # The same images sent again while the first request is running share its answer
+    try:
+        key = llm_limits.flight_key(model, prompt_text, task_count, use_cache, *[llm_cache.file_hash(path) for path in image_paths])
+    except OSError as e:
+        return classify_error(e)
+    return llm_limits.single_flight(key, lambda: _process_images(image_paths, prompt_text, task_count, model, use_cache))
+
+def _process_images(image_paths, prompt_text, task_count, model, use_cache):
+    metrics = _metrics(model, 'process', images=len(image_paths))
+    try:
+        giga = get_gigachat(model)
+        response, failed_files = _ask_with_images(
+            giga, image_paths, use_cache,
+            lambda attachment_ids: _complete(model, lambda: giga.chat(_image_chat(prompt_text, attachment_ids))),
+            metrics
+        )
+        result = _latex_result(response.choices[0].message.content, _output_layout(task_count))
+        result.failed_files = failed_files
+        return _finish_metrics(metrics, response, result)
+
+    except Exception as e:
+        return _finish_metrics(metrics, None, classify_error(e))
+
+def stream_image_with_gigachat(image_paths, task_count=3, model="GigaChat-Max", use_cache=True):
+    """
+    Same as process_image_with_gigachat, but returns as soon as the model starts
+    answering: LLMResult.stream yields the raw answer piece by piece.
+    """
+    if isinstance(image_paths, str):
+        image_paths = [image_paths]
+    error = _check_image_request(model)
+    if error:
+        return error
+    prompt_text = build_image_prompt(task_count)
+
+    metrics = _metrics(model, 'process_stream', images=len(image_paths))
+    try:
+        giga = get_gigachat(model)
+        stream, failed_files = _ask_with_images(
+            giga, image_paths, use_cache,
+            lambda attachment_ids: _complete(model, lambda: _start_stream(giga, _image_chat(prompt_text, attachment_ids), metrics)),
+            metrics
+        )
+        layout = _output_layout(task_count)
+        return LLMResult(stream=_laid_out(stream, layout) if layout else stream, failed_files=failed_files)
+    except Exception as e:
+        return _finish_metrics(metrics, None, classify_error(e))
+
+def generate_similar_worksheet(original_text, task_count=3, model="GigaChat-Max", difficulty="same", variant=2):
+    """
+    Generates a new set of similar math tasks based on the original ones.
+    variant is the number the model puts into the title of the answers.
+    Returns an LLMResult.
+    """
+    if not GIGACHAT_CREDENTIALS:
+        return LLMResult.failure(LLMError.CONFIG, "GIGACHAT_CREDENTIALS not found")
+    prompt_text = build_similar_prompt(original_text, task_count, difficulty, variant)
+    return llm_limits.single_flight(
+        llm_limits.flight_key(model, prompt_text, task_count),
+        lambda: _generate_similar(prompt_text, task_count, model, variant)
+    )
+
+def _generate_similar(prompt_text, task_count, model, variant=2):
+    metrics = _metrics(model, 'generate_similar')
     try:
         # Use selected GigaChat model
-        with GigaChat(credentials=GIGACHAT_CREDENTIALS, scope=GIGACHAT_SCOPE, model=model, verify_ssl_certs=False, timeout=120) as giga:
-            response = giga.chat(prompt_text)
-            raw_content = response.choices[0].message.content
-            return clean_latex(raw_content)
+        giga = get_gigachat(model)
+        response = _complete(model, lambda: giga.chat(prompt_text))
+        raw_content = response.choices[0].message.content
+        layout = _output_layout(task_count, f"Ответы (Вариант {variant})")
+        return _finish_metrics(metrics, response, _latex_result(raw_content, layout))
+    except Exception as e:
+        return _finish_metrics(metrics, None, classify_error(e))
+
+def stream_similar_worksheet(original_text, task_count=3, model="GigaChat-Max", difficulty="same"):
+    """Same as generate_similar_worksheet, with the answer streamed in LLMResult.stream."""
+    if not GIGACHAT_CREDENTIALS:
+        return LLMResult.failure(LLMError.CONFIG, "GIGACHAT_CREDENTIALS not found")
+    prompt_text = build_similar_prompt(original_text, task_count, difficulty)
+
+    metrics = _metrics(model, 'generate_similar_stream')
+    try:
+        giga = get_gigachat(model)
+        stream = _complete(model, lambda: _start_stream(giga, prompt_text, metrics))
+        layout = _output_layout(task_count, "Ответы (Вариант 2)")
+        return LLMResult(stream=_laid_out(stream, layout) if layout else stream)
+    except Exception as e:
+        return _finish_metrics(metrics, None, classify_error(e))
+
+
+# asyncio variants for async_app.py. They share the prompts and error handling
+# above; blocking work (file reads, the sqlite cache) runs in the default executor.
+
+_quotas = {}
+_quota_stats = {'in_flight': 0, 'waiting': 0, 'rejected': 0}
+
+async def aget_gigachat(model):
+    return await get_client_manager(GIGACHAT_CREDENTIALS).aget(model, GIGACHAT_SCOPE)
+
+async def _acquire_quota(model):
+    """Takes one of the GIGACHAT_MAX_CONCURRENT slots of the model. Returns False on timeout."""
+    semaphore = _quotas.setdefault(model, asyncio.Semaphore(GIGACHAT_MAX_CONCURRENT))
+    _quota_stats['waiting'] += 1
+    try:
+        await asyncio.wait_for(semaphore.acquire(), GIGACHAT_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        _quota_stats['rejected'] += 1
+        return False
+    finally:
+        _quota_stats['waiting'] -= 1
+    _quota_stats['in_flight'] += 1
+    return True
+
+def _release_quota(model):
+    _quota_stats['in_flight'] -= 1
+    _quotas[model].release()
+
+def _quota_exceeded():
+    return LLMResult.failure(LLMError.RATE_LIMIT, "Too many requests to GigaChat in flight, try again later.")
+
+def get_async_quota_stats():
+    return dict(_quota_stats, max_concurrent=GIGACHAT_MAX_CONCURRENT)
+
+def _read_upload(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+async def _acomplete(model, call):
+    """_complete for asyncio code: call() returns an awaitable."""
+    return await llm_limits.acall_with_retry(model, call, _retry_hint)
+
+async def _aupload_one(giga, path, use_cache):
+    """_upload_one for asyncio code."""
+    loop = asyncio.get_running_loop()
+    sha256 = await loop.run_in_executor(None, llm_cache.file_hash, path)
+    file_id = await loop.run_in_executor(None, llm_cache.get_file_id, sha256, GIGACHAT_SCOPE) if use_cache else None
+    if file_id:
+        return file_id, sha256, True
+    content = await loop.run_in_executor(None, _read_upload, path)
+    content_type = mimetypes.guess_type(path)[0] or 'image/jpeg'
+    for attempt in range(GIGACHAT_UPLOAD_RETRIES + 1):
+        try:
+            file_id = (await giga.aupload_file((os.path.basename(path), content, content_type))).id_
+            break
+        except Exception as e:
+            if attempt == GIGACHAT_UPLOAD_RETRIES or not _is_transient(e):
+                raise
+            await asyncio.sleep(UPLOAD_RETRY_DELAY * 2 ** attempt)
+    await loop.run_in_executor(None, llm_cache.put_file_id, sha256, GIGACHAT_SCOPE, file_id)
+    return file_id, sha256, False
+
+async def _aupload_images(giga, image_paths, use_cache):
+    semaphore = asyncio.Semaphore(GIGACHAT_UPLOAD_CONCURRENCY)
+
+    async def upload(path):
+        async with semaphore:
+            return await _aupload_one(giga, path, use_cache)
+
+    outcomes = await asyncio.gather(*(upload(path) for path in image_paths), return_exceptions=True)
+    return _collect_uploads(image_paths, outcomes)
+
+async def _aask_with_images(giga, image_paths, use_cache, ask, metrics):
+    """_ask_with_images for asyncio code; ask(attachment_ids) is awaited."""
+    with metrics.uploading():
+        attachment_ids, cached_hashes, failed_files, upload_error = await _aupload_images(giga, image_paths, use_cache)
+    if not attachment_ids:
+        raise upload_error
+    try:
+        return await ask(attachment_ids), failed_files
+    except ResponseError as e:
+        if not _stale_file_ids(e, cached_hashes):
+            raise
+        await asyncio.get_running_loop().run_in_executor(None, llm_cache.forget_file_ids, cached_hashes, GIGACHAT_SCOPE)
+        with metrics.uploading():
+            attachment_ids, _, failed_files, upload_error = await _aupload_images(giga, image_paths, use_cache=False)
+        if not attachment_ids:
+            raise upload_error
+        return await ask(attachment_ids), failed_files
+
+class _AsyncTextStream:
+    """
+    Async iterator of the answer text. aclose() ends the completion and frees
+    the quota slot, also when iteration never started.
+    """
+
+    def __init__(self, stream, first_chunk, release, metrics):
+        self._stream = stream
+        self._pending = first_chunk
+        self._release = release
+        self._metrics = metrics
+        self._outcome = llm_metrics.CANCELLED
+        self._chars = 0
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            if self._pending is not None:
+                chunk, self._pending = self._pending, None
+            else:
+                try:
+                    chunk = await self._stream.__anext__()
+                except StopAsyncIteration:
+                    self._outcome = llm_metrics.OK
+                    await self.aclose()
+                    raise
+                except Exception as e:
+                    error = classify_error(e).error
+                    self._outcome = error.kind
+                    await self.aclose()
+                    raise LLMStreamError(error) from e
+            if chunk.choices and chunk.choices[0].delta.content:
+                self._chars += len(chunk.choices[0].delta.content)
+                return chunk.choices[0].delta.content
+
+    async def aclose(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            await self._stream.aclose()
+        finally:
+            self._release()
+            self._metrics.finish(self._outcome, self._chars)
+
+class _AsyncLaidOut:
+    """_laid_out for an _AsyncTextStream; aclose() closes the stream underneath."""
+
+    def __init__(self, pieces, layout):
+        self._pieces = pieces
+        self._layout = layout
+        self._finished = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            while not self._finished:
+                try:
+                    piece = await self._pieces.__anext__()
+                except StopAsyncIteration:
+                    self._finished = True
+                    return self._layout.finish()
+                latex = self._layout.feed(piece)
+                if latex:
+                    return latex
+        except ValueError as e:
+            await self.aclose()
+            raise LLMStreamError(LLMError(LLMError.INVALID_OUTPUT, f"The model returned malformed tasks: {e}")) from e
+        raise StopAsyncIteration
+
+    async def aclose(self):
+        await self._pieces.aclose()
+
+async def _astart_stream(giga, payload, release, metrics):
+    """_start_stream for asyncio code; release() is called when the stream ends."""
+    stream = giga.astream(payload)
+    try:
+        first_chunk = await stream.__anext__()
+    except StopAsyncIteration:
+        first_chunk = None
+    except BaseException:
+        await stream.aclose()
+        raise
+    metrics.first_token()
+    return _AsyncTextStream(stream, first_chunk, release, metrics)
+
+async def aprocess_image_with_gigachat(image_paths, task_count=3, model="GigaChat-Max", use_cache=True):
+    """process_image_with_gigachat for asyncio code."""
+    error = _check_image_request(model)
+    if error:
+        return error
+    prompt_text = build_image_prompt(task_count)
+    loop = asyncio.get_running_loop()
+    try:
+        hashes = [await loop.run_in_executor(None, llm_cache.file_hash, path) for path in image_paths]
+    except OSError as e:
+        return classify_error(e)
+    key = llm_limits.flight_key(model, prompt_text, task_count, use_cache, *hashes)
+    return await llm_limits.asingle_flight(key, lambda: _aprocess_images(image_paths, prompt_text, task_count, model, use_cache))
+
+async def _aprocess_images(image_paths, prompt_text, task_count, model, use_cache):
+    if not await _acquire_quota(model):
+        return _quota_exceeded()
+
+    metrics = _metrics(model, 'process', images=len(image_paths))
+    try:
+        giga = await aget_gigachat(model)
+        response, failed_files = await _aask_with_images(
+            giga, image_paths, use_cache,
+            lambda attachment_ids: _acomplete(model, lambda: giga.achat(_image_chat(prompt_text, attachment_ids))),
+            metrics
+        )
+        result = _latex_result(response.choices[0].message.content, _output_layout(task_count))
+        result.failed_files = failed_files
+        return _finish_metrics(metrics, response, result)
+    except Exception as e:
+        return _finish_metrics(metrics, None, classify_error(e))
+    finally:
+        _release_quota(model)
+
+async def astream_image_with_gigachat(image_paths, task_count=3, model="GigaChat-Max", use_cache=True):
+    """stream_image_with_gigachat for asyncio code: LLMResult.stream is an async iterator."""
+    error = _check_image_request(model)
+    if error:
+        return error
+    prompt_text = build_image_prompt(task_count)
+    if not await _acquire_quota(model):
+        return _quota_exceeded()
+
+    metrics = _metrics(model, 'process_stream', images=len(image_paths))
+    try:
+        giga = await aget_gigachat(model)
+        stream, failed_files = await _aask_with_images(
+            giga, image_paths, use_cache,
+            lambda attachment_ids: _acomplete(
+                model, lambda: _astart_stream(giga, _image_chat(prompt_text, attachment_ids), lambda: _release_quota(model), metrics)
+            ),
+            metrics
+        )
+        layout = _output_layout(task_count)
+        return LLMResult(stream=_AsyncLaidOut(stream, layout) if layout else stream, failed_files=failed_files)
+    except Exception as e:
+        # The stream was not started, so nobody else releases the slot
+        _release_quota(model)
+        return _finish_metrics(metrics, None, classify_error(e))
+
+async def agenerate_similar_worksheet(original_text, task_count=3, model="GigaChat-Max", difficulty="same"):
+    """generate_similar_worksheet for asyncio code."""
+    if not GIGACHAT_CREDENTIALS:
+        return LLMResult.failure(LLMError.CONFIG, "GIGACHAT_CREDENTIALS not found")
+    prompt_text = build_similar_prompt(original_text, task_count, difficulty)
+    return await llm_limits.asingle_flight(
+        llm_limits.flight_key(model, prompt_text, task_count),
+        lambda: _agenerate_similar(prompt_text, task_count, model)
+    )
+
+async def _agenerate_similar(prompt_text, task_count, model):
+    if not await _acquire_quota(model):
+        return _quota_exceeded()
+
+    metrics = _metrics(model, 'generate_similar')
+    try:
+        giga = await aget_gigachat(model)
+        response = await _acomplete(model, lambda: giga.achat(prompt_text))
+        layout = _output_layout(task_count, "Ответы (Вариант 2)")
+        return _finish_metrics(metrics, response, _latex_result(response.choices[0].message.content, layout))
+    except Exception as e:
+        return _finish_metrics(metrics, None, classify_error(e))
+    finally:
+        _release_quota(model)
+
+async def astream_similar_worksheet(original_text, task_count=3, model="GigaChat-Max", difficulty="same"):
+    """stream_similar_worksheet for asyncio code: LLMResult.stream is an async iterator."""
+    if not GIGACHAT_CREDENTIALS:
+        return LLMResult.failure(LLMError.CONFIG, "GIGACHAT_CREDENTIALS not found")
+    prompt_text = build_similar_prompt(original_text, task_count, difficulty)
+    if not await _acquire_quota(model):
+        return _quota_exceeded()
+
+    metrics = _metrics(model, 'generate_similar_stream')
+    try:
+        giga = await aget_gigachat(model)
+        stream = await _acomplete(model, lambda: _astart_stream(giga, prompt_text, lambda: _release_quota(model), metrics))
+        layout = _output_layout(task_count, "Ответы (Вариант 2)")
+        return LLMResult(stream=_AsyncLaidOut(stream, layout) if layout else stream)
     except Exception as e:
-        return f"GigaChat Error: {str(e)}"
+        _release_quota(model)
+        return _finish_metrics(metrics, None, classify_error(e))
@@ -0,0 +1,167 @@
+import os
+import time
+import atexit
+import asyncio
+import threading
+
+from gigachat import GigaChat
+
+# Process-wide GigaChat clients, one per (model, scope).
+# A client keeps its OAuth token and its keep-alive HTTP connections between
+# requests, so a request no longer pays for a token exchange and a TLS handshake.
+# The SDK only refreshes a token after a 401, so tokens are refreshed here
+# shortly before they expire, once per client even under concurrent use.
+GIGACHAT_BASE_URL = os.environ.get('GIGACHAT_BASE_URL')  # e.g. a local stand-in server
+GIGACHAT_AUTH_URL = os.environ.get('GIGACHAT_AUTH_URL')
+GIGACHAT_TIMEOUT = float(os.environ.get('GIGACHAT_TIMEOUT', 120))
+# Refresh the token when it expires in less than this many seconds
+TOKEN_REFRESH_MARGIN = float(os.environ.get('GIGACHAT_TOKEN_REFRESH_MARGIN', 120))
+
+
+def _expires_at(token):
+    """Expiry of an AccessToken in seconds since the epoch (the API reports milliseconds)."""
+    expires_at = token.expires_at or 0
+    return expires_at / 1000 if expires_at > 10 ** 11 else expires_at
+
+
+class GigaChatClientManager:
+    def __init__(self, credentials, base_url=GIGACHAT_BASE_URL, auth_url=GIGACHAT_AUTH_URL, timeout=GIGACHAT_TIMEOUT,
+                 refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.credentials = credentials
+        self.base_url = base_url
+        self.auth_url = auth_url
+        self.timeout = timeout
+        self.refresh_margin = refresh_margin
+        self._clients = {}
+        self._token_locks = {}
+        self._async_token_locks = {}
+        self._issued_at = {}
+        self._lock = threading.Lock()
+        self._stats = {'clients_created': 0, 'token_refreshes': 0, 'token_refresh_errors': 0}
+
+    def _create(self, model, scope):
+        kwargs = dict(credentials=self.credentials, scope=scope, model=model, verify_ssl_certs=False, timeout=self.timeout)
+        if self.base_url:
+            kwargs['base_url'] = self.base_url
+        if self.auth_url:
+            kwargs['auth_url'] = self.auth_url
+        return GigaChat(**kwargs)
+
+    def _token_fresh(self, key, client):
+        token = client._access_token
+        if token is None:
+            return False
+        expires_at = _expires_at(token)
+        # Short-lived tokens are refreshed after three quarters of their lifetime
+        lifetime = expires_at - self._issued_at.get(key, 0)
+        return expires_at - time.time() > min(self.refresh_margin, lifetime / 4)
+
+    def _ensure_token(self, key, client):
+        if not client._use_auth or self._token_fresh(key, client):
+            return
+        with self._token_locks[key]:
+            # Another thread may have refreshed it while we waited
+            if self._token_fresh(key, client):
+                return
+            try:
+                issued_at = time.time()
+                client._update_token()
+                self._issued_at[key] = issued_at
+                self._count('token_refreshes')
+            except Exception:
+                self._count('token_refresh_errors')
+                raise
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _client(self, key):
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = self._create(*key)
+                    self._token_locks[key] = threading.Lock()
+                    self._clients[key] = client
+                    self._stats['clients_created'] += 1
+        return client
+
+    def get(self, model, scope):
+        """Returns the shared client for (model, scope) with a token that is valid for a while."""
+        key = (model, scope)
+        client = self._client(key)
+        self._ensure_token(key, client)
+        return client
+
+    async def aget(self, model, scope):
+        """get() for asyncio code (async_app.py): the token is refreshed without blocking the loop."""
+        key = (model, scope)
+        client = self._client(key)
+        if not client._use_auth or self._token_fresh(key, client):
+            return client
+        lock = self._async_token_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            if self._token_fresh(key, client):
+                return client
+            try:
+                issued_at = time.time()
+                await client._aupdate_token()
+                self._issued_at[key] = issued_at
+                self._count('token_refreshes')
+            except Exception:
+                self._count('token_refresh_errors')
+                raise
+        return client
+
+    def close(self):
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            try:
+                client.close()
+            except Exception:
+                pass
+
+    async def aclose(self):
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            try:
+                await client.aclose()
+                client.close()
+            except Exception:
+                pass
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, clients=len(self._clients))
+            tokens = {
+                f"{model}/{scope}": round(_expires_at(client._access_token) - time.time())
+                for (model, scope), client in self._clients.items() if client._access_token is not None
+            }
+        stats['token_expires_in'] = tokens
+        return stats
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_client_manager(credentials):
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = GigaChatClientManager(credentials)
+            atexit.register(_manager.close)
+        return _manager
+
+
+async def aclose_client_manager():
+    if _manager is not None:
+        await _manager.aclose()
+
+
+def get_gigachat_stats():
+    return _manager.stats() if _manager is not None else None
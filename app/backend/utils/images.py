@@ -0,0 +1,177 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from PIL import Image, ImageOps, ImageChops
+except ImportError:  # Pillow is optional: without it photos are sent as they are
+    Image = None
+
+# Preprocessing of uploaded photos before they go to the model.
+# Phone photos are often several MB; the model needs far less to read a page.
+# Each image is rotated according to its EXIF orientation, cropped to its
+# content, scaled down to IMAGE_MAX_EDGE and re-encoded as JPEG. The work runs
+# in a process pool, so request threads only wait for the result.
+IMAGE_PREPROCESS = os.environ.get('IMAGE_PREPROCESS', 'true').lower() == 'true'
+IMAGE_MAX_EDGE = int(os.environ.get('IMAGE_MAX_EDGE', 2048))  # px, long edge
+IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', 85))
+IMAGE_GRAYSCALE = os.environ.get('IMAGE_GRAYSCALE', 'false').lower() == 'true'
+IMAGE_AUTOCROP = os.environ.get('IMAGE_AUTOCROP', 'true').lower() == 'true'
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+IMAGE_TIMEOUT = 30  # seconds per image
+
+# Pixels that differ from the border colour by more than this count as content
+AUTOCROP_TOLERANCE = 40
+# Never crop away more than this share of the picture (a "border" that large is content)
+AUTOCROP_MIN_AREA = 0.3
+AUTOCROP_MARGIN = 0.02  # share of the long edge kept around the content
+
+_pool = None
+_pool_lock = threading.Lock()
+_stats = {'processed': 0, 'kept_original': 0, 'failed': 0, 'reused': 0, 'bytes_in': 0, 'bytes_out': 0}
+_lock = threading.Lock()
+
+
+def _settings_tag():
+    """Short tag of the settings, part of the output name, so changed settings produce new files."""
+    return f"e{IMAGE_MAX_EDGE}q{IMAGE_JPEG_QUALITY}{'g' if IMAGE_GRAYSCALE else ''}{'c' if IMAGE_AUTOCROP else ''}"
+
+
+def _autocrop(img):
+    # The top left pixel is taken as the border colour
+    background = Image.new(img.mode, img.size, img.getpixel((0, 0)))
+    diff = ImageChops.difference(img, background).convert('L')
+    bbox = diff.point(lambda p: 255 if p > AUTOCROP_TOLERANCE else 0).getbbox()
+    if not bbox:
+        return img
+    width, height = img.size
+    if (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) < AUTOCROP_MIN_AREA * width * height:
+        return img
+    margin = int(max(width, height) * AUTOCROP_MARGIN)
+    return img.crop((
+        max(0, bbox[0] - margin), max(0, bbox[1] - margin),
+        min(width, bbox[2] + margin), min(height, bbox[3] + margin)
+    ))
+
+
+def preprocess_file(src_path, dst_path, max_edge, quality, grayscale, autocrop):
+    """
+    Runs in a pool process. Writes the processed JPEG to dst_path, or an empty
+    dst_path if it would not be smaller than the original, so that the same
+    upload is not processed again. Returns (bytes before, bytes after).
+    """
+    size_in = os.path.getsize(src_path)
+    with Image.open(src_path) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ('RGBA', 'LA', 'P'):
+            # JPEG has no transparency: flatten onto white paper
+            img = img.convert('RGBA')
+            page = Image.new('RGB', img.size, 'white')
+            page.paste(img, mask=img.getchannel('A'))
+            img = page
+        img = img.convert('L' if grayscale else 'RGB')
+        if autocrop:
+            img = _autocrop(img)
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        tmp_path = f"{dst_path}.{os.getpid()}.part"
+        img.save(tmp_path, 'JPEG', quality=quality, optimize=True)
+    size_out = os.path.getsize(tmp_path)
+    if size_out >= size_in:
+        # Zero-length marker: keep the original
+        open(tmp_path, 'wb').close()
+        size_out = size_in
+    os.replace(tmp_path, dst_path)
+    return size_in, size_out
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _submit(*args):
+    try:
+        return _get_pool().submit(preprocess_file, *args)
+    except BrokenProcessPool:
+        # A pool process died (e.g. killed for memory): start a new pool once
+        _reset_pool()
+        return _get_pool().submit(preprocess_file, *args)
+
+
+def _count(**values):
+    with _lock:
+        for key, value in values.items():
+            _stats[key] += value
+
+
+def preprocess_images(paths):
+    """
+    Returns the paths to send to the model, in the same order: the processed
+    JPEG where preprocessing made the image smaller, otherwise the original.
+    Processed files (and empty markers for images kept as they are) sit next
+    to the uploads and are reused for the same upload.
+    """
+    if not IMAGE_PREPROCESS or Image is None or not paths:
+        return list(paths)
+
+    tag = _settings_tag()
+    results = list(paths)
+    pending = []
+    for i, path in enumerate(paths):
+        dst_path = f"{os.path.splitext(path)[0]}.{tag}.jpg"
+        try:
+            processed_size = os.path.getsize(dst_path)
+        except OSError:
+            processed_size = None
+        if processed_size is not None:
+            _count(reused=1)
+            if processed_size:
+                results[i] = dst_path
+            continue
+        future = _submit(path, dst_path, IMAGE_MAX_EDGE, IMAGE_JPEG_QUALITY, IMAGE_GRAYSCALE, IMAGE_AUTOCROP)
+        pending.append((i, path, dst_path, future))
+
+    for i, path, dst_path, future in pending:
+        try:
+            size_in, size_out = future.result(timeout=IMAGE_TIMEOUT)
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                _reset_pool()
+            # An unreadable or exotic image goes to the model as it is
+            print(f"Image preprocessing failed for {os.path.basename(path)}: {e!r}")
+            _count(failed=1)
+            continue
+        _count(bytes_in=size_in, bytes_out=size_out)
+        if size_out < size_in:
+            _count(processed=1)
+            results[i] = dst_path
+            print(f"Preprocessed {os.path.basename(path)}: {size_in // 1024} KiB -> {size_out // 1024} KiB")
+        else:
+            _count(kept_original=1)
+    return results
+
+
+def get_image_stats():
+    with _lock:
+        stats = dict(_stats)
+    stats.update(
+        enabled=IMAGE_PREPROCESS and Image is not None,
+        pillow=Image is not None,
+        bytes_saved=stats['bytes_in'] - stats['bytes_out'],
+        max_edge=IMAGE_MAX_EDGE,
+        grayscale=IMAGE_GRAYSCALE
+    )
+    return stats
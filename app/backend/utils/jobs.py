@@ -0,0 +1,271 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+
+# Persistent job queue for /api/process and /api/compile.
+# The web process only inserts jobs; worker processes (worker.py) claim them.
+# Scheduling: priority first (web > bot > bulk), then fair share between
+# teachers (fewest running jobs, least recently served), then arrival order.
+JOBS_DB_PATH = os.environ.get(
+    'JOBS_DB_PATH', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'jobs.db')
+)
+# A running job whose worker has not renewed its lease for this long is requeued
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 300))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 2))
+# Finished jobs are deleted after this many hours
+JOB_RETENTION_HOURS = float(os.environ.get('JOB_RETENTION_HOURS', 24))
+
+KINDS = ('process', 'compile', 'generate_similar', 'class_set')
+PRIORITIES = {'web': 0, 'bot': 1, 'bulk': 2}
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_NEXT_JOB_SQL = '''
+    SELECT j.id FROM jobs j
+    WHERE j.status = 'queued'
+    ORDER BY
+        j.priority,
+        (SELECT COUNT(*) FROM jobs r WHERE r.status = 'running' AND r.teacher = j.teacher),
+        COALESCE((SELECT MAX(s.started_at) FROM jobs s WHERE s.teacher = j.teacher), 0),
+        j.created_at
+    LIMIT 1
+'''
+
+
+def _connect():
+    conn = sqlite3.connect(JOBS_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_jobs_db():
+    conn = _connect()
+    try:
+        # WAL lets the web process read job status while workers write
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                teacher TEXT NOT NULL,
+                source TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                result TEXT,
+                http_status INTEGER,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                lease_until REAL,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, created_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_teacher ON jobs (teacher, status, started_at)')
+    finally:
+        conn.close()
+
+
+def submit_job(kind, payload, teacher='', source='web'):
+    """Queues a job and returns its id."""
+    if kind not in KINDS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    job_id = uuid.uuid4().hex
+    conn = _connect()
+    try:
+        conn.execute(
+            '''INSERT INTO jobs (id, kind, teacher, source, priority, status, payload, created_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+            (job_id, kind, teacher or 'anonymous', source, PRIORITIES.get(source, PRIORITIES['bulk']),
+             QUEUED, json.dumps(payload, ensure_ascii=False), time.time())
+        )
+    finally:
+        conn.close()
+    return job_id
+
+
+def claim_job(worker_name):
+    """
+    Atomically takes the next job for this worker.
+    Returns the job as a dict (payload decoded) or None if the queue is empty.
+    """
+    conn = _connect()
+    try:
+        # BEGIN IMMEDIATE takes the write lock, so two workers never claim the same job
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute(_NEXT_JOB_SQL).fetchone()
+        if row is None:
+            conn.execute('COMMIT')
+            return None
+        now = time.time()
+        conn.execute(
+            '''UPDATE jobs SET status = ?, worker = ?, started_at = ?, lease_until = ?, attempts = attempts + 1
+               WHERE id = ?''',
+            (RUNNING, worker_name, now, now + JOB_LEASE_SECONDS, row['id'])
+        )
+        job = conn.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone()
+        conn.execute('COMMIT')
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+    job = dict(job)
+    job['payload'] = json.loads(job['payload'])
+    return job
+
+
+def renew_lease(job_id, worker_name):
+    conn = _connect()
+    try:
+        conn.execute(
+            'UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = ?',
+            (time.time() + JOB_LEASE_SECONDS, job_id, worker_name, RUNNING)
+        )
+    finally:
+        conn.close()
+
+
+def release_job(job_id, worker_name):
+    """Puts a claimed job back at its place in the queue without counting the attempt."""
+    conn = _connect()
+    try:
+        conn.execute(
+            '''UPDATE jobs SET status = ?, worker = NULL, lease_until = NULL, started_at = NULL, attempts = attempts - 1
+               WHERE id = ? AND worker = ? AND status = ?''',
+            (QUEUED, job_id, worker_name, RUNNING)
+        )
+    finally:
+        conn.close()
+
+
+def finish_job(job_id, worker_name, result, http_status):
+    """Stores the response of a job; 4xx/5xx responses mark it as failed."""
+    conn = _connect()
+    try:
+        conn.execute(
+            '''UPDATE jobs SET status = ?, result = ?, http_status = ?, finished_at = ?, lease_until = NULL
+               WHERE id = ? AND worker = ? AND status = ?''',
+            (DONE if http_status < 400 else FAILED, json.dumps(result, ensure_ascii=False), http_status,
+             time.time(), job_id, worker_name, RUNNING)
+        )
+    finally:
+        conn.close()
+
+
+def requeue_expired():
+    """
+    Puts running jobs of crashed workers back into the queue, or fails them
+    after JOB_MAX_ATTEMPTS. Also deletes old finished jobs.
+    Returns the number of requeued jobs.
+    """
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute(
+            '''UPDATE jobs SET status = ?, finished_at = ?, http_status = 500, result = ?
+               WHERE status = ? AND lease_until < ? AND attempts >= ?''',
+            (FAILED, now, json.dumps({'error': 'Job worker stopped while running the job.'}),
+             RUNNING, now, JOB_MAX_ATTEMPTS)
+        )
+        requeued = conn.execute(
+            '''UPDATE jobs SET status = ?, worker = NULL, lease_until = NULL
+               WHERE status = ? AND lease_until < ?''',
+            (QUEUED, RUNNING, now)
+        ).rowcount
+        conn.execute(
+            'DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?',
+            (DONE, FAILED, now - JOB_RETENTION_HOURS * 3600)
+        )
+        conn.execute('COMMIT')
+        return requeued
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+
+def get_job(job_id):
+    """Returns the job as a dict (result decoded), or None."""
+    conn = _connect()
+    try:
+        row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        if job['status'] == QUEUED:
+            job['queue_position'] = conn.execute(
+                '''SELECT COUNT(*) FROM jobs WHERE status = ? AND (priority < ? OR (priority = ? AND created_at < ?))''',
+                (QUEUED, job['priority'], job['priority'], job['created_at'])
+            ).fetchone()[0]
+    finally:
+        conn.close()
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return job
+
+
+def wait_for_job(job_id, timeout, poll_interval=0.25):
+    """Long poll: returns the job once it is finished or the timeout has passed."""
+    deadline = time.monotonic() + timeout
+    while True:
+        job = get_job(job_id)
+        if job is None or job['status'] in (DONE, FAILED) or time.monotonic() >= deadline:
+            return job
+        time.sleep(poll_interval)
+
+
+async def await_job(job_id, timeout, poll_interval=0.25):
+    """wait_for_job for async_app.py: sleeps on the event loop between the lookups."""
+    deadline = time.monotonic() + timeout
+    while True:
+        job = await asyncio.to_thread(get_job, job_id)
+        if job is None or job['status'] in (DONE, FAILED) or time.monotonic() >= deadline:
+            return job
+        await asyncio.sleep(poll_interval)
+
+
+def job_status(job):
+    """Public view of a job for the API."""
+    status = {
+        'job_id': job['id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'source': job['source'],
+        'created_at': job['created_at'],
+        'started_at': job['started_at'],
+        'finished_at': job['finished_at'],
+        'attempts': job['attempts']
+    }
+    if 'queue_position' in job:
+        status['queue_position'] = job['queue_position']
+    return status
+
+
+def get_queue_stats():
+    conn = _connect()
+    try:
+        rows = conn.execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status').fetchall()
+        counts = {row['status']: row['n'] for row in rows}
+        oldest = conn.execute('SELECT MIN(created_at) FROM jobs WHERE status = ?', (QUEUED,)).fetchone()[0]
+    finally:
+        conn.close()
+    return {
+        'queued': counts.get(QUEUED, 0),
+        'running': counts.get(RUNNING, 0),
+        'done': counts.get(DONE, 0),
+        'failed': counts.get(FAILED, 0),
+        'oldest_queued_seconds': round(time.time() - oldest, 1) if oldest else 0
+    }
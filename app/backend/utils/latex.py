@@ -1,158 +1,275 @@
 import os
-import requests
 import subprocess
 import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), '../templates/default_worksheet.tex')
-OUTPUT_DIR = os.path.join(os.path.dirname(__file__), '../static/generated')
+from utils import tex_pool, pdf_cache, storage
+from utils.admission import tex_slot, CompileRejected
+from utils.templates import get_template
+from utils.cloud_latex import get_cloud_client
 
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+OUTPUT_DIR = storage.OUTPUT_DIR
+# Dumped pdflatex formats with the template preamble preloaded
+FORMAT_DIR = os.environ.get('LATEX_FORMAT_DIR', os.path.join(os.path.dirname(__file__), '../static/formats'))
+
+os.makedirs(FORMAT_DIR, exist_ok=True)
 
 # Check if we're in production (Render) or local development
 USE_CLOUD_LATEX = os.environ.get('USE_CLOUD_LATEX', 'false').lower() == 'true'
+# Set USE_PREAMBLE_FORMAT=false to always compile the full template preamble
+USE_PREAMBLE_FORMAT = os.environ.get('USE_PREAMBLE_FORMAT', 'true').lower() == 'true'
+
+# Threads used to compile the documents of one worksheet (tasks, keys) in parallel
+COMPILE_THREADS = int(os.environ.get('COMPILE_THREADS', 4))
+
+FORMAT_ERROR = "Preamble format file could not be loaded."
+
+# preamble hash -> format name (None if building the format failed)
+_formats = {}
+_building_formats = set()
+_format_lock = threading.Lock()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+_tex_version = None
+
+
+def _pdflatex_version():
+    """First line of `pdflatex --version`: a format only loads in the TeX that dumped it."""
+    global _tex_version
+    if _tex_version is None:
+        try:
+            output = subprocess.run(
+                ['pdflatex', '--version'], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL, timeout=10
+            ).stdout
+            _tex_version = output.decode('utf-8', 'replace').split('\n', 1)[0].strip()
+        except (OSError, subprocess.TimeoutExpired):
+            _tex_version = ''
+    return _tex_version
+
+
+def _format_name(preamble):
+    # The TeX version is part of the name, so an upgrade builds a new format instead of loading a stale one
+    digest = hashlib.sha1(f"{_pdflatex_version()}\0{preamble}".encode('utf-8')).hexdigest()[:12]
+    return f"worksheet_{digest}"
+
 
-def compile_latex_local(latex_source, filename_base):
-    """Compile LaTeX using local pdflatex (for development)."""
-    tex_filename = f"{filename_base}.tex"
-    tex_path = os.path.join(OUTPUT_DIR, tex_filename)
-    
-    with open(tex_path, 'w', encoding='utf-8') as f:
-        f.write(latex_source)
+def _format_usable(name):
+    """A format file is only trusted if it is there and not empty (e.g. left over from a crashed dump)."""
+    try:
+        return os.path.getsize(os.path.join(FORMAT_DIR, f"{name}.fmt")) > 0
+    except OSError:
+        return False
+
+
+def build_preamble_format(preamble):
+    """
+    Dumps a pdflatex format (.fmt) with the template preamble preloaded, so that
+    documents only have to typeset their body.
+    Returns the format name or None on failure.
+    """
+    name = _format_name(preamble)
+    if _format_usable(name):
+        return name
+
+    # Build under a temporary job name so concurrent workers never load a half-written format
+    tmp_name = f"{name}_{os.getpid()}_{threading.get_ident()}"
+    preamble_filename = f"{tmp_name}.tex"
+    with open(os.path.join(FORMAT_DIR, preamble_filename), 'w', encoding='utf-8') as f:
+        f.write(preamble)
+        f.write('\\dump\n')
 
     try:
-        result = subprocess.run(
-            ['pdflatex', '-interaction=nonstopmode', '-output-directory', OUTPUT_DIR, tex_path],
+        subprocess.run(
+            ['pdflatex', '-ini', '-interaction=nonstopmode', f'-jobname={tmp_name}',
+             f'&pdflatex {preamble_filename}'],
+            cwd=FORMAT_DIR,
             check=False,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            timeout=60  # 60 second timeout to prevent hanging
+            timeout=120
         )
-        
-        pdf_filename = f"{filename_base}.pdf"
-        pdf_path = os.path.join(OUTPUT_DIR, pdf_filename)
-        
-        if os.path.exists(pdf_path):
-            return pdf_filename, None
-             
-        if result.returncode != 0:
-            return None, f"LaTeX Compilation Error: {result.stderr.decode('utf-8', errors='ignore') if result.stderr else 'Unknown error'}"
-             
-    except subprocess.TimeoutExpired:
-        return None, "LaTeX compilation timeout (60s). Document may be too complex."
-    except FileNotFoundError:
-        return None, "pdflatex not found. Set USE_CLOUD_LATEX=true for cloud compilation."
+        tmp_fmt = os.path.join(FORMAT_DIR, f"{tmp_name}.fmt")
+        if not os.path.exists(tmp_fmt) or os.path.getsize(tmp_fmt) == 0:
+            print(f"Failed to build preamble format {name}, see {tmp_name}.log")
+            return None
+        os.replace(tmp_fmt, os.path.join(FORMAT_DIR, f"{name}.fmt"))
+        return name
+    except (subprocess.TimeoutExpired, FileNotFoundError) as e:
+        print(f"Failed to build preamble format {name}: {e}")
+        return None
+    finally:
+        # The .fmt of a failed dump is removed too, a replaced one is gone already
+        for leftover in (preamble_filename, f"{tmp_name}.fmt"):
+            path = os.path.join(FORMAT_DIR, leftover)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _build_format_in_background(preamble):
+    key = _format_name(preamble)
+    try:
+        _formats[key] = build_preamble_format(preamble)
+    finally:
+        with _format_lock:
+            _building_formats.discard(key)
+
+
+def get_preamble_format(template, wait=False):
+    """
+    Returns the name of an up-to-date preamble format for the Template, or None.
+    A missing format (first start or changed template) is built in a background
+    thread; until it is ready documents are compiled with the full preamble.
+    """
+    if USE_CLOUD_LATEX or not USE_PREAMBLE_FORMAT:
+        return None
+    preamble = template.preamble
+    if preamble is None:
+        return None
+
+    key = _format_name(preamble)
+    if key in _formats:
+        name = _formats[key]
+        if name and not _format_usable(name):
+            # Format was removed from disk or truncated: build it again
+            del _formats[key]
+        else:
+            return name
+
+    if wait:
+        _formats[key] = build_preamble_format(preamble)
+        return _formats[key]
+
+    with _format_lock:
+        if key in _building_formats:
+            return None
+        _building_formats.add(key)
+    threading.Thread(target=_build_format_in_background, args=(preamble,), daemon=True).start()
+    return None
+
+
+def _drop_preamble_format(name):
+    """
+    Deletes a format pdflatex could not load. It is remembered as unusable, so
+    this process compiles with the full preamble instead of rebuilding it.
+    """
+    for key, value in list(_formats.items()):
+        if value == name:
+            _formats[key] = None
+    path = os.path.join(FORMAT_DIR, f"{name}.fmt")
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def warm_up_latex():
+    """
+    Builds the preamble format for the default template and starts the warm
+    pdflatex pool with it at startup.
+    """
+    if USE_CLOUD_LATEX:
+        return None
+    template = get_template()
+    if template is None:
+        return None
+    fmt_name = get_preamble_format(template, wait=True)
+    tex_pool.get_tex_pool(warm_fmt=fmt_name, format_dir=FORMAT_DIR)
+    return fmt_name
+
+
+def compile_latex_local(latex_source, filename_base, fmt_name=None):
+    """
+    Compile LaTeX using local pdflatex (for development).
+    If fmt_name is given, latex_source is only the document body and the
+    preamble is loaded from the precompiled format.
+    Raises CompileRejected when the server is out of TeX capacity.
+    """
+    pdf_filename = f"{filename_base}.pdf"
+
+    try:
+        # Only the final PDF leaves the job's scratch directory
+        with storage.scratch_dir() as job_dir:
+            # Machine-wide limit on concurrent TeX runs, see utils/admission.py
+            with tex_slot():
+                # Warm pdflatex workers take process start-up and format loading off the request path
+                pdf_path, output, error = get_tex_pool().compile(
+                    latex_source, os.path.join(job_dir, pdf_filename), fmt_name=fmt_name
+                )
+
+            if pdf_path and os.path.exists(pdf_path):
+                return storage.publish(pdf_path, pdf_filename), None
+
+        if fmt_name and b'format file' in output:
+            return None, FORMAT_ERROR
+
+        return None, error
+    except CompileRejected:
+        raise
     except Exception as e:
         return None, f"Unexpected error: {str(e)}"
-         
-    return None, "PDF was not created."
+
+
+def get_tex_pool():
+    return tex_pool.get_tex_pool(format_dir=FORMAT_DIR)
 
 
 def compile_latex_cloud(latex_source, filename_base):
     """Compile LaTeX using cloud API (for production without TeX installed)."""
-    
-    # Save .tex file first
-    tex_filename = f"{filename_base}.tex"
-    tex_path = os.path.join(OUTPUT_DIR, tex_filename)
-    
-    with open(tex_path, 'w', encoding='utf-8') as f:
-        f.write(latex_source)
-    
+    pdf_filename = f"{filename_base}.pdf"
     try:
-        # Option 1: Use texlive.net (official TeX Live online compiler)
-        response = requests.post(
-            'https://texlive.net/cgi-bin/latexcgi',
-            data={
-                'filecontents[]': latex_source,
-                'filename[]': 'document.tex',
-                'engine': 'pdflatex',
-                'return': 'pdf'
-            },
-            timeout=120
-        )
-        
-        if response.status_code == 200 and (
-            response.headers.get('content-type', '').startswith('application/pdf') or
-            len(response.content) > 1000 and response.content[:4] == b'%PDF'
-        ):
-            pdf_filename = f"{filename_base}.pdf"
-            pdf_path = os.path.join(OUTPUT_DIR, pdf_filename)
-            
-            with open(pdf_path, 'wb') as f:
-                f.write(response.content)
-            
-            return pdf_filename, None
-        
-        # Option 2: Try latex.ytotech.com with correct format
-        response2 = requests.post(
-            'https://latex.ytotech.com/builds/sync',
-            json={
-                'compiler': 'pdflatex',
-                'resources': [
-                    {
-                        'main': True,
-                        'path': 'main.tex',
-                        'content': latex_source
-                    }
-                ]
-            },
-            headers={'Content-Type': 'application/json'},
-            timeout=120
-        )
-        
-        if response2.status_code == 200 and len(response2.content) > 100:
-            pdf_filename = f"{filename_base}.pdf"
-            pdf_path = os.path.join(OUTPUT_DIR, pdf_filename)
-            
-            with open(pdf_path, 'wb') as f:
-                f.write(response2.content)
-            
-            return pdf_filename, None
-        
-        # Option 3: Try latexonline.cc with GET method (URL-based)
-        import urllib.parse
-        import base64
-        
-        # For short documents, we can use URL encoding
-        encoded_source = base64.b64encode(latex_source.encode('utf-8')).decode('utf-8')
-        
-        # If all APIs fail, return meaningful error
-        error_details = f"API 1: {response.status_code}, API 2: {response2.status_code}"
-        return None, f"Cloud LaTeX compilation failed. {error_details}. Consider installing pdflatex on the server."
-                
-    except requests.Timeout:
-        return None, "Cloud LaTeX API timeout. Try again."
+        with storage.scratch_dir() as job_dir:
+            pdf_path = os.path.join(job_dir, pdf_filename)
+            # Pooled, hedged requests to texlive.net / latex.ytotech.com, see utils/cloud_latex.py
+            error = get_cloud_client().compile_to(latex_source, pdf_path)
+            if error:
+                return None, error
+            return storage.publish(pdf_path, pdf_filename), None
     except Exception as e:
         return None, f"Cloud compilation error: {str(e)}"
 
 
-def _compile_single_doc(content, topic, filename_base, teacher_name, layout="1col"):
-    # 1. Read Template
-    try:
-        with open(TEMPLATE_PATH, 'r', encoding='utf-8') as f:
-            template = f.read()
-    except FileNotFoundError:
-        return None, "Template file not found."
+def teacher_line(teacher_name):
+    """Value of PLACEHOLDER:TEACHER: generated only if teacher name is provided."""
+    if teacher_name and teacher_name.strip():
+        return f"\\par\\vspace{{1mm}}{{\\small\\color{{textgray!70}} Учитель: {teacher_name}}}"
+    return ""
 
+def _render_document(template, content, topic, teacher_name, layout="1col"):
+    """
+    Injects content into the template.
+    Returns (latex_source, body_source): the full document and the body to compile
+    against the preamble format (None if the template can't be split).
+    """
     # Wrap in multicols if requested
     if layout == "2col":
         # Ensure we don't break multicols with newpages if possible, but LaTeX multicols can handle it somewhat
         content = f"\\begin{{multicols}}{{2}}\n{content}\n\\end{{multicols}}"
 
-    # 2. Inject Content
-    latex_source = template.replace('PLACEHOLDER:CONTENT', content)
-    latex_source = latex_source.replace('PLACEHOLDER:TOPIC', topic)
-    
-    # Generate teacher line only if teacher name is provided
-    if teacher_name and teacher_name.strip():
-        teacher_line = f"\\par\\vspace{{1mm}}{{\\small\\color{{textgray!70}} Учитель: {teacher_name}}}"
-    else:
-        teacher_line = ""
-    latex_source = latex_source.replace('PLACEHOLDER:TEACHER', teacher_line)
+    values = {'CONTENT': content, 'TOPIC': topic, 'TEACHER': teacher_line(teacher_name)}
+    return template.render(**values), template.render_body(**values)
+
 
-    # 3. Compile using appropriate method
+def _compile_rendered(template, latex_source, body_source, filename_base):
     if USE_CLOUD_LATEX:
         return compile_latex_cloud(latex_source, filename_base)
     else:
+        # Compile only the body against the precompiled preamble if it is up to date
+        fmt_name = get_preamble_format(template) if body_source else None
+        if fmt_name:
+            result = compile_latex_local(body_source, filename_base, fmt_name=fmt_name)
+            if result[1] == FORMAT_ERROR:
+                # Stale or broken format: retry once with the full preamble
+                print(f"Preamble format {fmt_name} could not be loaded, dropping it")
+                _drop_preamble_format(fmt_name)
+            elif result[1] == tex_pool.PDFLATEX_NOT_FOUND:
+                return compile_latex_cloud(latex_source, filename_base)
+            else:
+                # Compiled, or an error in the document itself that the full preamble would repeat
+                return result
+
         # Try local first, fall back to cloud if pdflatex not found
         result = compile_latex_local(latex_source, filename_base)
         if result[1] and ("pdflatex" in result[1].lower() and "not found" in result[1].lower()):
@@ -160,12 +277,51 @@ def _compile_single_doc(content, topic, filename_base, teacher_name, layout="1co
             return compile_latex_cloud(latex_source, filename_base)
         return result
 
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=COMPILE_THREADS, thread_name_prefix='compile')
+        return _executor
+
+
+def _compile_documents(template, docs):
+    """
+    Compiles several rendered documents concurrently.
+    docs: list of (latex_source, body_source, filename_base).
+    Returns a list of (pdf_filename, error) in the same order.
+    """
+    if len(docs) == 1:
+        return [_compile_rendered(template, *docs[0])]
+
+    # The first document runs in the calling thread, the rest on the shared executor
+    futures = [_get_executor().submit(_compile_rendered, template, *doc) for doc in docs[1:]]
+    results = [_compile_rendered(template, *docs[0])]
+    for future in futures:
+        try:
+            results.append(future.result())
+        except CompileRejected:
+            raise
+        except Exception as e:
+            results.append((None, f"Unexpected error: {str(e)}"))
+    return results
+
+
+def _compile_single_doc(content, topic, filename_base, teacher_name, layout="1col", template_name=None):
+    template = get_template(template_name)
+    if template is None:
+        return None, "Template file not found."
+    latex_source, body_source = _render_document(template, content, topic, teacher_name, layout=layout)
+    return _compile_rendered(template, latex_source, body_source, filename_base)
+
 def extract_keys(content):
     """
     Разделяет сгенерированный LaTeX код на 'Задачи' и 'Ответы',
     ища строку \\section*{Ответы...
     """
-    parts = content.split(r'\section*{Ответы')
+    # Only at the first title: a class set has one answers table per student
+    parts = content.split(r'\section*{Ответы', 1)
     if len(parts) > 1:
         tasks = parts[0].strip()
         if tasks.endswith(r'\newpage'):
@@ -174,24 +330,53 @@ def extract_keys(content):
         return tasks, keys
     return content, ""
 
-def compile_latex(content, topic="Рабочий лист", filename_base="worksheet", teacher_name="", layout="1col"):
+def compile_latex(content, topic="Рабочий лист", filename_base="worksheet", teacher_name="", layout="1col", use_cache=True, template_name=None):
     """
     Разделяет контент на листы с задачами и ключами, 
     и компилирует два отдельных PDF файла.
-    Возвращает: (worksheet_pdf, keys_pdf, error)
+    Имена файлов строятся из хеша итогового LaTeX-кода, поэтому повторная
+    компиляция того же документа возвращает уже готовые PDF из кеша.
+    template_name выбирает шаблон из папки templates (по умолчанию default_worksheet).
+    Возвращает: (worksheet_pdf, keys_pdf, error, keys_error); keys_error —
+    ошибка компиляции ответов, лист с задачами при этом всё равно выдаётся.
+    При перегрузке сервера выбрасывает CompileRejected (ответ 429).
     """
+    template = get_template(template_name)
+    if template is None:
+        return None, None, "Template file not found.", None
+
     tasks_content, keys_content = extract_keys(content)
-    
-    # Compile main worksheet
-    main_pdf, error = _compile_single_doc(tasks_content, topic, filename_base, teacher_name, layout=layout)
+    tasks_source, tasks_body = _render_document(template, tasks_content, topic, teacher_name, layout=layout)
+    keys_topic = f"{topic} (Ответы)"
+    keys_source, keys_body = (None, None)
+    if keys_content:
+        keys_source, keys_body = _render_document(template, keys_content, keys_topic, teacher_name)
+
+    # The rendered sources include the template, so a template change invalidates the cache
+    cache_key = pdf_cache.make_key(tasks_source, keys_source or "")
+    filename_base = pdf_cache.cached_name(filename_base, cache_key)
+    keys_filename = f"{filename_base}_keys"
+
+    if use_cache:
+        cached = pdf_cache.lookup(filename_base, keys_filename if keys_content else None)
+        if cached:
+            return cached[0], cached[1], None, None
+
+    # Worksheet and answer keys are independent documents, compile them side by side
+    docs = [(tasks_source, tasks_body, filename_base)]
+    if keys_content:
+        docs.append((keys_source, keys_body, keys_filename))
+    results = _compile_documents(template, docs)
+
+    main_pdf, error = results[0]
     if error:
-        return None, None, error
+        return None, None, error, None
         
-    keys_pdf = None
+    keys_pdf, keys_error = None, None
     if keys_content:
-        # Компилируем ответы в отдельный PDF
-        keys_topic = f"{topic} (Ответы)"
-        keys_filename = f"{filename_base}_keys"
-        keys_pdf, _ = _compile_single_doc(keys_content, keys_topic, keys_filename, teacher_name)
-        
-    return main_pdf, keys_pdf, None
+        # Ответы компилируются в отдельный PDF; их ошибка не мешает выдать лист с задачами
+        keys_pdf, keys_error = results[1]
+        if keys_error:
+            print(f"Failed to compile answer keys {keys_filename}: {keys_error}")
+
+    return main_pdf, keys_pdf, None, keys_error
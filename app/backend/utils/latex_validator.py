@@ -0,0 +1,220 @@
+import re
+
+# Structural checks of a worksheet body that run in milliseconds, before any
+# TeX process is started. A document that fails here can never compile, so it
+# is rejected instead of occupying a pdflatex worker until the timeout.
+
+# What the LLM/OCR clients used to return in place of LaTeX when they failed
+PROVIDER_ERROR_PREFIXES = (
+    'GigaChat Error:',
+    'Error from YandexGPT',
+    'OCR Error:',
+    'OCR API Error:',
+    'OCR Exception:',
+    'Exception:',
+    'Error:',
+)
+
+# The body is injected into a template that already has a preamble and a document environment
+FORBIDDEN_COMMANDS = {
+    'documentclass': "the template already has a \\documentclass",
+    'usepackage': "packages are loaded by the template",
+    'RequirePackage': "packages are loaded by the template",
+    'input': "file access is not allowed",
+    'include': "file access is not allowed",
+    'openin': "file access is not allowed",
+    'openout': "file access is not allowed",
+    'write18': "shell escape is not allowed",
+    'immediate': "file access is not allowed",
+}
+FORBIDDEN_ENVIRONMENTS = {'document'}
+
+# Command -> number of mandatory {} arguments
+COMMAND_ARITY = {
+    'TaskBox': 2,
+    'WriteField': 1,
+}
+# A TeX dimension: 40mm, -1.5 cm, 0.5\textheight, \baselineskip, \dimexpr ... \relax
+_FACTOR = r'[+-]?\s*(?:\d+(?:[.,]\d*)?|[.,]\d+)'
+DIMENSION_RE = re.compile(
+    rf'^\s*(?:{_FACTOR}\s*(?:true\s*)?(?:pt|pc|in|bp|cm|mm|dd|cc|sp|em|ex)'
+    rf'|(?:{_FACTOR}\s*)?\\[A-Za-z@]+'
+    r'|\\dimexpr\b.*)\s*$',
+    re.S
+)
+
+_NAME_RE = re.compile(r'[A-Za-z@]+')
+_ENV_NAME_RE = re.compile(r'\s*\{([^{}]*)\}')
+
+
+class LatexValidationError:
+    def __init__(self, message, line, column):
+        self.message = message
+        self.line = line
+        self.column = column
+
+    def to_dict(self):
+        return {'message': self.message, 'line': self.line, 'column': self.column}
+
+    def __str__(self):
+        return f"line {self.line}, column {self.column}: {self.message}"
+
+
+class _Source:
+    """Maps string offsets to 1-based (line, column)."""
+
+    def __init__(self, text):
+        self.text = text
+        self._line_starts = [0] + [m.end() for m in re.finditer('\n', text)]
+
+    def error(self, message, offset):
+        lo, hi = 0, len(self._line_starts) - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self._line_starts[mid] <= offset:
+                lo = mid
+            else:
+                hi = mid - 1
+        return LatexValidationError(message, lo + 1, offset - self._line_starts[lo] + 1)
+
+
+def read_group(text, pos):
+    """
+    Skips blanks and reads one {...} group starting at pos.
+    Returns (offset after the closing brace, offset of the opening brace);
+    the first is None if there is no complete group.
+    """
+    while pos < len(text) and text[pos] in ' \t\n':
+        pos += 1
+    if pos >= len(text) or text[pos] != '{':
+        return None, pos
+    depth = 0
+    i = pos
+    while i < len(text):
+        c = text[i]
+        if c == '\\':
+            i += 2
+            continue
+        if c == '%':
+            newline = text.find('\n', i)
+            i = len(text) if newline == -1 else newline
+            continue
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                return i + 1, pos
+        i += 1
+    return None, pos
+
+
+def _check_provider_error(text, source):
+    stripped = text.lstrip()
+    for prefix in PROVIDER_ERROR_PREFIXES:
+        if stripped.startswith(prefix):
+            first_line = stripped.split('\n', 1)[0][:200]
+            return source.error(f"provider error instead of LaTeX: {first_line}", len(text) - len(stripped))
+    return None
+
+
+def _check_structure(text, source):
+    """Brace and environment balance, forbidden commands and macro arity in one pass."""
+    braces = []        # offsets of open '{'
+    environments = []  # (name, offset) of open \begin
+    math_open = None   # offset of an open inline $
+    display_open = None  # offset of an open $$
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c == '%':
+            newline = text.find('\n', i)
+            i = n if newline == -1 else newline
+            continue
+        if c == '{':
+            braces.append(i)
+        elif c == '}':
+            if not braces:
+                return source.error("unexpected '}' without a matching '{'", i)
+            braces.pop()
+        elif c == '$':
+            if text.startswith('$$', i) and math_open is None:
+                display_open = None if display_open is not None else i
+                i += 2
+                continue
+            math_open = None if math_open is not None else i
+        elif c == '\\':
+            match = _NAME_RE.match(text, i + 1)
+            if not match:
+                # Control symbol such as \{ \} \$ \% \\
+                i += 2
+                continue
+            name = match.group(0)
+            end = match.end()
+
+            if name in FORBIDDEN_COMMANDS:
+                return source.error(f"\\{name} is not allowed in the worksheet body: {FORBIDDEN_COMMANDS[name]}", i)
+
+            if name in ('begin', 'end'):
+                env = _ENV_NAME_RE.match(text, end)
+                if not env:
+                    return source.error(f"\\{name} without an environment name", i)
+                env_name = env.group(1).strip()
+                if env_name in FORBIDDEN_ENVIRONMENTS:
+                    return source.error(f"\\{name}{{{env_name}}} is not allowed, the template already has it", i)
+                if name == 'begin':
+                    environments.append((env_name, i))
+                else:
+                    if not environments:
+                        return source.error(f"\\end{{{env_name}}} without a matching \\begin", i)
+                    open_name, open_offset = environments.pop()
+                    if open_name != env_name:
+                        line = source.error('', open_offset).line
+                        return source.error(
+                            f"\\end{{{env_name}}} closes \\begin{{{open_name}}} from line {line}", i
+                        )
+                i = env.end()
+                continue
+
+            if name in COMMAND_ARITY:
+                pos = end
+                for arg in range(COMMAND_ARITY[name]):
+                    group_end, group_start = read_group(text, pos)
+                    if group_end is None:
+                        return source.error(
+                            f"\\{name} expects {COMMAND_ARITY[name]} argument(s) in braces, got {arg}",
+                            group_start if group_start < n else i
+                        )
+                    if name == 'WriteField' and not DIMENSION_RE.match(text[group_start + 1:group_end - 1]):
+                        return source.error(
+                            f"\\WriteField expects a height such as 40mm or 0.5\\textheight, got '{text[group_start + 1:group_end - 1]}'",
+                            group_start
+                        )
+                    pos = group_end
+            i = end
+            continue
+        i += 1
+
+    if math_open is not None:
+        return source.error("unclosed inline math '$'", math_open)
+    if display_open is not None:
+        return source.error("unclosed display math '$$'", display_open)
+    if environments:
+        env_name, offset = environments[-1]
+        return source.error(f"\\begin{{{env_name}}} is never closed", offset)
+    if braces:
+        return source.error("'{' is never closed", braces[-1])
+    return None
+
+
+def validate_latex(content):
+    """
+    Checks a worksheet body before it is compiled.
+    Returns None if it looks compilable, otherwise a LatexValidationError with
+    the line and column of the first problem.
+    """
+    if not content or not content.strip():
+        return LatexValidationError("the document is empty", 1, 1)
+    source = _Source(content)
+    return _check_provider_error(content, source) or _check_structure(content, source)
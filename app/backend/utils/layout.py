@@ -0,0 +1,150 @@
+import re
+import json
+
+# Layout of the worksheet body: tasks per page and the height of the answer
+# fields, shared by the prompts, the server-side layout of JSON answers
+# (GIGACHAT_JSON_TASKS) and the benchmark corpus.
+AVAILABLE_HEIGHT_MM = 190  # for the tasks of one page
+TEXT_BUFFER_MM = 15  # for the text of one task
+MIN_FIELD_MM = 10
+MAX_TASKS_PER_PAGE = 6
+
+_BACKSLASHES_RE = re.compile(r'\\+')
+_JSON_ESCAPES = set('"\\/bfnrtu')
+
+
+def grid_height_mm(count):
+    """Height of the \\WriteField after each task with count tasks on a page."""
+    return max(MIN_FIELD_MM, int(AVAILABLE_HEIGHT_MM / count - TEXT_BUFFER_MM))
+
+
+def layout_for(task_count):
+    """(tasks per page, height of the answer field in mm) for the requested task count."""
+    try:
+        count = int(task_count)
+    except (TypeError, ValueError):
+        count = 3
+    count = min(max(count, 1), MAX_TASKS_PER_PAGE)
+    return count, grid_height_mm(count)
+
+
+def _escape_latex(raw):
+    """
+    Doubles the backslashes of LaTeX commands the model left unescaped in its
+    JSON: "\\frac" would otherwise silently decode to a form feed and "rac".
+    A single backslash before two ASCII letters is taken for a command.
+    """
+    def fix(match):
+        slashes = match.group(0)
+        if len(slashes) % 2 == 0:
+            return slashes
+        rest = raw[match.end():match.end() + 2]
+        if rest[:1] not in _JSON_ESCAPES or (len(rest) == 2 and rest.isascii() and rest.isalpha()):
+            return slashes + '\\'
+        return slashes
+    return _BACKSLASHES_RE.sub(fix, raw)
+
+
+def parse_task(raw):
+    """(text, answer) of one {"text": ..., "answer": ...} object. Raises ValueError."""
+    try:
+        task = json.loads(_escape_latex(raw), strict=False)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"invalid JSON ({e.msg})") from e
+    if not isinstance(task, dict):
+        raise ValueError("a task is not an object")
+    text = str(task.get('text') or '').strip()
+    if not text:
+        raise ValueError("a task has no text")
+    answer = task.get('answer')
+    return text, str(answer).strip() if answer is not None else ''
+
+
+class TaskLayout:
+    """
+    Turns the model's JSON list of tasks, arriving in pieces, into the LaTeX
+    the model writes itself without GIGACHAT_JSON_TASKS: \\TaskBox and
+    \\WriteField per task, \\newpage after every full page, the answers table.
+    """
+
+    def __init__(self, task_count=3, answers_title="Ответы"):
+        self.per_page, self.field_mm = layout_for(task_count)
+        self.answers_title = answers_title
+        self.answers = []
+        self.text = ''
+        self._pos = 0  # everything before pos has been scanned
+        self._depth = 0
+        self._start = None  # of the object being received
+        self._in_string = False
+        self._escaped = False
+        self._passthrough = None  # the model wrote LaTeX instead of JSON
+
+    def _task_latex(self, text):
+        number = len(self.answers)
+        lines = [r"\newpage"] if number > 1 and (number - 1) % self.per_page == 0 else []
+        lines.append(f"\\TaskBox{{{number}}}{{{text}}}")
+        lines.append(f"\\WriteField{{{self.field_mm}mm}}")
+        return ("\n" if number > 1 else "") + "\n".join(lines)
+
+    def feed(self, piece):
+        """Adds a piece of the answer; returns the LaTeX of the tasks completed by it."""
+        self.text += piece
+        if self._passthrough is None:
+            start = min((i for i in (self.text.find(c) for c in '[{\\') if i != -1), default=None)
+            if start is None:
+                return ""
+            self._passthrough = self.text[start] == '\\'
+            if self._passthrough:
+                # The model ignored the format and wrote the LaTeX itself
+                return self.text
+        elif self._passthrough:
+            return piece
+        latex = []
+        for i in range(self._pos, len(self.text)):
+            char = self.text[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == '{':
+                if self._depth == 0:
+                    self._start = i
+                self._depth += 1
+            elif char == '}' and self._depth:
+                self._depth -= 1
+                if self._depth == 0:
+                    text, answer = parse_task(self.text[self._start:i + 1])
+                    self.answers.append(answer)
+                    latex.append(self._task_latex(text))
+        self._pos = len(self.text)
+        return "".join(latex)
+
+    def finish(self):
+        """LaTeX after the last task: the answers table. Raises ValueError if there were no tasks."""
+        if self._passthrough:
+            return ""
+        if not self.answers:
+            raise ValueError("no tasks in the answer")
+        if not any(self.answers):
+            return ""
+        lines = [
+            "",
+            r"\newpage",
+            f"\\section*{{{self.answers_title}}}",
+            r"\begin{tabular}{|c|c|}",
+            r"\hline",
+            r"№ & Ответ \\",
+            r"\hline",
+        ]
+        lines += [f"{number} & {answer} \\\\" for number, answer in enumerate(self.answers, start=1)]
+        lines += [r"\hline", r"\end{tabular}"]
+        return "\n".join(lines)
+
+    def render(self, raw):
+        """LaTeX of a complete answer."""
+        return self.feed(raw) + self.finish()
@@ -0,0 +1,211 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+
+# Persistent caches in front of GigaChat for image recognition.
+# Uploads are stored under the sha256 of their content (see app.save_uploads),
+# so the same textbook page submitted twice is recognised as such:
+# - gigachat_files: file id of an image already uploaded to GigaChat, per scope
+# - latex_results: LaTeX generated for (image hashes, task count, model, prompt version)
+# Entries expire after a TTL; LaTeX results are also evicted least recently
+# used first once they take more than LLM_CACHE_MAX_MB.
+LLM_CACHE_DB_PATH = os.environ.get(
+    'LLM_CACHE_DB_PATH', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'llm_cache.db')
+)
+LLM_CACHE_ENABLED = os.environ.get('LLM_CACHE_ENABLED', 'true').lower() == 'true'
+LLM_CACHE_TTL_HOURS = float(os.environ.get('LLM_CACHE_TTL_HOURS', 24 * 30))
+LLM_CACHE_MAX_MB = float(os.environ.get('LLM_CACHE_MAX_MB', 50))
+# GigaChat deletes stored files after a while; a stale id is dropped on the first error
+GIGACHAT_FILE_TTL_HOURS = float(os.environ.get('GIGACHAT_FILE_TTL_HOURS', 24))
+
+HASH_CHUNK = 1024 * 1024
+
+_stats = {'hits': 0, 'misses': 0, 'bypassed': 0, 'stored': 0, 'evicted': 0, 'file_id_hits': 0, 'file_id_misses': 0}
+_lock = threading.Lock()
+
+
+def _count(key, value=1):
+    with _lock:
+        _stats[key] += value
+
+
+def _connect():
+    conn = sqlite3.connect(LLM_CACHE_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_llm_cache_db():
+    conn = _connect()
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS gigachat_files (
+                sha256 TEXT NOT NULL,
+                scope TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                uploaded_at REAL NOT NULL,
+                PRIMARY KEY (sha256, scope)
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS latex_results (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                latex TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                used_at REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS latex_results_used ON latex_results (used_at)')
+    finally:
+        conn.close()
+
+
+def hash_stream(stream):
+    """sha256 hex digest of a binary file object, read in chunks."""
+    h = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(HASH_CHUNK), b''):
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def file_hash(path):
+    """sha256 of an upload; uploads saved by app.save_uploads carry it in their name."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if len(stem) == 64 and all(c in '0123456789abcdef' for c in stem):
+        return stem
+    with open(path, 'rb') as f:
+        return hash_stream(f)
+
+
+def result_key(image_hashes, task_count, model, prompt_version):
+    # Order matters: tasks are numbered in the order of the pages
+    parts = [prompt_version, model, str(task_count)] + list(image_hashes)
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def get_latex(key):
+    """Cached LaTeX for a result_key, or None."""
+    if not LLM_CACHE_ENABLED:
+        return None
+    conn = _connect()
+    try:
+        now = time.time()
+        row = conn.execute(
+            'SELECT latex FROM latex_results WHERE key = ? AND created_at > ?',
+            (key, now - LLM_CACHE_TTL_HOURS * 3600)
+        ).fetchone()
+        if row is None:
+            _count('misses')
+            return None
+        conn.execute('UPDATE latex_results SET used_at = ?, hits = hits + 1 WHERE key = ?', (now, key))
+        _count('hits')
+        return row['latex']
+    finally:
+        conn.close()
+
+
+def put_latex(key, latex, model, prompt_version):
+    if not LLM_CACHE_ENABLED:
+        return
+    now = time.time()
+    size = len(latex.encode('utf-8'))
+    conn = _connect()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('''
+            INSERT OR REPLACE INTO latex_results (key, model, prompt_version, latex, size, created_at, used_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (key, model, prompt_version, latex, size, now, now))
+        evicted = _evict(conn, now)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    _count('stored')
+    _count('evicted', evicted)
+
+
+def _evict(conn, now):
+    """Drops expired results, then the least recently used ones above the size limit."""
+    evicted = conn.execute(
+        'DELETE FROM latex_results WHERE created_at <= ?', (now - LLM_CACHE_TTL_HOURS * 3600,)
+    ).rowcount
+    max_bytes = LLM_CACHE_MAX_MB * 1024 * 1024
+    total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM latex_results').fetchone()[0]
+    if total <= max_bytes:
+        return evicted
+    excess = total - max_bytes
+    keys = []
+    for row in conn.execute('SELECT key, size FROM latex_results ORDER BY used_at'):
+        if excess <= 0:
+            break
+        keys.append(row['key'])
+        excess -= row['size']
+    conn.executemany('DELETE FROM latex_results WHERE key = ?', [(k,) for k in keys])
+    return evicted + len(keys)
+
+
+def get_file_id(sha256, scope):
+    if not LLM_CACHE_ENABLED:
+        return None
+    conn = _connect()
+    try:
+        row = conn.execute(
+            'SELECT file_id FROM gigachat_files WHERE sha256 = ? AND scope = ? AND uploaded_at > ?',
+            (sha256, scope, time.time() - GIGACHAT_FILE_TTL_HOURS * 3600)
+        ).fetchone()
+    finally:
+        conn.close()
+    _count('file_id_hits' if row else 'file_id_misses')
+    return row['file_id'] if row else None
+
+
+def put_file_id(sha256, scope, file_id):
+    if not LLM_CACHE_ENABLED:
+        return
+    conn = _connect()
+    try:
+        conn.execute(
+            'INSERT OR REPLACE INTO gigachat_files (sha256, scope, file_id, uploaded_at) VALUES (?, ?, ?, ?)',
+            (sha256, scope, file_id, time.time())
+        )
+    finally:
+        conn.close()
+
+
+def forget_file_ids(sha256s, scope):
+    conn = _connect()
+    try:
+        conn.executemany(
+            'DELETE FROM gigachat_files WHERE sha256 = ? AND scope = ?', [(sha, scope) for sha in sha256s]
+        )
+    finally:
+        conn.close()
+
+
+def count_bypass():
+    _count('bypassed')
+
+
+def get_llm_cache_stats():
+    with _lock:
+        stats = dict(_stats)
+    stats.update(enabled=LLM_CACHE_ENABLED, ttl_hours=LLM_CACHE_TTL_HOURS, max_mb=LLM_CACHE_MAX_MB)
+    if LLM_CACHE_ENABLED:
+        conn = _connect()
+        try:
+            row = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM latex_results').fetchone()
+            stats['entries'], stats['bytes'] = row[0], row[1]
+            stats['file_ids'] = conn.execute('SELECT COUNT(*) FROM gigachat_files').fetchone()[0]
+        finally:
+            conn.close()
+    return stats
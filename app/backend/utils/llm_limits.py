@@ -0,0 +1,264 @@
+import os
+import time
+import random
+import asyncio
+import hashlib
+import sqlite3
+import threading
+
+from utils.llm_cache import LLM_CACHE_DB_PATH
+
+# Client-side limits for LLM completions.
+# - Rate: a token bucket per model shared by all processes (gunicorn, workers,
+#   async_app) through sqlite, so together they stay within the upstream quota.
+#   A call waits for its slot; if the slot is further away than the deadline
+#   it fails at once with RateLimitExceeded instead of earning a 429.
+# - Retries: 429, 5xx and connection errors are retried with jittered
+#   exponential backoff (honouring Retry-After) until LLM_RETRY_DEADLINE.
+# - Single flight: identical calls in flight in one process share one
+#   upstream call (double clicks, the same photo sent twice).
+GIGACHAT_RPM = float(os.environ.get('GIGACHAT_RPM', 60))  # completions per minute per model
+# Per model overrides, e.g. "GigaChat-Max=20,GigaChat-Pro=40"
+GIGACHAT_MODEL_RPM = os.environ.get('GIGACHAT_MODEL_RPM', '')
+GIGACHAT_RATE_BURST = int(os.environ.get('GIGACHAT_RATE_BURST', 5))
+LLM_RETRY_DEADLINE = float(os.environ.get('LLM_RETRY_DEADLINE', 60))  # seconds per call for waiting and retries
+RETRY_BASE_DELAY = 1.0  # seconds, doubled after every attempt
+RETRY_MAX_DELAY = 20.0
+
+_stats = {'slots': 0, 'throttled': 0, 'wait_seconds': 0.0, 'rejected': 0, 'retries': 0, 'gave_up': 0, 'coalesced': 0}
+_lock = threading.Lock()
+
+
+class RateLimitExceeded(Exception):
+    """The next slot of the model is further away than the deadline of the call."""
+
+    def __init__(self, model, wait):
+        super().__init__(f"Rate limit of {model} reached, next slot in {wait:.0f}s")
+        self.model = model
+        self.wait = wait
+
+
+def _count(key, value=1):
+    with _lock:
+        _stats[key] += value
+
+
+def _parse_model_rpm(value):
+    limits = {}
+    for item in value.split(','):
+        if '=' in item:
+            model, rpm = item.split('=', 1)
+            limits[model.strip()] = float(rpm)
+    return limits
+
+
+_model_rpm = _parse_model_rpm(GIGACHAT_MODEL_RPM)
+
+
+def rpm_for(model):
+    return _model_rpm.get(model, GIGACHAT_RPM)
+
+
+def _connect():
+    return sqlite3.connect(LLM_CACHE_DB_PATH, timeout=30, isolation_level=None)
+
+
+def init_llm_limits_db():
+    conn = _connect()
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS rate_limits (
+                model TEXT PRIMARY KEY,
+                tat REAL NOT NULL
+            )
+        ''')
+    finally:
+        conn.close()
+
+
+def reserve(model, max_wait):
+    """
+    Takes the next slot of the model's bucket (GCRA: one theoretical arrival
+    time per model). Returns the seconds to wait before calling, or raises
+    RateLimitExceeded without taking a slot if that is more than max_wait.
+    """
+    rpm = rpm_for(model)
+    if rpm <= 0:
+        return 0.0
+    interval = 60.0 / rpm
+    tolerance = interval * (max(1, GIGACHAT_RATE_BURST) - 1)
+    conn = _connect()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('SELECT tat FROM rate_limits WHERE model = ?', (model,)).fetchone()
+        now = time.time()
+        tat = max(row[0] if row else now, now)
+        wait = max(0.0, tat - tolerance - now)
+        if wait > max_wait:
+            conn.execute('COMMIT')
+            raise RateLimitExceeded(model, wait)
+        conn.execute('INSERT OR REPLACE INTO rate_limits (model, tat) VALUES (?, ?)', (model, tat + interval))
+        conn.execute('COMMIT')
+        return wait
+    except sqlite3.Error as e:
+        # The limiter must not take the service down with it
+        print(f"Rate limiter unavailable, not limiting: {e}")
+        return 0.0
+    finally:
+        conn.close()
+
+
+def _slot_wait(model, deadline):
+    wait = reserve(model, max(0.0, deadline - time.monotonic()))
+    _count('slots')
+    if wait:
+        _count('throttled')
+        _count('wait_seconds', wait)
+    return wait
+
+
+def backoff_delay(attempt, retry_after=0.0):
+    """Full jitter: a random delay up to RETRY_BASE_DELAY * 2**attempt, at least Retry-After."""
+    return max(retry_after, random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
+
+
+def _next_delay(e, attempt, deadline, retry_hint):
+    """Seconds to sleep before the next attempt, or None to give up and raise e."""
+    hint = retry_hint(e)
+    if hint is None:
+        return None
+    delay = backoff_delay(attempt, hint)
+    if time.monotonic() + delay >= deadline:
+        _count('gave_up')
+        return None
+    _count('retries')
+    return delay
+
+
+def call_with_retry(model, call, retry_hint):
+    """
+    Calls call() within the rate limit of the model, retrying it while
+    retry_hint(exception) returns a minimum delay (None: not retryable).
+    """
+    deadline = time.monotonic() + LLM_RETRY_DEADLINE
+    attempt = 0
+    while True:
+        try:
+            wait = _slot_wait(model, deadline)
+        except RateLimitExceeded:
+            _count('rejected')
+            raise
+        if wait:
+            time.sleep(wait)
+        try:
+            return call()
+        except Exception as e:
+            delay = _next_delay(e, attempt, deadline, retry_hint)
+            if delay is None:
+                raise
+            print(f"{model} call failed ({e!r}), retrying in {delay:.1f}s")
+            attempt += 1
+            time.sleep(delay)
+
+
+async def acall_with_retry(model, call, retry_hint):
+    """call_with_retry for asyncio code: call() returns an awaitable."""
+    loop = asyncio.get_running_loop()
+    deadline = time.monotonic() + LLM_RETRY_DEADLINE
+    attempt = 0
+    while True:
+        try:
+            wait = await loop.run_in_executor(None, _slot_wait, model, deadline)
+        except RateLimitExceeded:
+            _count('rejected')
+            raise
+        if wait:
+            await asyncio.sleep(wait)
+        try:
+            return await call()
+        except Exception as e:
+            delay = _next_delay(e, attempt, deadline, retry_hint)
+            if delay is None:
+                raise
+            print(f"{model} call failed ({e!r}), retrying in {delay:.1f}s")
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+def flight_key(*parts):
+    return hashlib.sha256('\0'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+_aflights = {}
+
+
+def single_flight(key, func):
+    """
+    Runs func() unless a call with the same key is already running in this
+    process; then waits for that call and returns (or raises) its outcome.
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+    if not leader:
+        _count('coalesced')
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = func()
+        return flight.result
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+
+
+async def asingle_flight(key, func):
+    """single_flight for asyncio code: func() returns an awaitable; one flight table per event loop thread."""
+    future = _aflights.get(key)
+    if future is not None:
+        _count('coalesced')
+        # shield: a follower that is cancelled must not cancel the shared call
+        return await asyncio.shield(future)
+
+    future = _aflights[key] = asyncio.ensure_future(func())
+    try:
+        return await asyncio.shield(future)
+    finally:
+        if future.done():
+            _aflights.pop(key, None)
+        else:
+            # The leader was cancelled; the call finishes for the followers
+            future.add_done_callback(lambda _: _aflights.pop(key, None))
+
+
+def get_llm_limits_stats():
+    with _lock:
+        stats = dict(_stats)
+    stats.update(
+        wait_seconds=round(stats['wait_seconds'], 1),
+        rpm=GIGACHAT_RPM,
+        model_rpm=_model_rpm,
+        burst=GIGACHAT_RATE_BURST,
+        retry_deadline=LLM_RETRY_DEADLINE,
+        in_flight_keys=len(_flights) + len(_aflights)
+    )
+    return stats
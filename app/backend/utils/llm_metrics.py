@@ -0,0 +1,275 @@
+import os
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Metrics of the calls to the model providers (GigaChat, YandexGPT).
+# One row per request to a model in llm_metrics.db (shared by all processes):
+# endpoint that caused it, provider, model, operation, prompt version, outcome,
+# upload time, time to the first token (streams), total time, token usage.
+# Answers from the caches and coalesced requests never reach a provider and
+# are not recorded. Rows are written by a background thread, so recording
+# never blocks a request or the event loop. /api/llm_metrics summarises them.
+LLM_METRICS_ENABLED = os.environ.get('LLM_METRICS_ENABLED', 'true').lower() == 'true'
+LLM_METRICS_DB_PATH = os.environ.get(
+    'LLM_METRICS_DB_PATH', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'llm_metrics.db')
+)
+LLM_METRICS_RETENTION_DAYS = float(os.environ.get('LLM_METRICS_RETENTION_DAYS', 90))
+# Price per 1000 tokens by model, e.g. "GigaChat-Max=1.95,GigaChat-Pro=1.5,yandexgpt=1.2"
+LLM_PRICE_PER_1K_TOKENS = os.environ.get('LLM_PRICE_PER_1K_TOKENS', '')
+
+OK = 'ok'
+CANCELLED = 'cancelled'  # the client went away in the middle of a stream
+
+WRITE_BATCH = 100
+PURGE_INTERVAL = 3600  # seconds between deletions of rows past the retention
+
+_endpoint = contextvars.ContextVar('llm_endpoint', default='other')
+_queue = queue.Queue()
+_writer = None
+_writer_lock = threading.Lock()
+_stats = {'recorded': 0, 'dropped': 0}
+_lock = threading.Lock()
+
+COLUMNS = (
+    'started_at', 'endpoint', 'provider', 'model', 'operation', 'prompt_version', 'outcome', 'images',
+    'upload_ms', 'ttft_ms', 'total_ms', 'prompt_tokens', 'completion_tokens', 'total_tokens', 'completion_chars'
+)
+
+
+def _parse_prices(value):
+    prices = {}
+    for item in value.split(','):
+        if '=' in item:
+            model, price = item.split('=', 1)
+            prices[model.strip()] = float(price)
+    return prices
+
+
+_prices = _parse_prices(LLM_PRICE_PER_1K_TOKENS)
+
+
+def _connect():
+    conn = sqlite3.connect(LLM_METRICS_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_llm_metrics_db():
+    conn = _connect()
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS llm_calls (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at REAL NOT NULL,
+                endpoint TEXT NOT NULL,
+                provider TEXT NOT NULL,
+                model TEXT NOT NULL,
+                operation TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                outcome TEXT NOT NULL,
+                images INTEGER NOT NULL,
+                upload_ms REAL,
+                ttft_ms REAL,
+                total_ms REAL NOT NULL,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                total_tokens INTEGER,
+                completion_chars INTEGER
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS llm_calls_started ON llm_calls (started_at)')
+    finally:
+        conn.close()
+
+
+def set_endpoint(name):
+    """Names what the following calls are made for (an API path, a job kind) in this context."""
+    _endpoint.set(name)
+
+
+def _count(key, value=1):
+    with _lock:
+        _stats[key] += value
+
+
+def _write_rows(conn, rows):
+    placeholders = ', '.join('?' for _ in COLUMNS)
+    conn.execute('BEGIN')
+    conn.executemany(f"INSERT INTO llm_calls ({', '.join(COLUMNS)}) VALUES ({placeholders})", rows)
+    conn.execute('COMMIT')
+
+
+def _write_loop():
+    next_purge = 0
+    while True:
+        rows = [_queue.get()]
+        while len(rows) < WRITE_BATCH:
+            try:
+                rows.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            conn = _connect()
+            try:
+                _write_rows(conn, rows)
+                if time.monotonic() >= next_purge:
+                    conn.execute('DELETE FROM llm_calls WHERE started_at < ?', (time.time() - LLM_METRICS_RETENTION_DAYS * 86400,))
+                    next_purge = time.monotonic() + PURGE_INTERVAL
+            finally:
+                conn.close()
+            _count('recorded', len(rows))
+        except Exception as e:
+            print(f"Failed to write LLM metrics: {e}")
+            _count('dropped', len(rows))
+        for _ in rows:
+            _queue.task_done()
+
+
+def _flush():
+    """Waits (briefly) for the queued rows at exit."""
+    if _writer is not None:
+        deadline = time.monotonic() + 2
+        while _queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+
+def _start_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_write_loop, name='llm-metrics', daemon=True)
+            _writer.start()
+            atexit.register(_flush)
+
+
+class LLMCall:
+    """
+    Timing and usage of one request to a model. Create it right before the
+    request; finish() records it (only the first finish counts).
+    """
+
+    def __init__(self, provider, model, operation, prompt_version, images=0):
+        self.provider = provider
+        self.model = model
+        self.operation = operation
+        self.prompt_version = prompt_version
+        self.images = images
+        self.endpoint = _endpoint.get()
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self.upload_seconds = None
+        self.ttft_seconds = None
+        self.usage = (None, None, None)
+        self._finished = False
+
+    @contextmanager
+    def uploading(self):
+        """Time spent inside the block is added to the upload time."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.upload_seconds = (self.upload_seconds or 0) + time.monotonic() - started
+
+    def first_token(self):
+        if self.ttft_seconds is None:
+            self.ttft_seconds = time.monotonic() - self._started
+
+    def set_usage(self, prompt_tokens, completion_tokens, total_tokens):
+        self.usage = (prompt_tokens, completion_tokens, total_tokens)
+
+    def finish(self, outcome, completion_chars=None):
+        if self._finished:
+            return
+        self._finished = True
+        if not LLM_METRICS_ENABLED:
+            return
+        total = time.monotonic() - self._started
+        ms = lambda seconds: round(seconds * 1000, 1) if seconds is not None else None
+        _queue.put((
+            self.started_at, self.endpoint, self.provider, self.model, self.operation, self.prompt_version, outcome,
+            self.images, ms(self.upload_seconds), ms(self.ttft_seconds), ms(total), *self.usage, completion_chars
+        ))
+        _start_writer()
+
+    def finish_result(self, result):
+        """finish() with the outcome of an LLMResult."""
+        self.finish(result.error.kind if result.error else OK, len(result.latex) if result.latex else None)
+
+
+def _percentile(values, share):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+GROUP_BY = ('endpoint', 'provider', 'model', 'operation', 'prompt_version')
+
+
+def summarize(hours=24, group_by=GROUP_BY):
+    """
+    Per group of calls in the last hours: count, outcomes, latency
+    (average, p50, p95 of the total time; averages of upload and first token),
+    tokens and, where LLM_PRICE_PER_1K_TOKENS knows the model, cost.
+    """
+    group_by = [column for column in group_by if column in GROUP_BY] or list(GROUP_BY)
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM llm_calls WHERE started_at >= ? ORDER BY started_at",
+            (time.time() - hours * 3600,)
+        ).fetchall()
+    finally:
+        conn.close()
+
+    groups = {}
+    for row in rows:
+        key = tuple(row[column] for column in group_by)
+        groups.setdefault(key, []).append(row)
+
+    summary = []
+    for key, calls in groups.items():
+        totals = [call['total_ms'] for call in calls]
+        ttfts = [call['ttft_ms'] for call in calls if call['ttft_ms'] is not None]
+        uploads = [call['upload_ms'] for call in calls if call['upload_ms'] is not None]
+        outcomes = {}
+        for call in calls:
+            outcomes[call['outcome']] = outcomes.get(call['outcome'], 0) + 1
+        tokens = {
+            column: sum(call[column] or 0 for call in calls)
+            for column in ('prompt_tokens', 'completion_tokens', 'total_tokens')
+        }
+        with_usage = [call for call in calls if call['total_tokens'] is not None]
+        group = dict(zip(group_by, key))
+        group.update(
+            calls=len(calls),
+            outcomes=outcomes,
+            error_rate=round(1 - outcomes.get(OK, 0) / len(calls), 3),
+            avg_ms=round(sum(totals) / len(totals), 1),
+            p50_ms=_percentile(totals, 0.5),
+            p95_ms=_percentile(totals, 0.95),
+            avg_ttft_ms=round(sum(ttfts) / len(ttfts), 1) if ttfts else None,
+            avg_upload_ms=round(sum(uploads) / len(uploads), 1) if uploads else None,
+            calls_with_usage=len(with_usage),
+            avg_total_tokens=round(tokens['total_tokens'] / len(with_usage), 1) if with_usage else None,
+            **tokens
+        )
+        priced = [call for call in with_usage if call['model'] in _prices]
+        group['cost'] = round(sum(call['total_tokens'] / 1000 * _prices[call['model']] for call in priced), 2) if priced else None
+        summary.append(group)
+    summary.sort(key=lambda group: group['calls'], reverse=True)
+    return {'hours': hours, 'group_by': group_by, 'calls': len(rows), 'groups': summary}
+
+
+def get_llm_metrics_stats():
+    with _lock:
+        stats = dict(_stats)
+    stats.update(enabled=LLM_METRICS_ENABLED, queued=_queue.qsize())
+    return stats
@@ -0,0 +1,76 @@
+# Typed results of the LLM clients (GigaChat, YandexGPT).
+# Errors used to come back as strings like "GigaChat Error: ..." in place of
+# the LaTeX code; now callers can tell them apart and map them to a status code.
+
+
+class LLMError:
+    CONFIG = 'config'            # credentials missing or invalid configuration
+    UNSUPPORTED = 'unsupported'  # e.g. a model without image support
+    AUTH = 'auth'                # the provider rejected our credentials
+    RATE_LIMIT = 'rate_limit'
+    TIMEOUT = 'timeout'
+    PROVIDER = 'provider'        # any other failure on the provider side
+    INVALID_OUTPUT = 'invalid_output'  # the model answered, but not with usable LaTeX
+
+    HTTP_STATUS = {
+        CONFIG: 500,
+        UNSUPPORTED: 400,
+        AUTH: 502,
+        RATE_LIMIT: 429,
+        TIMEOUT: 504,
+        PROVIDER: 502,
+        INVALID_OUTPUT: 502,
+    }
+    RETRYABLE = {RATE_LIMIT, TIMEOUT, PROVIDER, INVALID_OUTPUT}
+
+    def __init__(self, kind, message, provider='gigachat'):
+        self.kind = kind
+        self.message = message
+        self.provider = provider
+
+    @property
+    def retryable(self):
+        return self.kind in self.RETRYABLE
+
+    @property
+    def http_status(self):
+        return self.HTTP_STATUS.get(self.kind, 502)
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'message': self.message,
+            'provider': self.provider,
+            'retryable': self.retryable
+        }
+
+    def __str__(self):
+        return f"{self.provider}: {self.message}"
+
+
+class LLMResult:
+    """LaTeX code produced by a model, or the error that prevented it."""
+
+    def __init__(self, latex=None, error=None, failed_files=None, stream=None):
+        self.latex = latex
+        self.error = error
+        # Inputs (e.g. pages of a multi-image upload) that were left out: [{'page', 'file', 'error'}]
+        self.failed_files = failed_files or []
+        # Streaming requests: iterator of the raw answer in pieces (may raise LLMStreamError)
+        self.stream = stream
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @classmethod
+    def failure(cls, kind, message, provider='gigachat'):
+        return cls(error=LLMError(kind, message, provider=provider))
+
+
+class LLMStreamError(Exception):
+    """The provider failed in the middle of a streamed answer."""
+
+    def __init__(self, error):
+        super().__init__(str(error))
+        self.error = error
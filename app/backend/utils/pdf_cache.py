@@ -0,0 +1,70 @@
+import os
+import hashlib
+import threading
+
+from utils import storage
+
+# Content-addressed cache of compiled PDFs.
+# Generated files are named after a hash of the rendered LaTeX source, so an
+# identical compile request is a file lookup instead of a pdflatex run.
+# Eviction (max age, max total size, least recently used first) is done by the
+# storage reaper, see utils/storage.py.
+PDF_CACHE_ENABLED = os.environ.get('PDF_CACHE_ENABLED', 'true').lower() == 'true'
+
+# Bump to invalidate every cached PDF (e.g. after changing compiler flags)
+CACHE_VERSION = "1"
+
+_stats = {'hits': 0, 'misses': 0}
+_lock = threading.Lock()
+
+
+def _count(key):
+    with _lock:
+        _stats[key] += 1
+
+
+def make_key(*sources):
+    h = hashlib.sha256(CACHE_VERSION.encode('utf-8'))
+    for source in sources:
+        h.update(b'\0')
+        h.update(source.encode('utf-8'))
+    return h.hexdigest()
+
+
+def cached_name(prefix, key):
+    return f"{prefix}_{key[:32]}"
+
+
+def lookup(filename_base, keys_filename_base=None):
+    """
+    Returns stored names (pdf_filename, keys_filename) if the worksheet (and its
+    keys, when the document has any) were already compiled, otherwise None.
+    """
+    if not PDF_CACHE_ENABLED:
+        return None
+
+    names = [f"{filename_base}.pdf"]
+    if keys_filename_base:
+        names.append(f"{keys_filename_base}.pdf")
+    paths = [storage.stored_path(name) for name in names]
+
+    if not all(os.path.exists(path) for path in paths):
+        _count('misses')
+        return None
+
+    # Touch the files so eviction sees them as recently used
+    for path in paths:
+        try:
+            os.utime(path)
+        except OSError:
+            # Evicted between the check and the touch
+            _count('misses')
+            return None
+    _count('hits')
+    stored = [storage.stored_name(name) for name in names]
+    return stored[0], (stored[1] if keys_filename_base else None)
+
+
+def get_cache_stats():
+    with _lock:
+        return dict(_stats, enabled=PDF_CACHE_ENABLED)
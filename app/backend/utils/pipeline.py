@@ -0,0 +1,390 @@
+import asyncio
+
+from utils.latex import compile_latex, teacher_line
+from utils.admission import CompileRejected
+from utils.templates import get_template, list_templates
+from utils.latex_validator import validate_latex
+from utils.db import save_worksheet
+from utils import llm_cache, speculative, class_set
+from utils.images import preprocess_images
+from utils.llm_result import LLMError, LLMStreamError
+from utils.streaming import sse_event, TaskBoxScanner
+
+# Request handling shared by the synchronous endpoints and the job workers.
+# Every step returns (response_data, http_status), so a job stores exactly what
+# the synchronous endpoint would have answered. The stream_* variants yield
+# SSE events instead, ending with that same response data; a* variants are the
+# asyncio versions used by async_app.py.
+
+
+def llm_error_response(error):
+    return {'error': f"{error.provider} error: {error.message}", 'llm_error': error.to_dict()}, error.http_status
+
+
+def latex_code_response(message, latex_content, **extra):
+    response_data = dict(extra, message=message, latex_code=latex_content)
+    # The code is shown to the user for editing, so a structural problem is reported, not fatal
+    validation_error = validate_latex(latex_content)
+    if validation_error:
+        response_data['validation_error'] = validation_error.to_dict()
+    return response_data
+
+
+def _images_cache_key(filepaths, task_count, model, use_cache):
+    """Returns (cache key, cached LaTeX or None)."""
+    from utils.gigachat_client import PROMPT_VERSION
+
+    cache_key = llm_cache.result_key([llm_cache.file_hash(path) for path in filepaths], task_count, model, PROMPT_VERSION)
+    if not use_cache:
+        llm_cache.count_bypass()
+        return cache_key, None
+    return cache_key, llm_cache.get_latex(cache_key)
+
+
+def _speculate(response_data, task_count, model):
+    """Starts Variant 2 of a good Variant 1 in the background (if SPECULATIVE_VARIANT2 is on)."""
+    if 'validation_error' not in response_data and not response_data.get('failed_files'):
+        speculative.schedule(response_data['latex_code'], task_count, model)
+    return response_data
+
+
+def _cached_images_response(latex_content, task_count, model):
+    response_data = latex_code_response('Worksheet parsed successfully', latex_content, model=model, cached=True)
+    return _speculate(response_data, task_count, model)
+
+
+def _images_response(cache_key, latex_content, task_count, model, failed_files):
+    from utils.gigachat_client import PROMPT_VERSION
+
+    response_data = latex_code_response('Worksheet parsed successfully', latex_content, model=model)
+    if failed_files:
+        # Some pages could not be uploaded; the worksheet holds the tasks of the others
+        response_data['failed_files'] = failed_files
+    # Broken or incomplete answers are not worth keeping: the next request gets a new one
+    if 'validation_error' not in response_data and not failed_files:
+        try:
+            llm_cache.put_latex(cache_key, latex_content, model, PROMPT_VERSION)
+        except Exception as e:
+            print(f"Failed to cache the LaTeX result: {e}")
+    return _speculate(response_data, task_count, model)
+
+
+def process_images(filepaths, task_count=3, model="GigaChat-Max", use_cache=True):
+    """
+    OCR + LaTeX generation for uploaded images.
+    The same images with the same settings are answered from the LLM cache
+    unless use_cache is False.
+    """
+    from utils.gigachat_client import process_image_with_gigachat
+
+    cache_key, latex_content = _images_cache_key(filepaths, task_count, model, use_cache)
+    if latex_content:
+        return _cached_images_response(latex_content, task_count, model), 200
+
+    # Smaller pages upload and are read faster; the cache key above is of the originals
+    image_paths = preprocess_images(filepaths)
+
+    # This single call handles both OCR and LaTeX generation
+    result = process_image_with_gigachat(image_paths, task_count=task_count, model=model, use_cache=use_cache)
+    if result.error:
+        return llm_error_response(result.error)
+    return _images_response(cache_key, result.latex, task_count, model, result.failed_files), 200
+
+
+def generate_similar(original_text, task_count=3, model="GigaChat-Max", difficulty="same"):
+    """Variant 2 with the same kind of tasks and different numbers."""
+    from utils.gigachat_client import generate_similar_worksheet
+
+    # Speculative mode may have generated exactly this variant already
+    latex_content = speculative.take(original_text, task_count, model, difficulty)
+    if latex_content:
+        return latex_code_response('Variant 2 text generated successfully', latex_content, cached=True), 200
+
+    result = generate_similar_worksheet(original_text, task_count=task_count, model=model, difficulty=difficulty)
+    if result.error:
+        return llm_error_response(result.error)
+    return latex_code_response('Variant 2 text generated successfully', result.latex), 200
+
+
+def _error_event(error):
+    response_data, status = llm_error_response(error)
+    return sse_event('error', dict(response_data, status=status))
+
+
+def _stream_events(result, done):
+    """
+    SSE events of a streaming LLMResult: 'task' per completed \\TaskBox, then
+    'done' with done(latex) as data, or 'error'.
+    """
+    from utils.gigachat_client import clean_latex
+
+    if result.error:
+        yield _error_event(result.error)
+        return
+
+    scanner = TaskBoxScanner()
+    try:
+        for piece in result.stream:
+            for task in scanner.feed(piece):
+                yield sse_event('task', task)
+    except LLMStreamError as e:
+        yield _error_event(e.error)
+        return
+    finally:
+        # Also runs when the client disconnects, which stops the completion
+        result.stream.close()
+
+    latex_content = clean_latex(scanner.text)
+    if not latex_content:
+        yield _error_event(LLMError(LLMError.INVALID_OUTPUT, "The model returned an empty answer."))
+        return
+    yield sse_event('done', done(latex_content))
+
+
+def stream_cached(response_data):
+    """Events of a cached answer: all its tasks at once, then 'done' with response_data."""
+    for task in TaskBoxScanner().feed(response_data['latex_code']):
+        yield sse_event('task', task)
+    yield sse_event('done', response_data)
+
+
+def stream_process_images(filepaths, task_count=3, model="GigaChat-Max", use_cache=True):
+    """process_images as a generator of SSE events."""
+    from utils.gigachat_client import stream_image_with_gigachat
+
+    cache_key, latex_content = _images_cache_key(filepaths, task_count, model, use_cache)
+    if latex_content:
+        yield from stream_cached(_cached_images_response(latex_content, task_count, model))
+        return
+
+    image_paths = preprocess_images(filepaths)
+    result = stream_image_with_gigachat(image_paths, task_count=task_count, model=model, use_cache=use_cache)
+    yield from _stream_events(result, lambda latex: _images_response(cache_key, latex, task_count, model, result.failed_files))
+
+
+def stream_generate_similar(original_text, task_count=3, model="GigaChat-Max", difficulty="same"):
+    """generate_similar as a generator of SSE events."""
+    from utils.gigachat_client import stream_similar_worksheet
+
+    latex_content = speculative.take(original_text, task_count, model, difficulty)
+    if latex_content:
+        yield from stream_cached(latex_code_response('Variant 2 text generated successfully', latex_content, cached=True))
+        return
+
+    result = stream_similar_worksheet(original_text, task_count=task_count, model=model, difficulty=difficulty)
+    yield from _stream_events(result, lambda latex: latex_code_response('Variant 2 text generated successfully', latex))
+
+
+async def _in_executor(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def aprocess_images(filepaths, task_count=3, model="GigaChat-Max", use_cache=True):
+    """process_images for async_app.py: hashing, the cache and image processing run in executors."""
+    from utils.gigachat_client import aprocess_image_with_gigachat
+
+    cache_key, latex_content = await _in_executor(_images_cache_key, filepaths, task_count, model, use_cache)
+    if latex_content:
+        return await _in_executor(_cached_images_response, latex_content, task_count, model), 200
+
+    image_paths = await _in_executor(preprocess_images, filepaths)
+    result = await aprocess_image_with_gigachat(image_paths, task_count=task_count, model=model, use_cache=use_cache)
+    if result.error:
+        return llm_error_response(result.error)
+    return await _in_executor(_images_response, cache_key, result.latex, task_count, model, result.failed_files), 200
+
+
+async def agenerate_similar(original_text, task_count=3, model="GigaChat-Max", difficulty="same"):
+    """generate_similar for async_app.py."""
+    from utils.gigachat_client import agenerate_similar_worksheet
+
+    # Waits without blocking the loop for a speculative generation still under way
+    latex_content = await speculative.atake(original_text, task_count, model, difficulty)
+    if latex_content:
+        return await _in_executor(
+            lambda: latex_code_response('Variant 2 text generated successfully', latex_content, cached=True)
+        ), 200
+
+    result = await agenerate_similar_worksheet(original_text, task_count=task_count, model=model, difficulty=difficulty)
+    if result.error:
+        return llm_error_response(result.error)
+    return await _in_executor(latex_code_response, 'Variant 2 text generated successfully', result.latex), 200
+
+
+async def _astream_events(result, done):
+    """_stream_events for an LLMResult whose stream is an async iterator; done runs in an executor."""
+    from utils.gigachat_client import clean_latex
+
+    if result.error:
+        yield _error_event(result.error)
+        return
+
+    scanner = TaskBoxScanner()
+    try:
+        async for piece in result.stream:
+            for task in scanner.feed(piece):
+                yield sse_event('task', task)
+    except LLMStreamError as e:
+        yield _error_event(e.error)
+        return
+    finally:
+        await result.stream.aclose()
+
+    latex_content = clean_latex(scanner.text)
+    if not latex_content:
+        yield _error_event(LLMError(LLMError.INVALID_OUTPUT, "The model returned an empty answer."))
+        return
+    yield sse_event('done', await _in_executor(done, latex_content))
+
+
+async def astream_process_images(filepaths, task_count=3, model="GigaChat-Max", use_cache=True):
+    """stream_process_images for async_app.py."""
+    from utils.gigachat_client import astream_image_with_gigachat
+
+    cache_key, latex_content = await _in_executor(_images_cache_key, filepaths, task_count, model, use_cache)
+    if latex_content:
+        response_data = await _in_executor(_cached_images_response, latex_content, task_count, model)
+        for event in stream_cached(response_data):
+            yield event
+        return
+
+    image_paths = await _in_executor(preprocess_images, filepaths)
+    result = await astream_image_with_gigachat(image_paths, task_count=task_count, model=model, use_cache=use_cache)
+    async for event in _astream_events(result, lambda latex: _images_response(cache_key, latex, task_count, model, result.failed_files)):
+        yield event
+
+
+async def astream_generate_similar(original_text, task_count=3, model="GigaChat-Max", difficulty="same"):
+    """stream_generate_similar for async_app.py."""
+    from utils.gigachat_client import astream_similar_worksheet
+
+    latex_content = await speculative.atake(original_text, task_count, model, difficulty)
+    if latex_content:
+        response_data = await _in_executor(
+            lambda: latex_code_response('Variant 2 text generated successfully', latex_content, cached=True)
+        )
+        for event in stream_cached(response_data):
+            yield event
+        return
+
+    result = await astream_similar_worksheet(original_text, task_count=task_count, model=model, difficulty=difficulty)
+    async for event in _astream_events(result, lambda latex: latex_code_response('Variant 2 text generated successfully', latex)):
+        yield event
+
+
+def _class_set_header(data):
+    """(header LaTeX, None) for a class set request, or (None, (response_data, status)) if it is invalid."""
+    try:
+        count = int(data.get('count', 0))
+    except (TypeError, ValueError):
+        count = 0
+
+    if not data.get('original_text'):
+        return None, ({'error': 'Original text is required'}, 400)
+    if not 1 <= count <= class_set.CLASS_SET_MAX_VARIANTS:
+        return None, ({'error': f"count must be between 1 and {class_set.CLASS_SET_MAX_VARIANTS}"}, 400)
+    template_name = data.get('template') or None
+    template = get_template(template_name)
+    if template is None:
+        return None, ({'error': f"Unknown template: {template_name}", 'templates': list_templates()}, 400)
+    topic = data.get('topic', 'Рабочий лист')
+    # Repeated on the first page of every student
+    header = template.render_header(TOPIC=topic, TEACHER=teacher_line(data.get('teacher_name', '')))
+    if header is None:
+        return None, ({'error': f"Template {template.name} has no PLACEHOLDER:CONTENT in its document body"}, 400)
+    return header, None
+
+
+def check_class_set(data):
+    """(response_data, status) if a class set request is invalid, None if it can be queued."""
+    return _class_set_header(data)[1]
+
+
+def make_class_set(data):
+    """
+    A distinct variant per student, compiled into one PDF (students numbered
+    1..N) and one answer key. Variants that could not be generated are listed
+    in 'variants' with their error; the others are still delivered.
+    """
+    header, invalid = _class_set_header(data)
+    if invalid:
+        return invalid
+
+    variants = class_set.generate_variants(
+        data['original_text'], int(data['count']), task_count=data.get('task_count', 3), model=data.get('model', 'GigaChat-Max'),
+        difficulty=data.get('difficulty', 'same')
+    )
+    generated = sum(1 for variant in variants if variant['status'] == class_set.OK)
+    if not generated:
+        return llm_error_response(variants[0]['error'])
+
+    latex_content = class_set.combine_variants(variants, header, layout=data.get('layout', '1col'))
+    tables_error = class_set.check_answer_tables(variants, latex_content)
+    if tables_error:
+        return {'error': tables_error}, 500
+    response_data, status = compile_worksheet(dict(data, latex_code=latex_content, layout='1col', is_variant2=False))
+    response_data.update(
+        latex_code=latex_content,
+        generated=generated,
+        failed=count - generated,
+        variants=class_set.variant_statuses(variants)
+    )
+    if status == 200:
+        response_data['message'] = f"Class set of {generated} variants generated successfully"
+    return response_data, status
+
+
+def compile_worksheet(data):
+    """Compiles the worksheet (and answer keys) described by a /api/compile request body."""
+    latex_content = data.get('latex_code')
+    topic = data.get('topic', 'Рабочий лист')
+    teacher_name = data.get('teacher_name', '')
+    is_variant2 = data.get('is_variant2', False)
+    layout = data.get('layout', '1col')
+    template_name = data.get('template') or None
+
+    if not latex_content:
+        return {'error': 'No LaTeX code provided'}, 400
+    if template_name and get_template(template_name) is None:
+        return {'error': f"Unknown template: {template_name}", 'templates': list_templates()}, 400
+
+    # Reject documents that can never compile before they take up a TeX worker
+    validation_error = validate_latex(latex_content)
+    if validation_error:
+        return {
+            'error': f"Invalid LaTeX ({validation_error})",
+            'validation_error': validation_error.to_dict()
+        }, 422
+
+    # compile_latex appends a hash of the rendered source, so repeated requests hit the PDF cache
+    base_name = "variant2" if is_variant2 else "worksheet"
+    topic_str = f"{topic} (Вариант 2)" if is_variant2 else topic
+
+    try:
+        pdf_filename, keys_filename, error, keys_error = compile_latex(latex_content, topic=topic_str, filename_base=base_name, teacher_name=teacher_name, layout=layout, template_name=template_name)
+    except CompileRejected as e:
+        # app.py turns retry_after into a Retry-After header
+        return {'error': str(e), 'retry_after': e.retry_after}, 429
+
+    if not pdf_filename:
+        return {'error': f"PDF Generation failed: {error}"}, 500
+
+    pdf_url = f"/worksheet-api/generated/{pdf_filename}"
+    keys_url = f"/worksheet-api/generated/{keys_filename}" if keys_filename else None
+
+    # Save to history
+    try:
+        save_worksheet(topic_str, teacher_name, latex_content, pdf_url, keys_url)
+    except Exception as e:
+        print(f"Failed to save to history: {e}")
+
+    response_data = {
+        'message': 'PDF generated successfully',
+        'pdf_url': pdf_url
+    }
+    if keys_url:
+        response_data['keys_url'] = keys_url
+    if keys_error:
+        # The worksheet is delivered anyway; the client tells the teacher the keys are missing
+        response_data['keys_error'] = f"Answer keys failed to compile: {keys_error}"
+    return response_data, 200
@@ -0,0 +1,290 @@
+import os
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.llm_cache import LLM_CACHE_DB_PATH
+from utils.latex_validator import validate_latex
+from utils import llm_metrics
+from utils.layout import layout_for
+
+# Speculative Variant 2 (opt-in).
+# As soon as Variant 1 is recognised, Variant 2 is generated in the background
+# with the difficulty teachers pick most often, so that the click on
+# "Вариант 2" is answered from the cache instead of after a minute of waiting.
+# Speculative calls are limited per hour and in flight (over all processes,
+# counted in sqlite); results that nobody asks for expire after
+# SPECULATIVE_TTL_MINUTES and are reported as wasted in /api/stats.
+SPECULATIVE_VARIANT2 = os.environ.get('SPECULATIVE_VARIANT2', 'false').lower() == 'true'
+# 'auto' follows the observed clicks; or a fixed 'easier' / 'same' / 'harder'
+SPECULATIVE_DIFFICULTY = os.environ.get('SPECULATIVE_DIFFICULTY', 'auto')
+SPECULATIVE_MAX_PER_HOUR = int(os.environ.get('SPECULATIVE_MAX_PER_HOUR', 60))
+SPECULATIVE_MAX_INFLIGHT = int(os.environ.get('SPECULATIVE_MAX_INFLIGHT', 2))
+SPECULATIVE_TTL_MINUTES = float(os.environ.get('SPECULATIVE_TTL_MINUTES', 30))
+# A click that finds its variant still being generated waits for it this long
+SPECULATIVE_WAIT = float(os.environ.get('SPECULATIVE_WAIT', 90))
+
+DIFFICULTIES = ('easier', 'same', 'harder')
+DEFAULT_DIFFICULTY = 'same'
+# Until this many clicks are recorded, 'auto' uses DEFAULT_DIFFICULTY
+MIN_CLICKS = 20
+# A generation still pending after this long is considered lost (process died)
+PENDING_TIMEOUT = 180
+RETENTION_HOURS = 24  # rows are kept this long for the statistics
+POLL_INTERVAL = 0.5
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+_executor = ThreadPoolExecutor(max_workers=max(1, SPECULATIVE_MAX_INFLIGHT), thread_name_prefix='speculative')
+_stats = {'scheduled': 0, 'skipped_budget': 0, 'hits': 0, 'waited_hits': 0, 'misses': 0}
+_lock = threading.Lock()
+
+
+def _count(key):
+    with _lock:
+        _stats[key] += 1
+
+
+def _connect():
+    conn = sqlite3.connect(LLM_CACHE_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_speculative_db():
+    conn = _connect()
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS speculative_variants (
+                key TEXT PRIMARY KEY,
+                difficulty TEXT NOT NULL,
+                status TEXT NOT NULL,
+                latex TEXT,
+                created_at REAL NOT NULL,
+                finished_at REAL,
+                used_at REAL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS speculative_created ON speculative_variants (created_at)')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS variant2_clicks (
+                difficulty TEXT PRIMARY KEY,
+                clicks INTEGER NOT NULL
+            )
+        ''')
+    finally:
+        conn.close()
+
+
+def variant_key(original_text, task_count, model, difficulty):
+    from utils.gigachat_client import PROMPT_VERSION
+
+    count, _ = layout_for(task_count)
+    parts = [PROMPT_VERSION, model, str(count), difficulty, original_text.strip()]
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def likely_difficulty():
+    """The difficulty to speculate on: the most clicked one, or the configured one."""
+    if SPECULATIVE_DIFFICULTY in DIFFICULTIES:
+        return SPECULATIVE_DIFFICULTY
+    conn = _connect()
+    try:
+        rows = conn.execute('SELECT difficulty, clicks FROM variant2_clicks').fetchall()
+    finally:
+        conn.close()
+    clicks = {row['difficulty']: row['clicks'] for row in rows}
+    if sum(clicks.values()) < MIN_CLICKS:
+        return DEFAULT_DIFFICULTY
+    return max(DIFFICULTIES, key=lambda d: clicks.get(d, 0))
+
+
+def _claim(key, difficulty):
+    """Inserts a pending row if the budget allows and the variant isn't there yet."""
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('DELETE FROM speculative_variants WHERE created_at < ?', (now - RETENTION_HOURS * 3600,))
+        row = conn.execute('SELECT status, created_at FROM speculative_variants WHERE key = ?', (key,)).fetchone()
+        if row and row['status'] != FAILED and row['created_at'] > now - SPECULATIVE_TTL_MINUTES * 60:
+            conn.execute('COMMIT')
+            return False
+        in_flight = conn.execute(
+            'SELECT COUNT(*) FROM speculative_variants WHERE status = ? AND created_at > ?',
+            (PENDING, now - PENDING_TIMEOUT)
+        ).fetchone()[0]
+        last_hour = conn.execute(
+            'SELECT COUNT(*) FROM speculative_variants WHERE created_at > ?', (now - 3600,)
+        ).fetchone()[0]
+        if in_flight >= SPECULATIVE_MAX_INFLIGHT or last_hour >= SPECULATIVE_MAX_PER_HOUR:
+            conn.execute('COMMIT')
+            _count('skipped_budget')
+            return False
+        conn.execute('''
+            INSERT OR REPLACE INTO speculative_variants (key, difficulty, status, created_at)
+            VALUES (?, ?, ?, ?)
+        ''', (key, difficulty, PENDING, now))
+        conn.execute('COMMIT')
+        return True
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+
+def _finish(key, status, latex=None):
+    conn = _connect()
+    try:
+        conn.execute(
+            'UPDATE speculative_variants SET status = ?, latex = ?, finished_at = ? WHERE key = ?',
+            (status, latex, time.time(), key)
+        )
+    finally:
+        conn.close()
+
+
+def _generate(key, original_text, task_count, model, difficulty):
+    from utils.gigachat_client import generate_similar_worksheet
+
+    llm_metrics.set_endpoint('speculative')
+    try:
+        result = generate_similar_worksheet(original_text, task_count=task_count, model=model, difficulty=difficulty)
+        if result.ok and validate_latex(result.latex) is None:
+            _finish(key, DONE, result.latex)
+        else:
+            _finish(key, FAILED)
+    except Exception as e:
+        print(f"Speculative Variant 2 failed: {e}")
+        _finish(key, FAILED)
+
+
+def schedule(original_text, task_count=3, model="GigaChat-Max"):
+    """
+    Starts generating Variant 2 of a freshly recognised worksheet in the
+    background. Does nothing unless SPECULATIVE_VARIANT2 is on and the budget allows.
+    """
+    if not SPECULATIVE_VARIANT2 or not original_text:
+        return
+    try:
+        difficulty = likely_difficulty()
+        key = variant_key(original_text, task_count, model, difficulty)
+        if not _claim(key, difficulty):
+            return
+    except Exception as e:
+        print(f"Failed to schedule a speculative Variant 2: {e}")
+        return
+    _count('scheduled')
+    _executor.submit(_generate, key, original_text, task_count, model, difficulty)
+
+
+def _record_click(difficulty):
+    if difficulty not in DIFFICULTIES:
+        return
+    conn = _connect()
+    try:
+        conn.execute('''
+            INSERT INTO variant2_clicks (difficulty, clicks) VALUES (?, 1)
+            ON CONFLICT(difficulty) DO UPDATE SET clicks = clicks + 1
+        ''', (difficulty,))
+    finally:
+        conn.close()
+
+
+def _look_up(key, deadline):
+    """(DONE, latex) if the variant is ready, (PENDING, None) to wait, (FAILED, None) to give up."""
+    now = time.time()
+    conn = _connect()
+    try:
+        row = conn.execute(
+            'SELECT status, latex, created_at FROM speculative_variants WHERE key = ? AND created_at > ?',
+            (key, now - SPECULATIVE_TTL_MINUTES * 60)
+        ).fetchone()
+        if row and row['status'] == DONE:
+            conn.execute('UPDATE speculative_variants SET used_at = ? WHERE key = ? AND used_at IS NULL', (now, key))
+            return DONE, row['latex']
+    finally:
+        conn.close()
+    if (not row or row['status'] == FAILED or row['created_at'] < now - PENDING_TIMEOUT
+            or time.monotonic() > deadline):
+        return FAILED, None
+    return PENDING, None
+
+
+def _taken(status, latex, waited):
+    _count(('waited_hits' if waited else 'hits') if status == DONE else 'misses')
+    return latex
+
+
+def take(original_text, task_count=3, model="GigaChat-Max", difficulty="same"):
+    """
+    Called for every Variant 2 request: records the clicked difficulty and
+    returns the speculated LaTeX for exactly this request, or None. A variant
+    still being generated is waited for (up to SPECULATIVE_WAIT seconds).
+    """
+    if not SPECULATIVE_VARIANT2:
+        return None
+    key = variant_key(original_text, task_count, model, difficulty)
+    deadline = time.monotonic() + SPECULATIVE_WAIT
+    _record_click(difficulty)
+    waited = False
+    while True:
+        status, latex = _look_up(key, deadline)
+        if status != PENDING:
+            return _taken(status, latex, waited)
+        waited = True
+        time.sleep(POLL_INTERVAL)
+
+
+async def atake(original_text, task_count=3, model="GigaChat-Max", difficulty="same"):
+    """
+    take() for async_app.py: waits with asyncio.sleep, so a pending variant
+    holds neither the event loop nor a thread of its executor.
+    """
+    if not SPECULATIVE_VARIANT2:
+        return None
+    key = variant_key(original_text, task_count, model, difficulty)
+    deadline = time.monotonic() + SPECULATIVE_WAIT
+    await asyncio.to_thread(_record_click, difficulty)
+    waited = False
+    while True:
+        status, latex = await asyncio.to_thread(_look_up, key, deadline)
+        if status != PENDING:
+            return _taken(status, latex, waited)
+        waited = True
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+def get_speculative_stats():
+    with _lock:
+        stats = dict(_stats)
+    stats.update(enabled=SPECULATIVE_VARIANT2, difficulty=SPECULATIVE_DIFFICULTY, ttl_minutes=SPECULATIVE_TTL_MINUTES)
+    if not SPECULATIVE_VARIANT2:
+        return stats
+    now = time.time()
+    conn = _connect()
+    try:
+        row = conn.execute('''
+            SELECT
+                COUNT(*) AS generated,
+                SUM(used_at IS NOT NULL) AS used,
+                SUM(status = 'done' AND used_at IS NULL AND created_at <= ?) AS expired_unused,
+                SUM(status = 'pending') AS pending,
+                SUM(status = 'failed') AS failed
+            FROM speculative_variants
+        ''', (now - SPECULATIVE_TTL_MINUTES * 60,)).fetchone()
+        clicks = {r['difficulty']: r['clicks'] for r in conn.execute('SELECT difficulty, clicks FROM variant2_clicks')}
+    finally:
+        conn.close()
+    # Counted over the last RETENTION_HOURS (all processes)
+    stats['last_24h'] = {key: row[key] or 0 for key in row.keys()}
+    stats['clicks'] = clicks
+    stats['next_difficulty'] = likely_difficulty()
+    return stats
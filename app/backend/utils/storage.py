@@ -0,0 +1,228 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# Final PDFs live in a sharded store: static/generated/<ab>/<name>.pdf
+OUTPUT_DIR = os.path.join(os.path.dirname(__file__), '../static/generated')
+
+# Intermediate files (.tex, .aux, .log) never touch the output store.
+# /dev/shm keeps them in memory where available.
+_default_scratch = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+SCRATCH_ROOT = os.environ.get('LATEX_SCRATCH_DIR', os.path.join(_default_scratch, 'worksheet-creator'))
+JOBS_DIR = os.path.join(SCRATCH_ROOT, 'jobs')
+
+# Retention policy for generated files, enforced by a background reaper
+GENERATED_MAX_AGE_HOURS = float(os.environ.get('GENERATED_MAX_AGE_HOURS', 24 * 7))
+GENERATED_MAX_BYTES = int(os.environ.get('GENERATED_MAX_MB', 500)) * 1024 * 1024
+REAPER_INTERVAL = int(os.environ.get('GENERATED_REAPER_INTERVAL', 600))  # seconds
+# Job scratch directories older than this belong to crashed or killed jobs
+STALE_SCRATCH_SECONDS = 3600
+
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+os.makedirs(JOBS_DIR, exist_ok=True)
+
+_stats = {'reaped_files': 0, 'reaped_bytes': 0, 'reaper_runs': 0}
+_lock = threading.Lock()
+_reaper = None
+
+# path -> (inode, size, etag). Stored files are never modified in place (only
+# replaced or touched), so inode and size identify the content.
+_etags = {}
+MAX_ETAGS = 10000
+
+
+def group_name(filename):
+    """worksheet_<hash>_keys.pdf and worksheet_<hash>.pdf belong to worksheet_<hash>."""
+    base = os.path.basename(filename).split('.', 1)[0]
+    if base.endswith('_keys'):
+        base = base[:-len('_keys')]
+    return base
+
+
+def stored_name(filename):
+    """
+    Returns the name of a generated file relative to OUTPUT_DIR, e.g. 'a3/worksheet_x.pdf'.
+    Files of one worksheet share a shard, so its keys sit next to it.
+    """
+    shard = hashlib.sha1(group_name(filename).encode('utf-8')).hexdigest()[:2]
+    return f"{shard}/{filename}"
+
+
+def stored_path(filename):
+    return os.path.join(OUTPUT_DIR, *stored_name(filename).split('/'))
+
+
+def publish(src_path, filename):
+    """Atomically moves a finished file from scratch into the store. Returns its stored name."""
+    dest = stored_path(filename)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    try:
+        os.replace(src_path, dest)
+    except OSError:
+        # Scratch on tmpfs and the store are on different filesystems
+        tmp_dest = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.move(src_path, tmp_dest)
+        os.replace(tmp_dest, dest)
+    return stored_name(filename)
+
+
+def write_bytes(filename, data):
+    """Writes a finished file into the store. Returns its stored name."""
+    dest = stored_path(filename)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp_dest = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_dest, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_dest, dest)
+    return stored_name(filename)
+
+
+def resolve(name):
+    """Path of a stored name like 'a3/worksheet_x.pdf', or None if it is invalid or missing."""
+    parts = name.split('/')
+    if any(part in ('', '.', '..') or '\\' in part for part in parts):
+        return None
+    path = os.path.join(OUTPUT_DIR, *parts)
+    return path if os.path.isfile(path) else None
+
+
+def file_etag(path):
+    """Content hash of a stored file, computed once per file."""
+    st = os.stat(path)
+    cached = _etags.get(path)
+    if cached and cached[:2] == (st.st_ino, st.st_size):
+        return cached[2]
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    etag = h.hexdigest()[:32]
+    with _lock:
+        if len(_etags) >= MAX_ETAGS:
+            _etags.clear()
+        _etags[path] = (st.st_ino, st.st_size, etag)
+    return etag
+
+
+@contextmanager
+def scratch_dir():
+    """Per-job build directory, removed when the job is done."""
+    path = tempfile.mkdtemp(dir=JOBS_DIR)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _scan_groups(directory):
+    groups = {}
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.startswith('.'):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            group = groups.setdefault(group_name(name), {'size': 0, 'used': 0, 'paths': []})
+            group['size'] += st.st_size
+            group['used'] = max(group['used'], st.st_mtime)
+            group['paths'].append(path)
+    return groups
+
+
+def _remove_group(group):
+    for path in group['paths']:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def reap(max_age_hours=None, max_bytes=None):
+    """
+    Deletes worksheets not used for max_age_hours, then the least recently used
+    ones until the store fits into max_bytes. Returns the number of files removed.
+    """
+    if max_age_hours is None:
+        max_age_hours = GENERATED_MAX_AGE_HOURS
+    if max_bytes is None:
+        max_bytes = GENERATED_MAX_BYTES
+
+    groups = sorted(_scan_groups(OUTPUT_DIR).values(), key=lambda g: g['used'])
+    total = sum(g['size'] for g in groups)
+    cutoff = time.time() - max_age_hours * 3600
+
+    removed_files = 0
+    removed_bytes = 0
+    for group in groups:
+        if group['used'] >= cutoff and total <= max_bytes:
+            break
+        _remove_group(group)
+        total -= group['size']
+        removed_files += len(group['paths'])
+        removed_bytes += group['size']
+
+    _reap_scratch()
+    with _lock:
+        _stats['reaped_files'] += removed_files
+        _stats['reaped_bytes'] += removed_bytes
+        _stats['reaper_runs'] += 1
+    return removed_files
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+def _reap_scratch():
+    now = time.time()
+    for entry in os.scandir(JOBS_DIR):
+        try:
+            if now - entry.stat().st_mtime > STALE_SCRATCH_SECONDS:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass
+
+    # Warm TeX workers keep one directory per <pid>_<index>
+    pool_dir = os.path.join(SCRATCH_ROOT, 'tex_pool')
+    if os.path.isdir(pool_dir):
+        for entry in os.scandir(pool_dir):
+            pid = entry.name.split('_', 1)[0]
+            if pid.isdigit() and not _pid_alive(int(pid)):
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def _reaper_loop():
+    while True:
+        try:
+            reap()
+        except Exception as e:
+            print(f"Generated files reaper failed: {e}")
+        time.sleep(REAPER_INTERVAL)
+
+
+def start_reaper():
+    """Starts the background reaper once per process."""
+    global _reaper
+    with _lock:
+        if _reaper is None:
+            _reaper = threading.Thread(target=_reaper_loop, name='generated-reaper', daemon=True)
+            _reaper.start()
+
+
+def get_storage_stats():
+    with _lock:
+        return dict(_stats, max_age_hours=GENERATED_MAX_AGE_HOURS, max_bytes=GENERATED_MAX_BYTES)
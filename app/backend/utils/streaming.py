@@ -0,0 +1,49 @@
+import json
+
+from utils.latex_validator import read_group
+
+# Server-Sent Events for the streaming endpoints (/api/process/stream,
+# /api/generate_similar/stream). The model's answer is relayed as it is
+# generated: every \TaskBox{n}{text} is sent as a 'task' event as soon as its
+# closing brace arrives, then 'done' carries what the synchronous endpoint
+# would have answered, or 'error' what it would have failed with.
+
+TASKBOX = '\\TaskBox'
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class TaskBoxScanner:
+    """Finds complete \\TaskBox{n}{text} blocks in LaTeX that arrives in pieces."""
+
+    def __init__(self):
+        self.text = ''
+        self.pos = 0  # everything before pos has been scanned
+        self.count = 0
+
+    def feed(self, piece):
+        """Adds a piece of the answer and returns the tasks completed by it, as dicts."""
+        self.text += piece
+        tasks = []
+        while True:
+            start = self.text.find(TASKBOX, self.pos)
+            if start == -1:
+                # Keep a possible partial '\TaskBo' at the end for the next piece
+                self.pos = max(self.pos, len(self.text) - len(TASKBOX))
+                return tasks
+            number_end, number_start = read_group(self.text, start + len(TASKBOX))
+            if number_end is None:
+                return tasks
+            text_end, text_start = read_group(self.text, number_end)
+            if text_end is None:
+                return tasks
+            self.count += 1
+            tasks.append({
+                'index': self.count,
+                'number': self.text[number_start + 1:number_end - 1].strip(),
+                'text': self.text[text_start + 1:text_end - 1].strip(),
+                'latex': self.text[start:text_end]
+            })
+            self.pos = text_end
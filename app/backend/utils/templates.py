@@ -0,0 +1,133 @@
+import os
+import re
+import time
+import hashlib
+import threading
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), '../templates')
+DEFAULT_TEMPLATE = 'default_worksheet'
+# Template files are stat'ed for changes at most this often (seconds)
+TEMPLATE_CHECK_INTERVAL = float(os.environ.get('TEMPLATE_CHECK_INTERVAL', 2))
+
+PLACEHOLDER_RE = re.compile(r'PLACEHOLDER:([A-Z]+)')
+NAME_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+
+BODY_MARKER = r'\begin{document}'
+# The teacher placeholder lives inside the \WorksheetTitle definition, so in the
+# shared preamble it is replaced by a macro that each document body defines
+TEACHER_MACRO = r'\WorksheetTeacherLine'
+CONTENT_PLACEHOLDER = 'PLACEHOLDER:CONTENT'
+
+
+class _Parts:
+    """Source split at its placeholders; rendering is a single join."""
+
+    def __init__(self, source):
+        pieces = PLACEHOLDER_RE.split(source)
+        self.literals = pieces[0::2]
+        self.fields = pieces[1::2]
+
+    def render(self, values):
+        out = [self.literals[0]]
+        for field, literal in zip(self.fields, self.literals[1:]):
+            out.append(values.get(field, ''))
+            out.append(literal)
+        return ''.join(out)
+
+
+class Template:
+    def __init__(self, name, source, mtime):
+        self.name = name
+        self.mtime = mtime
+        self.version = hashlib.sha1(source.encode('utf-8')).hexdigest()[:12]
+        self._full = _Parts(source)
+
+        # Preamble/body split for compiling against a precompiled format
+        self.preamble = None
+        self._body = None
+        # What the body prints above the content (title, header fields)
+        self._header = None
+        idx = source.find(BODY_MARKER)
+        content_idx = source.find(CONTENT_PLACEHOLDER, idx)
+        if idx != -1 and content_idx != -1:
+            self._header = _Parts(source[idx + len(BODY_MARKER):content_idx])
+        if idx != -1:
+            preamble = source[:idx].replace('PLACEHOLDER:TEACHER', TEACHER_MACRO)
+            if 'PLACEHOLDER:' not in preamble:
+                self.preamble = preamble
+                self._body = _Parts(source[idx:])
+
+    def render(self, **values):
+        """Full document, e.g. render(CONTENT=..., TOPIC=..., TEACHER=...)."""
+        return self._full.render(values)
+
+    def render_header(self, **values):
+        """What the template prints at the top of the document, or None if it has no body with the content."""
+        if self._header is None:
+            return None
+        return self._header.render(values).strip()
+
+    def render_body(self, **values):
+        """Document body for the preamble format, or None if the template can't be split."""
+        if self._body is None:
+            return None
+        teacher_def = f"\\def{TEACHER_MACRO}{{{values.get('TEACHER', '')}}}\n"
+        return ''.join([teacher_def, self._body.render(values)])
+
+
+class TemplateRegistry:
+    """Loads named templates from a directory once and reloads them when they change on disk."""
+
+    def __init__(self, directory=TEMPLATES_DIR):
+        self.directory = directory
+        self._templates = {}
+        self._checked = {}
+        self._lock = threading.Lock()
+
+    def _path(self, name):
+        return os.path.join(self.directory, f"{name}.tex")
+
+    def names(self):
+        return sorted(
+            f[:-4] for f in os.listdir(self.directory)
+            if f.endswith('.tex') and NAME_RE.match(f[:-4])
+        )
+
+    def get(self, name=None):
+        """Returns the Template or None if there is no such template."""
+        name = name or DEFAULT_TEMPLATE
+        if not NAME_RE.match(name):
+            return None
+
+        now = time.monotonic()
+        template = self._templates.get(name)
+        if template is not None and now - self._checked.get(name, 0) < TEMPLATE_CHECK_INTERVAL:
+            return template
+
+        path = self._path(name)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        self._checked[name] = now
+        if template is not None and template.mtime == mtime:
+            return template
+
+        with self._lock:
+            template = self._templates.get(name)
+            if template is None or template.mtime != mtime:
+                with open(path, 'r', encoding='utf-8') as f:
+                    template = Template(name, f.read(), mtime)
+                self._templates[name] = template
+        return template
+
+
+registry = TemplateRegistry()
+
+
+def get_template(name=None):
+    return registry.get(name)
+
+
+def list_templates():
+    return registry.names()
@@ -0,0 +1,244 @@
+import os
+import math
+import queue
+import shutil
+import signal
+import subprocess
+import threading
+from concurrent.futures import Future
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from utils import storage
+from utils.admission import TEX_MAX_CONCURRENT
+
+# Processes on this machine with a pool of their own (gunicorn and queue workers).
+# They share TEX_MAX_CONCURRENT admission slots, so by default each process keeps
+# only its share of warm pdflatex workers instead of one per CPU core.
+TEX_POOL_PROCESSES = int(os.environ.get('TEX_POOL_PROCESSES', os.environ.get('WEB_CONCURRENCY', 1)))
+# Number of warm pdflatex workers of this process
+TEX_POOL_SIZE = int(os.environ.get('TEX_POOL_SIZE', math.ceil(TEX_MAX_CONCURRENT / max(1, TEX_POOL_PROCESSES))))
+# A worker wipes its scratch directory and starts over after this many jobs
+TEX_POOL_MAX_JOBS = int(os.environ.get('TEX_POOL_MAX_JOBS', 50))
+TEX_TIMEOUT = 60  # seconds per document
+POOL_DIR = os.environ.get('TEX_POOL_DIR', os.path.join(storage.SCRATCH_ROOT, 'tex_pool'))
+# Per-process ceilings, so a pathological document can't take the machine down (0 = no limit)
+TEX_MEMORY_LIMIT_MB = int(os.environ.get('TEX_MEMORY_LIMIT_MB', 1024))
+TEX_CPU_LIMIT = int(os.environ.get('TEX_CPU_LIMIT', TEX_TIMEOUT))  # CPU seconds
+
+JOB_NAME = 'job'
+SOURCE_NAME = 'document.tex'
+# The first line reads the job from stdin, so pdflatex can start and load its
+# format before a job exists. scrollmode is needed for \read from the terminal;
+# the job line switches back to nonstopmode.
+WAIT_FOR_JOB = r'\read16 to\WorksheetJob \WorksheetJob'
+
+PDFLATEX_NOT_FOUND = "pdflatex not found. Set USE_CLOUD_LATEX=true for cloud compilation."
+# Exit codes of a process stopped by the CPU time limit
+LIMIT_EXIT_CODES = {-getattr(signal, name) for name in ('SIGXCPU', 'SIGKILL') if hasattr(signal, name)}
+
+
+def apply_limits(pid):
+    """Sets the memory and CPU time ceilings of a running TeX process (Linux)."""
+    if resource is None or not hasattr(resource, 'prlimit'):
+        return
+    try:
+        if TEX_MEMORY_LIMIT_MB:
+            limit = TEX_MEMORY_LIMIT_MB * 1024 * 1024
+            resource.prlimit(pid, resource.RLIMIT_AS, (limit, limit))
+        if TEX_CPU_LIMIT:
+            # SIGXCPU at the soft limit, SIGKILL one second later
+            resource.prlimit(pid, resource.RLIMIT_CPU, (TEX_CPU_LIMIT, TEX_CPU_LIMIT + 1))
+    except (OSError, ValueError) as e:
+        # Process already exited, or limits above the hard limits of the server
+        print(f"Could not set resource limits for pdflatex {pid}: {e}")
+
+
+class _TexWorker(threading.Thread):
+    """
+    Keeps one pdflatex process started and blocked on stdin, with the format
+    already loaded. A TeX process can only typeset one document, so after each
+    job the next process is spawned right away, off the request path.
+    """
+
+    def __init__(self, pool, index):
+        super().__init__(name=f"tex-worker-{index}", daemon=True)
+        self.pool = pool
+        self.workdir = os.path.join(POOL_DIR, f"{os.getpid()}_{index}")
+        self.proc = None
+        self.proc_fmt = None
+        self.jobs_done = 0
+
+    def _reset_workdir(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+        os.makedirs(self.workdir, exist_ok=True)
+
+    def _spawn(self, fmt_name, format_dir):
+        for ext in ('.pdf', '.aux', '.log'):
+            path = os.path.join(self.workdir, JOB_NAME + ext)
+            if os.path.exists(path):
+                os.remove(path)
+
+        cmd = ['pdflatex', '-interaction=scrollmode', f'-jobname={JOB_NAME}', WAIT_FOR_JOB]
+        env = None
+        if fmt_name:
+            cmd.insert(1, f'-fmt={fmt_name}')
+            env = dict(os.environ, TEXFORMATS=format_dir + os.pathsep)
+
+        self.proc = subprocess.Popen(
+            cmd,
+            cwd=self.workdir,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env
+        )
+        apply_limits(self.proc.pid)
+        self.proc_fmt = fmt_name
+
+    def _warm_up(self):
+        try:
+            self._spawn(self.pool.warm_fmt, self.pool.format_dir)
+        except FileNotFoundError:
+            self.proc = None
+
+    def _kill(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.communicate()
+        self.proc = None
+
+    def _run_job(self, latex_source, pdf_path, fmt_name):
+        with open(os.path.join(self.workdir, SOURCE_NAME), 'w', encoding='utf-8') as f:
+            f.write(latex_source)
+
+        if self.proc is None or self.proc.poll() is not None or self.proc_fmt != fmt_name:
+            if self.proc is not None and self.proc.poll() is not None:
+                # Warm process crashed while idle
+                self.pool._count('restarts')
+            self._kill()
+            try:
+                self._spawn(fmt_name, self.pool.format_dir)
+            except FileNotFoundError:
+                return None, b'', PDFLATEX_NOT_FOUND
+        else:
+            self.pool._count('warm_hits')
+
+        proc, self.proc = self.proc, None
+        try:
+            stdout, stderr = proc.communicate(
+                f'\\nonstopmode\\input{{{SOURCE_NAME}}}\n'.encode('utf-8'),
+                timeout=TEX_TIMEOUT
+            )
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            return None, b'', f"LaTeX compilation timeout ({TEX_TIMEOUT}s). Document may be too complex."
+
+        job_pdf = os.path.join(self.workdir, f"{JOB_NAME}.pdf")
+        if os.path.exists(job_pdf):
+            os.replace(job_pdf, pdf_path)
+            return pdf_path, stdout, None
+
+        if proc.returncode in LIMIT_EXIT_CODES:
+            return None, stdout, "LaTeX process was stopped: the document exceeded the memory or CPU time limit."
+        if proc.returncode != 0:
+            return None, stdout, f"LaTeX Compilation Error: {stderr.decode('utf-8', errors='ignore') if stderr else 'Unknown error'}"
+        return None, stdout, "PDF was not created."
+
+    def run(self):
+        self._reset_workdir()
+        self._warm_up()
+        while True:
+            job = self.pool._jobs.get()
+            if job is None:
+                self._kill()
+                return
+            future, latex_source, pdf_path, fmt_name = job
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            with self.pool._lock:
+                self.pool._busy += 1
+            try:
+                future.set_result(self._run_job(latex_source, pdf_path, fmt_name))
+            except Exception as e:
+                self._kill()
+                self.pool._count('restarts')
+                future.set_result((None, b'', f"Unexpected error: {str(e)}"))
+            finally:
+                with self.pool._lock:
+                    self.pool._busy -= 1
+                    self.pool._stats['jobs'] += 1
+
+            self.jobs_done += 1
+            if self.jobs_done >= TEX_POOL_MAX_JOBS:
+                self._kill()
+                self._reset_workdir()
+                self.jobs_done = 0
+                self.pool._count('recycled')
+            if fmt_name:
+                # Jobs compiled with the full preamble don't change the format to preload
+                self.pool.warm_fmt = fmt_name
+            self._warm_up()
+
+
+class TexPool:
+    """Pool of warm pdflatex workers fed from a job queue."""
+
+    def __init__(self, size=TEX_POOL_SIZE, warm_fmt=None, format_dir=None):
+        self.size = max(1, size)
+        self.warm_fmt = warm_fmt
+        self.format_dir = format_dir or ''
+        self._jobs = queue.Queue()
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._stats = {'jobs': 0, 'warm_hits': 0, 'restarts': 0, 'recycled': 0}
+        self._workers = [_TexWorker(self, i) for i in range(self.size)]
+        for worker in self._workers:
+            worker.start()
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def submit(self, latex_source, pdf_path, fmt_name=None):
+        """
+        Queues a document for compilation.
+        Returns a Future resolving to (pdf_path, pdflatex_output, error).
+        """
+        future = Future()
+        self._jobs.put((future, latex_source, pdf_path, fmt_name))
+        return future
+
+    def compile(self, latex_source, pdf_path, fmt_name=None):
+        return self.submit(latex_source, pdf_path, fmt_name).result()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=self.size, busy=self._busy, queue_depth=self._jobs.qsize())
+
+    def shutdown(self):
+        for _ in self._workers:
+            self._jobs.put(None)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool_stats():
+    """Returns pool counters, or None if the pool was never started."""
+    return _pool.stats() if _pool is not None else None
+
+
+def get_tex_pool(warm_fmt=None, format_dir=None):
+    """Returns the process-wide TeX pool, starting it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = TexPool(warm_fmt=warm_fmt, format_dir=format_dir)
+        return _pool
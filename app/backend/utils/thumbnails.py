@@ -0,0 +1,118 @@
+import os
+import subprocess
+import threading
+
+from utils import storage
+from utils.admission import make_slots, acquire_slot
+
+# PNG previews of generated PDFs, rendered with pdftoppm (poppler-utils) on
+# first request and stored next to the PDF, so the reaper evicts them together.
+# At most THUMBNAIL_CONCURRENCY renders run at once on the machine; a request
+# that can't get a slot within THUMBNAIL_WAIT seconds is turned away, so
+# thumbnail bursts never compete with compiles for long.
+THUMBNAIL_CONCURRENCY = int(os.environ.get('THUMBNAIL_CONCURRENCY', 2))
+THUMBNAIL_WAIT = float(os.environ.get('THUMBNAIL_WAIT', 3))
+THUMBNAIL_TIMEOUT = 20  # seconds per render
+THUMBNAIL_RETRY_AFTER = 2
+
+DEFAULT_WIDTH = 240
+MIN_WIDTH = 80
+MAX_WIDTH = 1200
+WIDTH_STEP = 80  # widths are rounded to a step so clients can't fill the disk with variants
+MAX_PAGE = 50
+# Renders run at a lower CPU priority than pdflatex
+THUMBNAIL_NICE = 10
+
+PDFTOPPM_NOT_FOUND = "pdftoppm not found. Install poppler-utils to enable thumbnails."
+
+_slots = make_slots('thumb', THUMBNAIL_CONCURRENCY)
+_stats = {'rendered': 0, 'cache_hits': 0, 'busy': 0, 'failed': 0}
+_lock = threading.Lock()
+
+
+class ThumbnailBusy(Exception):
+    """All render slots are taken; answer with 503 and Retry-After."""
+
+    retry_after = THUMBNAIL_RETRY_AFTER
+
+
+def _count(key):
+    with _lock:
+        _stats[key] += 1
+
+
+def normalize_width(width):
+    width = min(max(width or DEFAULT_WIDTH, MIN_WIDTH), MAX_WIDTH)
+    return int(round(width / WIDTH_STEP) * WIDTH_STEP)
+
+
+def thumbnail_name(pdf_name, page, width):
+    """'a3/worksheet_x.pdf' -> 'worksheet_x.p1.w240.png' (stored in the same shard)."""
+    base = os.path.basename(pdf_name)
+    if base.endswith('.pdf'):
+        base = base[:-4]
+    return f"{base}.p{page}.w{width}.png"
+
+
+def _render(pdf_path, png_path, page, width):
+    out_prefix = png_path[:-len('.png')]
+    proc = subprocess.Popen(
+        ['pdftoppm', '-png', '-f', str(page), '-l', str(page),
+         '-scale-to-x', str(width), '-scale-to-y', '-1', '-singlefile',
+         pdf_path, out_prefix],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    try:
+        os.setpriority(os.PRIO_PROCESS, proc.pid, THUMBNAIL_NICE)
+    except (AttributeError, OSError):
+        pass
+    try:
+        _, stderr = proc.communicate(timeout=THUMBNAIL_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        return "Thumbnail rendering timed out."
+    if proc.returncode != 0 or not os.path.exists(png_path):
+        return f"Thumbnail rendering failed: {stderr.decode('utf-8', errors='ignore').strip() or 'unknown error'}"
+    return None
+
+
+def get_thumbnail(pdf_path, page=1, width=DEFAULT_WIDTH):
+    """
+    Returns (stored_name, error) of the PNG of one page of a generated PDF,
+    rendering it on first use. Raises ThumbnailBusy when no render slot is free.
+    """
+    name = thumbnail_name(pdf_path, page, width)
+    if os.path.exists(storage.stored_path(name)):
+        _count('cache_hits')
+        return storage.stored_name(name), None
+
+    slot = acquire_slot(_slots, THUMBNAIL_WAIT)
+    if slot is None:
+        _count('busy')
+        raise ThumbnailBusy()
+    try:
+        # Another request may have rendered it while we waited
+        if os.path.exists(storage.stored_path(name)):
+            _count('cache_hits')
+            return storage.stored_name(name), None
+
+        with storage.scratch_dir() as job_dir:
+            png_path = os.path.join(job_dir, name)
+            try:
+                error = _render(pdf_path, png_path, page, width)
+            except FileNotFoundError:
+                error = PDFTOPPM_NOT_FOUND
+            if error:
+                _count('failed')
+                return None, error
+            _count('rendered')
+            return storage.publish(png_path, name), None
+    finally:
+        _slots.release(slot)
+
+
+def get_thumbnail_stats():
+    with _lock:
+        return dict(_stats, max_concurrent=THUMBNAIL_CONCURRENCY)
@@ -3,11 +3,52 @@ import base64
 import json
 from config import FOLDER_ID, IAM_TOKEN, API_KEY
 
+from utils.llm_result import LLMResult, LLMError
+from utils.llm_metrics import LLMCall, OK
+from utils.layout import layout_for
+
+# Bump when the prompts change (recorded with every call in the LLM metrics)
+PROMPT_VERSION = "1"
+COMPLETION_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+
 def get_auth_header():
     if IAM_TOKEN:
         return f"Bearer {IAM_TOKEN}"
     return f"Api-Key {API_KEY}"
 
+def _completion_result(response):
+    """Turns a YandexGPT completion response into an LLMResult."""
+    if response.status_code == 200:
+        result = response.json()
+        text = result['result']['alternatives'][0]['message']['text'].strip()
+        if not text:
+            return LLMResult.failure(LLMError.INVALID_OUTPUT, "The model returned an empty answer.", provider='yandexgpt')
+        return LLMResult(latex=text)
+    if response.status_code in (401, 403):
+        kind = LLMError.AUTH
+    elif response.status_code == 429:
+        kind = LLMError.RATE_LIMIT
+    else:
+        kind = LLMError.PROVIDER
+    return LLMResult.failure(kind, f"HTTP {response.status_code}: {response.text[:500]}", provider='yandexgpt')
+
+def _request_completion(headers, prompt, operation):
+    """Sends a completion request and records its timing and token usage."""
+    metrics = LLMCall('yandexgpt', 'yandexgpt', operation, PROMPT_VERSION)
+    try:
+        response = requests.post(COMPLETION_URL, headers=headers, json=prompt)
+        result = _completion_result(response)
+        if result.ok:
+            usage = response.json()['result'].get('usage', {})
+            to_int = lambda value: int(value) if value is not None else None
+            metrics.set_usage(to_int(usage.get('inputTextTokens')), to_int(usage.get('completionTokens')), to_int(usage.get('totalTokens')))
+    except requests.Timeout:
+        result = LLMResult.failure(LLMError.TIMEOUT, "YandexGPT did not answer in time.", provider='yandexgpt')
+    except Exception as e:
+        result = LLMResult.failure(LLMError.PROVIDER, str(e), provider='yandexgpt')
+    metrics.finish_result(result)
+    return result
+
 def ocr_image(image_path):
     """
     Performs OCR using Yandex Vision API (v1).
@@ -35,12 +76,14 @@ def ocr_image(image_path):
         "Authorization": get_auth_header()
     }
 
+    metrics = LLMCall('yandex_vision', 'ocr', 'ocr', PROMPT_VERSION, images=1)
     try:
         response = requests.post(
             "https://vision.api.cloud.yandex.net/vision/v1/batchAnalyze",
             headers=headers,
             json=body
         )
+        metrics.finish(OK if response.status_code == 200 else f"http_{response.status_code}")
         
         if response.status_code != 200:
             return f"OCR Error: {response.text}"
@@ -69,44 +112,19 @@ def ocr_image(image_path):
         return full_text if full_text else "No text found in image."
 
     except Exception as e:
+        metrics.finish(LLMError.PROVIDER)
         return f"OCR Exception: {str(e)}"
 
 def generate_worksheet_latex(text, topic="General", task_count=3):
     """
     Uses YandexGPT to generate LaTeX content.
+    Returns an LLMResult.
     """
     if not API_KEY and not IAM_TOKEN:
-        return "Error: No Yandex Credentials provided."
+        return LLMResult.failure(LLMError.CONFIG, "No Yandex Credentials provided.", provider='yandexgpt')
     
-    # --- Dynamic Layout Calculation ---
-    # A4 printable height approx 240mm (minus headers/margins)
-    # Header: ~40mm. Title: ~15mm. 
-    # Available for tasks: ~185mm.
-    # We estimate task text takes ~20mm. 
-    # But if there are many tasks, text must be shorter or grid smaller.
-    
-    available_height = 190 # mm
-    
-    # Calculate grid height per task
-    # Formula: (Available - (TaskCount * TextBuffer)) / TaskCount
-    # TextBuffer is space for the question text itself.
-    text_buffer = 15 # mm
-    
-    try:
-        count = int(task_count)
-    except:
-        count = 3
-        
-    if count < 1: count = 1
-    if count > 6: count = 6
-
-    # Calculate grid height
-    raw_grid_height = (available_height / count) - text_buffer
-    
-    # Safety bounds
-    if raw_grid_height < 10: raw_grid_height = 10
-    
-    grid_height_mm = int(raw_grid_height)
+    # Tasks per page and the height of the answer fields (utils/layout.py)
+    count, grid_height_mm = layout_for(task_count)
     
     headers = {
         "Authorization": get_auth_header(),
@@ -157,39 +175,22 @@ def generate_worksheet_latex(text, topic="General", task_count=3):
         ]
     }
 
-    try:
-        response = requests.post(
-            "https://llm.api.cloud.yandex.net/foundationModels/v1/completion",
-            headers=headers,
-            json=prompt
-        )
-        if response.status_code == 200:
-            result = response.json()
-            return result['result']['alternatives'][0]['message']['text']
-        else:
-            return f"Error from YandexGPT: {response.text}"
-    except Exception as e:
-        return f"Exception: {str(e)}"
+    return _request_completion(headers, prompt, 'generate_latex')
 
 def generate_similar_worksheet(original_text, task_count=3, difficulty="same"):
     """
     Uses YandexGPT to generate a similar worksheet (Variant 2).
+    Returns an LLMResult.
     """
     if not API_KEY and not IAM_TOKEN:
-        return "Error: No Yandex Credentials provided."
+        return LLMResult.failure(LLMError.CONFIG, "No Yandex Credentials provided.", provider='yandexgpt')
         
     headers = {
         "Authorization": get_auth_header(),
         "x-folder-id": FOLDER_ID
     }
     
-    available_height = 190
-    text_buffer = 15
-    try: count = int(task_count)
-    except: count = 3
-    if count < 1: count = 1
-    if count > 6: count = 6
-    grid_height_mm = max(10, int((available_height / count) - text_buffer))
+    count, grid_height_mm = layout_for(task_count)
     
     diff_prompt = ""
     if difficulty == "harder":
@@ -230,16 +231,4 @@ def generate_similar_worksheet(original_text, task_count=3, difficulty="same"):
         ]
     }
 
-    try:
-        response = requests.post(
-            "https://llm.api.cloud.yandex.net/foundationModels/v1/completion",
-            headers=headers,
-            json=prompt
-        )
-        if response.status_code == 200:
-            result = response.json()
-            return result['result']['alternatives'][0]['message']['text']
-        else:
-            return f"Error from YandexGPT: {response.text}"
-    except Exception as e:
-        return f"Exception: {str(e)}"
+    return _request_completion(headers, prompt, 'generate_similar')
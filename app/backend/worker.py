@@ -0,0 +1,151 @@
+"""
+Job queue workers: python worker.py
+
+Runs JOB_WORKERS processes that take jobs submitted through /api/jobs from the
+queue (utils/jobs.py) and run them through the same pipeline as the
+synchronous endpoints. Throughput scales with the number of workers, not with
+the number of gunicorn workers.
+"""
+import os
+import time
+import signal
+import socket
+import threading
+import multiprocessing
+
+from utils import jobs
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 0.5))  # seconds between polls of an empty queue
+REQUEUE_INTERVAL = 30  # seconds between checks for jobs of crashed workers
+# A worker runs one job at a time (worksheet + answer keys), so it needs two warm pdflatex processes
+WORKER_TEX_POOL_SIZE = os.environ.get('WORKER_TEX_POOL_SIZE', '2')
+
+
+def run_job(job):
+    """Returns (response_data, http_status) for a claimed job."""
+    from utils import pipeline, llm_metrics
+
+    payload = job['payload']
+    llm_metrics.set_endpoint(f"job:{job['kind']}")
+    if job['kind'] == 'process':
+        return pipeline.process_images(payload['filepaths'], task_count=payload.get('task_count', 3), model=payload.get('model', 'GigaChat-Max'), use_cache=not payload.get('no_cache'))
+    if job['kind'] == 'generate_similar':
+        return pipeline.generate_similar(payload['original_text'], task_count=payload.get('task_count', 3), model=payload.get('model', 'GigaChat-Max'), difficulty=payload.get('difficulty', 'same'))
+    if job['kind'] == 'compile':
+        return pipeline.compile_worksheet(payload)
+    if job['kind'] == 'class_set':
+        return pipeline.make_class_set(payload)
+    return {'error': f"Unknown job kind: {job['kind']}"}, 400
+
+
+def _keep_lease(job_id, worker_name, done):
+    while not done.wait(jobs.JOB_LEASE_SECONDS / 3):
+        try:
+            jobs.renew_lease(job_id, worker_name)
+        except Exception as e:
+            print(f"Failed to renew lease of job {job_id}: {e}")
+
+
+def work(worker_name, stop=None):
+    """Claims and runs jobs until stop is set."""
+    stop = stop or threading.Event()
+    next_requeue = 0
+    while not stop.is_set():
+        try:
+            if time.monotonic() >= next_requeue:
+                requeued = jobs.requeue_expired()
+                if requeued:
+                    print(f"{worker_name}: requeued {requeued} job(s) of stopped workers")
+                next_requeue = time.monotonic() + REQUEUE_INTERVAL
+
+            job = jobs.claim_job(worker_name)
+        except Exception as e:
+            print(f"{worker_name}: job queue error: {e}")
+            job = None
+        if job is None:
+            stop.wait(JOB_POLL_INTERVAL)
+            continue
+
+        done = threading.Event()
+        threading.Thread(target=_keep_lease, args=(job['id'], worker_name, done), daemon=True).start()
+        try:
+            result, http_status = run_job(job)
+        except Exception as e:
+            result, http_status = {'error': f"Unexpected error: {str(e)}"}, 500
+        finally:
+            done.set()
+
+        if http_status == 429 and 'retry_after' in result:
+            # TeX capacity is exhausted: put the job back instead of failing it, and back off
+            jobs.release_job(job['id'], worker_name)
+            stop.wait(result['retry_after'])
+            continue
+        jobs.finish_job(job['id'], worker_name, result, http_status)
+
+
+def start_inprocess_workers(count):
+    """Runs queue workers as threads of the current process (single-process deployments)."""
+    for i in range(count):
+        name = f"{socket.gethostname()}:{os.getpid()}:t{i}"
+        threading.Thread(target=work, args=(name,), name=f"job-worker-{i}", daemon=True).start()
+
+
+def _worker_process(index):
+    # Finish the current job, then exit
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    from utils.latex import warm_up_latex
+    warm_up_latex()
+    work(f"{socket.gethostname()}:{os.getpid()}", stop)
+
+
+def main():
+    # Must be set before utils.tex_pool is imported by the workers
+    os.environ.setdefault('TEX_POOL_SIZE', WORKER_TEX_POOL_SIZE)
+
+    from utils.db import init_db
+    from utils.llm_cache import init_llm_cache_db
+    from utils.speculative import init_speculative_db
+    from utils.llm_limits import init_llm_limits_db
+    from utils.llm_metrics import init_llm_metrics_db
+    init_db()
+    jobs.init_jobs_db()
+    init_llm_cache_db()
+    init_speculative_db()
+    init_llm_limits_db()
+    init_llm_metrics_db()
+
+    processes = {}
+    stopping = False
+
+    def shutdown(*_):
+        nonlocal stopping
+        stopping = True
+        for proc in processes.values():
+            proc.terminate()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    print(f"Starting {JOB_WORKERS} job workers")
+    while not stopping:
+        # Start missing workers and replace crashed ones; their jobs are requeued when the lease runs out
+        for index in range(JOB_WORKERS):
+            proc = processes.get(index)
+            if proc is None or not proc.is_alive():
+                if proc is not None:
+                    print(f"Job worker {index} exited with code {proc.exitcode}, restarting")
+                proc = multiprocessing.Process(target=_worker_process, args=(index,), name=f"job-worker-{index}")
+                proc.start()
+                processes[index] = proc
+        time.sleep(1)
+
+    for proc in processes.values():
+        proc.join(timeout=30)
+
+
+if __name__ == '__main__':
+    main()
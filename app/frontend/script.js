@@ -28,21 +28,38 @@ document.getElementById('fileInput').addEventListener('change', async (e) => {
     formData.append('model', gigaModel);
 
     const statusDiv = document.getElementById('status');
-    statusDiv.innerHTML = '<p>Обработка... Пожалуйста, подождите.</p><div class="loader"></div>';
+    const controller = new AbortController();
+    statusDiv.innerHTML = `
+        <p>Обработка... Задачи появляются по мере распознавания.</p><div class="loader"></div>
+        <ol id="streamedTasks" class="streamed-tasks"></ol>
+        <button id="cancelProcessBtn" class="action-btn tertiary">
+            <ion-icon name="close-circle-outline"></ion-icon>
+            Отменить
+        </button>
+    `;
+    document.getElementById('cancelProcessBtn').addEventListener('click', () => controller.abort());
+    const streamedTasks = document.getElementById('streamedTasks');
 
     try {
-        const response = await fetch('/worksheet-api/process', {
-            method: 'POST',
-            body: formData
-        });
-        const result = await response.json();
+        const { ok, result } = await streamLatex('/worksheet-api/process/stream', formData, (task) => {
+            const item = document.createElement('li');
+            item.textContent = task.text;
+            streamedTasks.appendChild(item);
+        }, controller.signal);
 
-        if (response.ok) {
+        if (ok) {
             // Store LaTeX code
             window.currentLatexCode = result.latex_code || '';
 
+            // Pages that could not be uploaded were left out of the worksheet
+            const failedPages = (result.failed_files || []).map(f => f.page).join(', ');
+            const failedNote = failedPages
+                ? `<p class="error">Не удалось загрузить страницы: ${failedPages}. Задачи с них не распознаны.</p>`
+                : '';
+
             statusDiv.innerHTML = `
                 <p class="success">Текст распознан! ✅</p>
+                ${failedNote}
                 <div class="editor-container">
                     <div class="editor-header">
                         <span><ion-icon name="code-slash-outline"></ion-icon> Редактор LaTeX (проверьте код перед печатью)</span>
@@ -104,6 +121,7 @@ document.getElementById('fileInput').addEventListener('change', async (e) => {
                                     <ion-icon name="key-outline"></ion-icon>
                                     Ответы В1
                                 </a>` : ''}
+                                ${compileRes.keys_error ? `<span class="error">Ответы не собрались</span>` : ''}
                             </div>
                             <div class="action-group" style="flex-direction: column; align-items: center; gap: 8px;">
                                 <select id="variantDifficulty" class="topic-input" style="max-width: 250px; text-align: center;">
@@ -159,13 +177,11 @@ document.getElementById('fileInput').addEventListener('change', async (e) => {
                     formData2.append('topic', topic);
                     formData2.append('teacher_name', teacherName);
 
-                    const resp2 = await fetch('/worksheet-api/generate_similar', {
-                        method: 'POST',
-                        body: formData2
+                    const { ok: ok2, result: res2 } = await streamLatex('/worksheet-api/generate_similar/stream', formData2, (task) => {
+                        status2.innerHTML = `<div class="loader small"></div> Готово задач: ${task.index}`;
                     });
-                    const res2 = await resp2.json();
 
-                    if (resp2.ok) {
+                    if (ok2) {
                         // Store LaTeX code for variant 2
                         window.currentLatexCode2 = res2.latex_code || '';
 
@@ -196,6 +212,7 @@ document.getElementById('fileInput').addEventListener('change', async (e) => {
                                         <ion-icon name="key-outline"></ion-icon>
                                         Ответы В2
                                     </a>` : ''}
+                                    ${compileRes2.keys_error ? `<span class="error">Ответы не собрались</span>` : ''}
                                     <button onclick="showLatexModal(window.currentLatexCode2 || 'LaTeX код недоступен')" class="action-btn tertiary">
                                         <ion-icon name="code-slash-outline"></ion-icon>
                                         LaTeX Варианта 2
@@ -222,11 +239,52 @@ document.getElementById('fileInput').addEventListener('change', async (e) => {
             statusDiv.innerHTML = `<p class="error">Ошибка: ${result.error}</p>`;
         }
     } catch (error) {
+        if (error.name === 'AbortError') {
+            statusDiv.innerHTML = '<p>Распознавание отменено.</p>';
+            return;
+        }
         statusDiv.innerHTML = `<p class="error">Ошибка сети: ${error.message}</p>`;
         console.error(error);
     }
 });
 
+// Reads the Server-Sent Events of a /stream endpoint: calls onTask for every
+// task as soon as the model has finished writing it, and resolves with
+// {ok, result}, where result is the data of the final 'done' or 'error' event.
+async function streamLatex(url, formData, onTask, signal) {
+    const response = await fetch(url, { method: 'POST', body: formData, signal });
+    const contentType = response.headers.get('Content-Type') || '';
+    if (!contentType.startsWith('text/event-stream')) {
+        // Request rejected before streaming started (e.g. no files)
+        return { ok: response.ok, result: await response.json() };
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const block = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            let event = 'message';
+            let data = '';
+            for (const line of block.split('\n')) {
+                if (line.startsWith('event: ')) event = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            }
+            if (event === 'task') onTask(JSON.parse(data));
+            else if (event === 'done') return { ok: true, result: JSON.parse(data) };
+            else if (event === 'error') return { ok: false, result: JSON.parse(data) };
+        }
+    }
+    return { ok: false, result: { error: 'Соединение с сервером прервано' } };
+}
+
 // LaTeX Modal Function
 function showLatexModal(latexCode) {
     // Remove existing modal if any
@@ -325,6 +383,32 @@ document.addEventListener('keydown', (e) => {
     }
 });
 
+// A busy renderer (503) is asked once more after its Retry-After; anything else
+// leaves a placeholder, so the preview never disappears from the list
+async function thumbnailFailed(img) {
+    const link = img.parentElement;
+    if (!img.dataset.retried) {
+        img.dataset.retried = '1';
+        try {
+            const resp = await fetch(img.src);
+            if (resp.status === 503) {
+                const delay = parseFloat(resp.headers.get('Retry-After')) || 2;
+                setTimeout(() => { img.src += '&retry=1'; }, delay * 1000);
+                return;
+            }
+            if (resp.ok) {
+                img.src = URL.createObjectURL(await resp.blob());
+                return;
+            }
+        } catch (err) {
+            // Network error: fall through to the placeholder
+        }
+    }
+    img.remove();
+    link.classList.add('history-thumb-missing');
+    link.innerHTML = '<ion-icon name="document-outline"></ion-icon>';
+}
+
 // Load History
 async function loadHistory() {
     const historyContainer = document.getElementById('historyContainer');
@@ -340,9 +424,13 @@ async function loadHistory() {
                     hour: '2-digit', minute: '2-digit'
                 });
 
+                // Preview of the first page, rendered by the server on first request
+                const thumbUrl = item.pdf_url ? item.pdf_url.replace('/generated/', '/thumbnail/') + '?width=160' : null;
+
                 const div = document.createElement('div');
                 div.className = 'history-item';
                 div.innerHTML = `
+                    ${thumbUrl ? `<a href="${item.pdf_url}" target="_blank" class="history-thumb"><img src="${thumbUrl}" loading="lazy" alt="" onerror="thumbnailFailed(this)"></a>` : ''}
                     <div class="history-info">
                         <h4>${escapeHtml(item.topic || 'Без темы')}</h4>
                         <p>${date} | Учитель: ${escapeHtml(item.teacher_name || 'Не указан')}</p>
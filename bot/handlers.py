@@ -1,4 +1,5 @@
 import os
+import time
 import requests
 import uuid
 import json
@@ -6,11 +7,60 @@ from telebot.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, C
 
 # The URL where your Flask backend is running (port 3005 as configured in Nginx/app)
 BACKEND_URL = "http://127.0.0.1:3005"
+# The asyncio server (backend/async_app.py) holds the long polls of queued jobs
+ASYNC_BACKEND_URL = "http://127.0.0.1:3006"
+
+# Send work through the backend job queue (needs backend/worker.py running) instead of
+# the synchronous endpoints; bot jobs are scheduled after interactive web requests
+USE_JOB_QUEUE = os.environ.get('WORKSHEET_USE_JOB_QUEUE', 'false').lower() == 'true'
+JOB_TIMEOUT = 600  # seconds
+
+# When the bot runs on the same machine as the backend, generated PDFs are read
+# straight from app/backend/static/generated instead of being downloaded again
+GENERATED_DIR = os.environ.get('WORKSHEET_GENERATED_DIR')
 
 # In-memory store for user state
 # { chat_id: {'latex_code': str, 'teacher_name': str, 'layout': str, 'topic': str} }
 USER_DATA = {}
 
+def call_backend(kind, files=None, data=None, json_body=None):
+    """
+    Runs /api/<kind> (process, compile, generate_similar) and returns the response.
+    With the job queue the result endpoint answers exactly like the synchronous one.
+    """
+    if not USE_JOB_QUEUE:
+        return requests.post(f"{BACKEND_URL}/api/{kind}", files=files, data=data, json=json_body)
+
+    if files:
+        resp = requests.post(f"{BACKEND_URL}/api/jobs", files=files, data=dict(data or {}, kind=kind, source='bot'))
+    else:
+        resp = requests.post(f"{BACKEND_URL}/api/jobs", json=dict(json_body or data or {}, kind=kind, source='bot'))
+    if resp.status_code != 202:
+        return resp
+
+    job_id = resp.json()['job_id']
+    deadline = time.time() + JOB_TIMEOUT
+    while True:
+        # Long poll: the backend holds the request until the job is finished or 30 s have passed
+        try:
+            resp = requests.get(f"{ASYNC_BACKEND_URL}/api/jobs/{job_id}/result", params={'wait': 30}, timeout=60)
+        except requests.ConnectionError:
+            # No async_app.py: gunicorn caps the wait at a few seconds
+            resp = requests.get(f"{BACKEND_URL}/api/jobs/{job_id}/result", params={'wait': 30}, timeout=60)
+        if resp.status_code != 202 or time.time() > deadline:
+            return resp
+
+def fetch_generated(url):
+    """Returns the bytes of a generated file given its /worksheet-api/generated/... URL, or None."""
+    name = url.split('/generated/', 1)[-1]
+    if GENERATED_DIR:
+        path = os.path.join(GENERATED_DIR, *name.split('/'))
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                return f.read()
+    resp = requests.get(f"{BACKEND_URL}/api/generated/{name}")
+    return resp.content if resp.status_code == 200 else None
+
 def register_handlers(bot):
     
     @bot.message_handler(commands=['start', 'help'])
@@ -66,7 +116,7 @@ def register_handlers(bot):
                 teacher = '@' + str(message.from_user.username) if message.from_user.username else ''
                 data = {'topic': 'Рабочий лист (из Telegram)', 'teacher_name': teacher}
                 
-                resp = requests.post(f"{BACKEND_URL}/api/process", files=files, data=data)
+                resp = call_backend('process', files=files, data=data)
             
             # Clean up temp file
             if os.path.exists(tmp_filepath):
@@ -103,7 +153,7 @@ def register_handlers(bot):
     def call_compile_and_send(chat_id, latex_code, topic, teacher_name, layout, is_variant2=False):
         bot.send_message(chat_id, "⏳ Компилирую PDF...")
         try:
-            compile_resp = requests.post(f"{BACKEND_URL}/api/compile", json={
+            compile_resp = call_backend('compile', json_body={
                 'latex_code': latex_code,
                 'topic': topic,
                 'teacher_name': teacher_name,
@@ -118,18 +168,18 @@ def register_handlers(bot):
                 
                 # Fetch PDFs and send
                 if pdf_url:
-                    pdf_url_local = pdf_url.replace('/worksheet-api/', '/api/')
-                    pdf_resp = requests.get(f"{BACKEND_URL}{pdf_url_local}")
-                    if pdf_resp.status_code == 200:
+                    pdf_content = fetch_generated(pdf_url)
+                    if pdf_content:
                         doc_name = "variant2.pdf" if is_variant2 else "worksheet.pdf"
-                        bot.send_document(chat_id, (doc_name, pdf_resp.content))
+                        bot.send_document(chat_id, (doc_name, pdf_content))
                         
                 if keys_url:
-                    keys_url_local = keys_url.replace('/worksheet-api/', '/api/')
-                    keys_resp = requests.get(f"{BACKEND_URL}{keys_url_local}")
-                    if keys_resp.status_code == 200:
+                    keys_content = fetch_generated(keys_url)
+                    if keys_content:
                         doc_name = "variant2_keys.pdf" if is_variant2 else "keys.pdf"
-                        bot.send_document(chat_id, (doc_name, keys_resp.content))
+                        bot.send_document(chat_id, (doc_name, keys_content))
+                elif compile_data.get('keys_error'):
+                    bot.send_message(chat_id, "⚠️ Не удалось собрать PDF с ответами, отправляю только задания.")
                         
                 bot.send_message(chat_id, "🎉 Готово! Ваш рабочий лист успешно создан.")
                 
@@ -187,7 +237,7 @@ def register_handlers(bot):
         bot.send_message(chat_id, "🤖 Генерирую Вариант 2 (ИИ придумывает новые задачи)... Это может занять около минуты.")
         
         try:
-            resp = requests.post(f"{BACKEND_URL}/api/generate_similar", data={
+            resp = call_backend('generate_similar', data={
                 'original_text': user_info['latex_code'],
                 'task_count': 3,
                 'difficulty': difficulty,
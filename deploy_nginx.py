@@ -1,11 +1,40 @@
 import os
 
+# Set WORKSHEET_ASYNC_APP=false when async_app.py is not running: gunicorn
+# then serves recognition and Variant 2 as well
+ASYNC_APP = os.environ.get('WORKSHEET_ASYNC_APP', 'true').lower() == 'true'
+
+async_conf = """
+    # Recognition and Variant 2 wait for GigaChat for up to two minutes: they go to
+    # the asyncio server (app/backend/async_app.py), not to the gunicorn workers
+    location ~ ^/worksheet-api/(process|generate_similar)(/stream)?$ {
+        rewrite ^/worksheet-api/(.*) /api/$1 break;
+        proxy_pass http://127.0.0.1:3006;
+        proxy_set_header Host $host;
+        proxy_set_header X-Real-IP $remote_addr;
+        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+        proxy_set_header X-Forwarded-Proto $scheme;
+        proxy_read_timeout 180s;
+    }
+
+    # Long polls of queued jobs (?wait=N) wait there too instead of in a sync gunicorn worker
+    location ~ ^/worksheet-api/jobs/[^/]+(/result)?$ {
+        rewrite ^/worksheet-api/(.*) /api/$1 break;
+        proxy_pass http://127.0.0.1:3006;
+        proxy_set_header Host $host;
+        proxy_set_header X-Real-IP $remote_addr;
+        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+        proxy_set_header X-Forwarded-Proto $scheme;
+        proxy_read_timeout 60s;
+    }
+"""
+
 conf = """
     location /worksheet-creator/ {
         alias /home/pavel/projects/worksheet-creator/app/frontend/;
         index index.html;
     }
-
+""" + (async_conf if ASYNC_APP else "") + """
     location /worksheet-api/ {
         rewrite ^/worksheet-api/(.*) /api/$1 break;
         proxy_pass http://127.0.0.1:3005;
@@ -13,6 +42,20 @@ conf = """
         proxy_set_header X-Real-IP $remote_addr;
         proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
         proxy_set_header X-Forwarded-Proto $scheme;
+        # Lets the backend hand generated files back to nginx (see below)
+        proxy_set_header X-Sendfile-Type X-Accel-Redirect;
+    }
+
+    # Generated PDFs: Flask checks the request and answers with X-Accel-Redirect
+    # (run the backend with GENERATED_ACCEL_PREFIX=/worksheet-generated-internal/),
+    # nginx sends the file itself with sendfile and handles Range requests.
+    # The ETag comes from nginx too (the backend's is not passed on), so it
+    # also answers the browsers' If-None-Match with 304
+    location /worksheet-generated-internal/ {
+        internal;
+        alias /home/pavel/projects/worksheet-creator/app/backend/static/generated/;
+        sendfile on;
+        tcp_nopush on;
     }
 """
 